@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from books.models import Book
+from books.models import Book, BookInventoryShard
 
 
 admin.site.register(Book)
+admin.site.register(BookInventoryShard)
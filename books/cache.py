@@ -0,0 +1,136 @@
+"""
+Read-through cache for the book catalog.
+
+Catalog pages are stored under a key that embeds the catalog version, so a
+single INCR invalidates every cached page at once. Book detail payloads
+embed a per-book version that is bumped when that book changes. A reader
+that computed a value from data older than the bump stores it under the
+old version, where nobody looks for it. Invalidation runs after the
+surrounding transaction commits, so a page is never re-cached from data
+that is about to change.
+"""
+
+import hashlib
+import logging
+import time
+
+from django.core.cache import caches
+from django.db import transaction
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+CACHE_ALIAS = "catalog"
+CACHE_TIMEOUT = 5 * 60
+LOCK_TIMEOUT = 10
+LOCK_WAIT = 2
+LOCK_POLL_INTERVAL = 0.05
+
+VERSION_KEY = "books:catalog:version"
+HITS_KEY = "books:cache:hits"
+MISSES_KEY = "books:cache:misses"
+
+
+def _cache():
+    return caches[CACHE_ALIAS]
+
+
+def _incr(key) -> int:
+    try:
+        return _cache().incr(key)
+    except ValueError:
+        if _cache().add(key, 1, timeout=None):
+            return 1
+        return _cache().incr(key)
+
+
+def _version(key) -> int:
+    version = _cache().get(key)
+    if version is None:
+        _cache().add(key, 1, timeout=None)
+        version = _cache().get(key, 1)
+    return version
+
+
+def _book_version_key(book_id: int) -> str:
+    return f"books:detail:{book_id}:version"
+
+
+def catalog_page_key(url: str) -> str:
+    digest = hashlib.sha1(url.encode()).hexdigest()
+    return f"books:catalog:{_version(VERSION_KEY)}:{digest}"
+
+
+def book_detail_key(book_id: int) -> str:
+    book_id = int(book_id)
+    return f"books:detail:{book_id}:{_version(_book_version_key(book_id))}"
+
+
+def get_or_compute(get_key, compute):
+    """
+    Return the value cached under ``get_key()`` or compute and store it.
+
+    Only one caller recomputes a missing key, the others wait for its
+    result for up to LOCK_WAIT seconds. If Redis is unavailable the value
+    is computed without caching, a value computed before Redis failed
+    is returned as it is.
+    """
+    computed = None
+    try:
+        key = get_key()
+        data = _cache().get(key)
+        if data is not None:
+            _incr(HITS_KEY)
+            return data
+
+        _incr(MISSES_KEY)
+        lock_key = f"{key}:lock"
+        if _cache().add(lock_key, 1, timeout=LOCK_TIMEOUT):
+            try:
+                computed = compute()
+                _cache().set(key, computed, timeout=CACHE_TIMEOUT)
+            finally:
+                _cache().delete(lock_key)
+            return computed
+
+        deadline = time.monotonic() + LOCK_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(LOCK_POLL_INTERVAL)
+            data = _cache().get(key)
+            if data is not None:
+                return data
+
+    except RedisError:
+        logger.warning("Catalog cache is unavailable", exc_info=True)
+
+    return compute() if computed is None else computed
+
+
+def invalidate_catalog(*book_ids: int) -> None:
+    """Drop every cached catalog page and the given books' details on commit."""
+
+    def invalidate():
+        try:
+            _incr(VERSION_KEY)
+            for book_id in book_ids:
+                _incr(_book_version_key(book_id))
+        except RedisError:
+            logger.warning("Catalog cache invalidation failed", exc_info=True)
+
+    transaction.on_commit(invalidate)
+
+
+def catalog_cache_stats() -> dict:
+    try:
+        hits = _cache().get(HITS_KEY, 0)
+        misses = _cache().get(MISSES_KEY, 0)
+    except RedisError:
+        return {"available": False}
+
+    total = hits + misses
+    return {
+        "available": True,
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": round(hits / total, 4) if total else None,
+    }
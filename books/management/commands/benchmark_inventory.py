@@ -0,0 +1,70 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from books.models import Book
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures how many borrows per second a single title can take, "
+        "with a single inventory row and with sharded inventory"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=32)
+        parser.add_argument("--seconds", type=float, default=5)
+        parser.add_argument("--shards", type=int, default=16)
+        parser.add_argument(
+            "--hold-ms",
+            type=float,
+            default=5,
+            help="Time the borrow transaction keeps running after the "
+            "reservation (stands in for the rest of perform_create).",
+        )
+
+    def handle(self, *args, **options):
+        book = Book.objects.create(
+            title=f"Inventory benchmark {time.time()}",
+            author="Benchmark",
+            inventory=10**9,
+            daily_fee=1,
+        )
+        try:
+            single = self.run(book, options)
+            book.set_shard_count(options["shards"])
+            sharded = self.run(book, options)
+        finally:
+            book.delete()
+
+        self.stdout.write(f"single row: {single:.0f} borrows/s")
+        self.stdout.write(f"{options['shards']} shards: {sharded:.0f} borrows/s")
+        self.stdout.write(self.style.SUCCESS(f"speedup: x{sharded / single:.2f}"))
+
+    def run(self, book, options) -> float:
+        hold = options["hold_ms"] / 1000
+        deadline = time.monotonic() + options["seconds"]
+        counts = []
+
+        def worker():
+            done = 0
+            try:
+                while time.monotonic() < deadline:
+                    with transaction.atomic():
+                        Book.objects.reserve(book)
+                        time.sleep(hold)
+                    done += 1
+            finally:
+                connection.close()
+            counts.append(done)
+
+        threads = [threading.Thread(target=worker) for _ in range(options["threads"])]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return sum(counts) / (time.monotonic() - started)
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from books.cache import invalidate_catalog
+from books.models import Book
+
+
+class Command(BaseCommand):
+    help = (
+        "Spreads a book's inventory over N counter rows (sharded mode) "
+        "or folds it back into a single row with --shards 0"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("book_id", type=int)
+        parser.add_argument("--shards", type=int, default=8)
+
+    def handle(self, *args, **options):
+        if options["shards"] < 0:
+            raise CommandError("--shards must be 0 or greater.")
+
+        try:
+            book = Book.objects.get(id=options["book_id"])
+        except Book.DoesNotExist:
+            raise CommandError(f"Book {options['book_id']} does not exist.")
+
+        book.set_shard_count(options["shards"])
+        invalidate_catalog(book.id)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Book '{book.title}' uses {book.shard_count} inventory shards, "
+                f"{book.available_inventory} copies available."
+            )
+        )
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.1 on 2026-10-18 05:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("books", "0004_alter_book_unique_together"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="book",
+            index=models.Index(
+                fields=["author", "title", "id"], name="book_author_title_id_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.1.1 on 2026-10-18 05:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("books", "0006_book_search_vector_book_book_search_vector_idx_and_more"),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name="book",
+            constraint=models.CheckConstraint(
+                condition=models.Q(("inventory__gte", 0)),
+                name="book inventory must not be negative",
+            ),
+        ),
+    ]
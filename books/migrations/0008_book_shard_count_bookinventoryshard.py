@@ -0,0 +1,53 @@
+# Generated by Django 5.1.1 on 2026-10-18 05:33
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("books", "0007_book_book_inventory_must_not_be_negative"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="book",
+            name="shard_count",
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name="BookInventoryShard",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("index", models.PositiveSmallIntegerField()),
+                ("inventory", models.PositiveIntegerField(default=0)),
+                (
+                    "book",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="inventory_shards",
+                        to="books.book",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name_plural": "book inventory shards",
+                "constraints": [
+                    models.CheckConstraint(
+                        condition=models.Q(("inventory__gte", 0)),
+                        name="book inventory shard must not be negative",
+                    )
+                ],
+                "unique_together": {("book", "index")},
+            },
+        ),
+    ]
@@ -1,4 +1,86 @@
-from django.db import models
+import random
+import re
+
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import (
+    SearchQuery,
+    SearchRank,
+    SearchVector,
+    SearchVectorField,
+    TrigramWordSimilarity,
+)
+from django.db import models, transaction
+from django.db.models import F, FloatField, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Cast
+
+
+class BookQuerySet(models.QuerySet):
+    def search(self, text: str):
+        """
+        Full-text match of every word as a prefix of a title/author word,
+        or a fuzzy trigram match on the author. Annotates ``rank``
+        (cast to double precision so it survives a cursor round trip).
+        """
+        condition = Q(author__trigram_word_similar=text)
+        rank = TrigramWordSimilarity(text, "author")
+
+        terms = re.findall(r"\w+", text)
+        if terms:
+            query = SearchQuery(
+                " & ".join(f"{term}:*" for term in terms),
+                search_type="raw",
+                config="english",
+            )
+            condition |= Q(search_vector=query)
+            rank = SearchRank(F("search_vector"), query) + rank
+
+        return self.filter(condition).annotate(rank=Cast(rank, FloatField()))
+
+    def with_available_inventory(self):
+        """Annotate the stock held in inventory shards (see Book.shard_count)."""
+        shard_totals = (
+            BookInventoryShard.objects.filter(book=OuterRef("pk"))
+            .values("book")
+            .annotate(total=Sum("inventory"))
+            .values("total")
+        )
+        return self.annotate(sharded_inventory=Subquery(shard_totals))
+
+    def reserve(self, book: "Book") -> bool:
+        """
+        Take one copy of the book with a single conditional UPDATE.
+        Sharded books try their shards in random order first.
+        Returns False when no copy is left.
+        """
+        if book.shard_count:
+            shard_ids = list(
+                BookInventoryShard.objects.filter(
+                    book_id=book.id, inventory__gt=0
+                ).values_list("id", flat=True)
+            )
+            random.shuffle(shard_ids)
+            for shard_id in shard_ids:
+                reserved = BookInventoryShard.objects.filter(
+                    id=shard_id, inventory__gt=0
+                ).update(inventory=F("inventory") - 1)
+                if reserved:
+                    return True
+
+        reserved = self.filter(id=book.id, inventory__gt=0).update(
+            inventory=F("inventory") - 1
+        )
+        return reserved == 1
+
+    def release(self, book: "Book", quantity: int = 1) -> None:
+        """Put copies of the book back with a single UPDATE."""
+        if book.shard_count:
+            released = BookInventoryShard.objects.filter(
+                book_id=book.id, index=random.randrange(book.shard_count)
+            ).update(inventory=F("inventory") + quantity)
+            if released:
+                return
+
+        self.filter(id=book.id).update(inventory=F("inventory") + quantity)
 
 
 class Book(models.Model):
@@ -12,12 +94,125 @@ class Book(models.Model):
     author = models.CharField(max_length=255)
     cover = models.CharField(max_length=1, choices=STATUS_CHOICES, default="H")
     inventory = models.PositiveIntegerField()
+    shard_count = models.PositiveSmallIntegerField(default=0)
     daily_fee = models.DecimalField(max_digits=5, decimal_places=2)
+    search_vector = models.GeneratedField(
+        expression=(
+            SearchVector("title", weight="A", config="english")
+            + SearchVector("author", weight="B", config="english")
+        ),
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
+
+    objects = BookQuerySet.as_manager()
 
     def __str__(self):
         return f"{self.author} " f"{self.title[0:10]}"
 
+    @property
+    def available_inventory(self) -> int:
+        """
+        Copies available for borrowing. A sharded book keeps its stock in
+        BookInventoryShard rows, anything left in the inventory column
+        still counts.
+        """
+        if not self.shard_count:
+            return self.inventory
+
+        sharded_inventory = getattr(self, "sharded_inventory", None)
+        if sharded_inventory is None:
+            sharded_inventory = self.inventory_shards.aggregate(total=Sum("inventory"))[
+                "total"
+            ]
+        return self.inventory + (sharded_inventory or 0)
+
+    @available_inventory.setter
+    def available_inventory(self, value: int) -> None:
+        self.inventory = value
+        self.sharded_inventory = None
+        self._inventory_changed = True
+
+    def save(self, *args, **kwargs):
+        inventory_changed = getattr(self, "_inventory_changed", False)
+        self._inventory_changed = False
+        if not (self.shard_count and inventory_changed):
+            return super().save(*args, **kwargs)
+
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            self.set_shard_count(self.shard_count, total=self.inventory)
+
+    @transaction.atomic
+    def set_shard_count(self, shard_count: int, total: int = None) -> None:
+        """
+        Spread the book's stock evenly over ``shard_count`` counter rows so
+        that concurrent borrows of a hot title do not queue on one row
+        lock. ``0`` folds the shards back into the inventory column.
+        ``total`` replaces the current stock instead of carrying it over.
+        """
+        book = Book.objects.select_for_update().get(id=self.id)
+        shards = BookInventoryShard.objects.select_for_update().filter(book=book)
+        if total is None:
+            total = book.inventory + sum(shard.inventory for shard in shards)
+        shards.delete()
+
+        if shard_count:
+            share, remainder = divmod(total, shard_count)
+            BookInventoryShard.objects.bulk_create(
+                BookInventoryShard(
+                    book=book,
+                    index=index,
+                    inventory=share + (1 if index < remainder else 0),
+                )
+                for index in range(shard_count)
+            )
+            total = 0
+
+        Book.objects.filter(id=book.id).update(inventory=total, shard_count=shard_count)
+        self.inventory = total
+        self.shard_count = shard_count
+        self.sharded_inventory = None
+
     class Meta:
         verbose_name_plural = "books"
         ordering = ["author", "title"]
         unique_together = ("title", "author", "cover")
+        constraints = [
+            models.CheckConstraint(
+                condition=Q(inventory__gte=0),
+                name="book inventory must not be negative",
+            ),
+        ]
+        indexes = [
+            models.Index(
+                fields=["author", "title", "id"], name="book_author_title_id_idx"
+            ),
+            GinIndex(fields=["search_vector"], name="book_search_vector_idx"),
+            GinIndex(
+                fields=["author"],
+                name="book_author_trgm_idx",
+                opclasses=["gin_trgm_ops"],
+            ),
+        ]
+
+
+class BookInventoryShard(models.Model):
+    book = models.ForeignKey(
+        Book, on_delete=models.CASCADE, related_name="inventory_shards"
+    )
+    index = models.PositiveSmallIntegerField()
+    inventory = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.book} #{self.index}: {self.inventory}"
+
+    class Meta:
+        verbose_name_plural = "book inventory shards"
+        unique_together = ("book", "index")
+        constraints = [
+            models.CheckConstraint(
+                condition=Q(inventory__gte=0),
+                name="book inventory shard must not be negative",
+            ),
+        ]
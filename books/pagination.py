@@ -0,0 +1,10 @@
+from helpers.pagination import KeysetPagination
+
+
+class BookCursorPagination(KeysetPagination):
+    ordering = ("author", "title", "id")
+
+    def get_ordering(self, request, queryset, view):
+        if "rank" in queryset.query.annotations:
+            return ("-rank", "id")
+        return super().get_ordering(request, queryset, view)
@@ -4,6 +4,7 @@ from books.models import Book
 
 
 class BookSerializer(serializers.ModelSerializer):
+    inventory = serializers.IntegerField(source="available_inventory", min_value=0)
 
     class Meta:
         model = Book
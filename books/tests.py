@@ -1,3 +1,321 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from redis.exceptions import RedisError
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from books.cache import (
+    book_detail_key,
+    catalog_cache_stats,
+    get_or_compute,
+    invalidate_catalog,
+)
+from books.models import Book
+
+BOOK_LIST_URL = reverse("books:book-list")
+LOCMEM_CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "catalog": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "catalog",
+    },
+}
+
+
+def sample_book(**params) -> Book:
+    defaults = {
+        "title": "Test Title",
+        "author": "Test Author",
+        "cover": "H",
+        "inventory": 10,
+        "daily_fee": 1,
+    }
+    defaults.update(params)
+    return Book.objects.create(**defaults)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BookPaginationTests(TestCase):
+
+    def setUp(self) -> None:
+        caches["catalog"].clear()
+        self.client = APIClient()
+        for author in ("Author B", "Author A"):
+            for number in range(3):
+                sample_book(title=f"Title {number}", author=author)
+                sample_book(title=f"Title {number}", author=author, cover="S")
+
+    def test_list_is_paginated(self):
+        res = self.client.get(BOOK_LIST_URL, {"page_size": 4})
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(res.data["results"]), 4)
+        self.assertIsNotNone(res.data["next"])
+        self.assertIsNone(res.data["previous"])
+
+    def test_next_links_walk_catalog_in_order(self):
+        expected_ids = list(
+            Book.objects.order_by("author", "title", "id").values_list("id", flat=True)
+        )
+
+        seen_ids = []
+        url = f"{BOOK_LIST_URL}?page_size=5"
+        while url:
+            res = self.client.get(url)
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            seen_ids.extend(book["id"] for book in res.data["results"])
+            url = res.data["next"]
+
+        self.assertEqual(seen_ids, expected_ids)
+
+    def test_previous_link_returns_previous_page(self):
+        first_page = self.client.get(BOOK_LIST_URL, {"page_size": 5})
+        second_page = self.client.get(first_page.data["next"])
+        previous_page = self.client.get(second_page.data["previous"])
+
+        self.assertEqual(previous_page.data["results"], first_page.data["results"])
+
+    def test_cursor_is_stable_under_concurrent_inserts(self):
+        first_page = self.client.get(BOOK_LIST_URL, {"page_size": 5})
+        sample_book(title="Title 0", author="Author 0")
+
+        second_page = self.client.get(first_page.data["next"])
+        first_ids = {book["id"] for book in first_page.data["results"]}
+        second_ids = {book["id"] for book in second_page.data["results"]}
+
+        self.assertFalse(first_ids & second_ids)
+
+    def test_invalid_cursor(self):
+        res = self.client.get(BOOK_LIST_URL, {"cursor": "not-a-cursor"})
+
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BookSearchTests(TestCase):
+
+    def setUp(self) -> None:
+        caches["catalog"].clear()
+        self.client = APIClient()
+        self.war_and_peace = sample_book(title="War and Peace", author="Leo Tolstoy")
+        self.anna = sample_book(title="Anna Karenina", author="Leo Tolstoy")
+        self.idiot = sample_book(title="The Idiot", author="Fyodor Dostoevsky")
+
+    def search(self, text):
+        res = self.client.get(BOOK_LIST_URL, {"search": text})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        return [book["id"] for book in res.data["results"]]
+
+    def test_search_by_title_word_prefix(self):
+        self.assertEqual(self.search("karen"), [self.anna.id])
+
+    def test_search_by_author(self):
+        ids = self.search("tolstoy")
+
+        self.assertCountEqual(ids, [self.war_and_peace.id, self.anna.id])
+
+    def test_search_tolerates_author_typo(self):
+        self.assertEqual(self.search("Dostoyevsky"), [self.idiot.id])
+
+    def test_search_is_ranked_by_relevance(self):
+        ids = self.search("peace")
+
+        self.assertEqual(ids[0], self.war_and_peace.id)
+
+    def test_search_vector_follows_title_update(self):
+        self.anna.title = "Resurrection"
+        self.anna.save()
+
+        self.assertEqual(self.search("resurrect"), [self.anna.id])
+
+    def test_search_results_are_paginated(self):
+        first_page = self.client.get(
+            BOOK_LIST_URL, {"search": "leo tolstoy", "page_size": 1}
+        )
+        second_page = self.client.get(first_page.data["next"])
+
+        ids = [
+            first_page.data["results"][0]["id"],
+            second_page.data["results"][0]["id"],
+        ]
+        self.assertCountEqual(ids, [self.war_and_peace.id, self.anna.id])
+        self.assertIsNone(second_page.data["next"])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BookCacheTests(TestCase):
+
+    def setUp(self) -> None:
+        caches["catalog"].clear()
+        self.client = APIClient()
+        self.admin_user = get_user_model().objects.create_superuser(
+            email="admin@test.com",
+            password="admin_password",
+        )
+        self.book = sample_book()
+
+    def test_list_is_served_from_cache(self):
+        self.client.get(BOOK_LIST_URL)
+
+        with self.assertNumQueries(0):
+            res = self.client.get(BOOK_LIST_URL)
+
+        self.assertEqual(res.data["results"][0]["id"], self.book.id)
+        self.assertEqual(catalog_cache_stats()["hits"], 1)
+        self.assertEqual(catalog_cache_stats()["misses"], 1)
+
+    def test_create_invalidates_list(self):
+        self.client.get(BOOK_LIST_URL)
+
+        self.client.force_authenticate(self.admin_user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                BOOK_LIST_URL,
+                {
+                    "title": "Another Title",
+                    "author": "Another Author",
+                    "cover": "S",
+                    "inventory": 3,
+                    "daily_fee": 1,
+                },
+            )
+        res = self.client.get(BOOK_LIST_URL)
+
+        self.assertEqual(len(res.data["results"]), 2)
+
+    def test_update_invalidates_detail(self):
+        self.client.force_authenticate(self.admin_user)
+        detail_url = reverse("books:book-detail", args=[self.book.id])
+        self.client.get(detail_url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(detail_url, {"inventory": 7})
+        res = self.client.get(detail_url)
+
+        self.assertEqual(res.data["inventory"], 7)
+
+    def test_zero_padded_pk_shares_the_detail_entry(self):
+        self.client.force_authenticate(self.admin_user)
+        alias_url = reverse("books:book-detail", args=[f"0{self.book.id}"])
+        self.client.get(alias_url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(
+                reverse("books:book-detail", args=[self.book.id]), {"inventory": 7}
+            )
+        res = self.client.get(alias_url)
+
+        self.assertEqual(res.data["inventory"], 7)
+
+    def test_detail_computed_before_a_change_is_not_served(self):
+        self.client.force_authenticate(self.admin_user)
+        detail_url = reverse("books:book-detail", args=[self.book.id])
+
+        def compute_then_change():
+            data = {"id": self.book.id, "inventory": self.book.inventory}
+            Book.objects.filter(id=self.book.id).update(inventory=3)
+            with self.captureOnCommitCallbacks(execute=True):
+                invalidate_catalog(self.book.id)
+            return data
+
+        get_or_compute(lambda: book_detail_key(self.book.id), compute_then_change)
+        res = self.client.get(detail_url)
+
+        self.assertEqual(res.data["inventory"], 3)
+
+    def test_value_is_computed_once_when_storing_fails(self):
+        compute = mock.Mock(return_value={"id": self.book.id})
+
+        with mock.patch.object(caches["catalog"], "set", side_effect=RedisError):
+            data = get_or_compute(lambda: book_detail_key(self.book.id), compute)
+
+        self.assertEqual(data, {"id": self.book.id})
+        compute.assert_called_once()
+
+
+class BookInventoryTests(TestCase):
+
+    def test_reserve_takes_one_copy(self):
+        book = sample_book(inventory=2)
+
+        self.assertTrue(Book.objects.reserve(book))
+        book.refresh_from_db()
+        self.assertEqual(book.inventory, 1)
+
+    def test_reserve_never_oversells(self):
+        book = sample_book(inventory=1)
+
+        self.assertTrue(Book.objects.reserve(book))
+        self.assertFalse(Book.objects.reserve(book))
+        book.refresh_from_db()
+        self.assertEqual(book.inventory, 0)
+
+    def test_release_returns_copies(self):
+        book = sample_book(inventory=0)
+
+        Book.objects.release(book, quantity=2)
+        book.refresh_from_db()
+        self.assertEqual(book.inventory, 2)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BookShardedInventoryTests(TestCase):
+
+    def setUp(self) -> None:
+        caches["catalog"].clear()
+        self.client = APIClient()
+        self.book = sample_book(inventory=10)
+        self.book.set_shard_count(4)
+
+    def test_stock_is_spread_over_shards(self):
+        shards = list(self.book.inventory_shards.values_list("inventory", flat=True))
+
+        self.assertCountEqual(shards, [3, 3, 2, 2])
+        self.assertEqual(self.book.available_inventory, 10)
+
+    def test_reserve_until_exhausted(self):
+        for _ in range(10):
+            self.assertTrue(Book.objects.reserve(self.book))
+
+        self.assertFalse(Book.objects.reserve(self.book))
+        self.assertEqual(Book.objects.get(id=self.book.id).available_inventory, 0)
+
+    def test_release_goes_to_a_shard(self):
+        Book.objects.release(self.book, quantity=2)
+
+        self.assertEqual(Book.objects.get(id=self.book.id).inventory, 0)
+        self.assertEqual(Book.objects.get(id=self.book.id).available_inventory, 12)
+
+    def test_serializer_shows_sharded_total(self):
+        Book.objects.reserve(self.book)
+
+        res = self.client.get(BOOK_LIST_URL)
+
+        self.assertEqual(res.data["results"][0]["inventory"], 9)
+
+    def test_admin_update_redistributes_shards(self):
+        admin_user = get_user_model().objects.create_superuser(
+            email="admin@test.com",
+            password="admin_password",
+        )
+        self.client.force_authenticate(admin_user)
+        detail_url = reverse("books:book-detail", args=[self.book.id])
+
+        res = self.client.patch(detail_url, {"inventory": 6})
+
+        self.assertEqual(res.data["inventory"], 6)
+        self.assertEqual(
+            sum(self.book.inventory_shards.values_list("inventory", flat=True)), 6
+        )
+
+    def test_unshard_folds_stock_back(self):
+        Book.objects.reserve(self.book)
+
+        self.book.set_shard_count(0)
+
+        self.assertEqual(self.book.inventory, 9)
+        self.assertFalse(self.book.inventory_shards.exists())
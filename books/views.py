@@ -1,7 +1,16 @@
+from drf_spectacular.utils import extend_schema, OpenApiParameter
 from rest_framework import viewsets
 from rest_framework.permissions import IsAdminUser, AllowAny
+from rest_framework.response import Response
 
+from books.cache import (
+    book_detail_key,
+    catalog_page_key,
+    get_or_compute,
+    invalidate_catalog,
+)
 from books.models import Book
+from books.pagination import BookCursorPagination
 from books.serializers import BookSerializer
 
 
@@ -9,8 +18,59 @@ class BookViewSet(viewsets.ModelViewSet):
     queryset = Book.objects.all()
     serializer_class = BookSerializer
     permission_classes = [IsAdminUser]
+    pagination_class = BookCursorPagination
+
+    def get_queryset(self):
+        queryset = super().get_queryset().with_available_inventory()
+
+        search = self.request.query_params.get("search", "").strip()
+        if self.action == "list" and search:
+            queryset = queryset.search(search)
+
+        return queryset
 
     def get_permissions(self):
         if self.action == "list":
             return (AllowAny(),)
         return super().get_permissions()
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter(
+                "search",
+                type=str,
+                description="Search books by title and author words (prefixes "
+                "match, author tolerates typos), results are ordered by "
+                "relevance ex. ?search=tolst",
+            ),
+        ]
+    )
+    def list(self, request, *args, **kwargs):
+        """Get list of books."""
+        data = get_or_compute(
+            lambda: catalog_page_key(request.build_absolute_uri()),
+            lambda: super(BookViewSet, self).list(request, *args, **kwargs).data,
+        )
+        return Response(data)
+
+    def retrieve(self, request, *args, **kwargs):
+        if not str(kwargs["pk"]).isdigit():
+            return super().retrieve(request, *args, **kwargs)
+        data = get_or_compute(
+            lambda: book_detail_key(kwargs["pk"]),
+            lambda: super(BookViewSet, self).retrieve(request, *args, **kwargs).data,
+        )
+        return Response(data)
+
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        invalidate_catalog(serializer.instance.id)
+
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        invalidate_catalog(serializer.instance.id)
+
+    def perform_destroy(self, instance):
+        book_id = instance.id
+        super().perform_destroy(instance)
+        invalidate_catalog(book_id)
@@ -0,0 +1,50 @@
+# Generated by Django 5.1.1 on 2026-10-18 05:44
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("books", "0008_book_shard_count_bookinventoryshard"),
+        ("borrowings", "0009_alter_borrowing_borrow_date"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="borrowing",
+            index=models.Index(
+                fields=["borrow_date", "id"], name="borrowing_date_id_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="borrowing",
+            index=models.Index(
+                fields=["user", "actual_return_date"], name="borrowing_user_return_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="borrowing",
+            index=models.Index(
+                fields=["user", "borrow_date", "id"], name="borrowing_user_date_id_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="borrowing",
+            index=models.Index(
+                condition=models.Q(("actual_return_date__isnull", True)),
+                fields=["borrow_date", "id"],
+                name="borrowing_active_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="borrowing",
+            index=models.Index(
+                condition=models.Q(("actual_return_date__isnull", True)),
+                fields=["expected_return_date"],
+                name="borrowing_active_due_idx",
+            ),
+        ),
+    ]
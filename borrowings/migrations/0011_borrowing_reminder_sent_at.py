@@ -0,0 +1,32 @@
+# Generated by Django 5.1.1 on 2026-10-18 05:56
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("books", "0008_book_shard_count_bookinventoryshard"),
+        ("borrowings", "0010_borrowing_borrowing_date_id_idx_and_more"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="borrowing",
+            name="reminder_sent_at",
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="borrowing",
+            index=models.Index(
+                condition=models.Q(
+                    ("actual_return_date__isnull", True),
+                    ("reminder_sent_at__isnull", True),
+                ),
+                fields=["expected_return_date"],
+                name="borrowing_reminder_due_idx",
+            ),
+        ),
+    ]
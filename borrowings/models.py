@@ -10,6 +10,7 @@ class Borrowing(models.Model):
     borrow_date = models.DateField(auto_now_add=True)
     expected_return_date = models.DateField()
     actual_return_date = models.DateField(blank=True, null=True, default=None)
+    reminder_sent_at = models.DateTimeField(blank=True, null=True, default=None)
     book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name="borrowings")
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="borrowings")
 
@@ -26,3 +27,31 @@ class Borrowing(models.Model):
                 name="expected return date must be after the borrow date",
             ),
         ]
+        indexes = [
+            models.Index(fields=["borrow_date", "id"], name="borrowing_date_id_idx"),
+            models.Index(
+                fields=["user", "actual_return_date"],
+                name="borrowing_user_return_idx",
+            ),
+            models.Index(
+                fields=["user", "borrow_date", "id"],
+                name="borrowing_user_date_id_idx",
+            ),
+            models.Index(
+                fields=["borrow_date", "id"],
+                condition=Q(actual_return_date__isnull=True),
+                name="borrowing_active_idx",
+            ),
+            models.Index(
+                fields=["expected_return_date"],
+                condition=Q(actual_return_date__isnull=True),
+                name="borrowing_active_due_idx",
+            ),
+            models.Index(
+                fields=["expected_return_date"],
+                condition=Q(
+                    actual_return_date__isnull=True, reminder_sent_at__isnull=True
+                ),
+                name="borrowing_reminder_due_idx",
+            ),
+        ]
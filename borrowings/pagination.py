@@ -0,0 +1,5 @@
+from helpers.pagination import KeysetPagination
+
+
+class BorrowingCursorPagination(KeysetPagination):
+    ordering = ("borrow_date", "id")
@@ -2,9 +2,22 @@ from django.utils import timezone
 
 from rest_framework import serializers
 
+from books.models import Book
 from books.serializers import BookSerializer
 from borrowings.models import Borrowing
 
+BULK_RETURN_LIMIT = 200
+CHECKOUT_LIMIT = 10
+
+
+def validate_return_date(expected_return_date):
+    if expected_return_date <= timezone.now().date():
+        raise serializers.ValidationError(
+            "Expected return date must be after borrow date."
+        )
+
+    return expected_return_date
+
 
 class BorrowingListSerializer(serializers.ModelSerializer):
     book = BookSerializer(read_only=True)
@@ -12,6 +25,9 @@ class BorrowingListSerializer(serializers.ModelSerializer):
     payment = serializers.StringRelatedField(
         many=True, read_only=True, source="payments"
     )
+    # Cart checkout payments covering the borrowing, the first borrowing
+    # of a cart also lists the payment under ``payment``.
+    cart_payments = serializers.StringRelatedField(many=True, read_only=True)
 
     class Meta:
         model = Borrowing
@@ -22,6 +38,7 @@ class BorrowingListSerializer(serializers.ModelSerializer):
             "actual_return_date",
             "book",
             "payment",
+            "cart_payments",
             "user",
         )
 
@@ -46,6 +63,7 @@ class BorrowingCreateSerializer(serializers.ModelSerializer):
     payment = serializers.StringRelatedField(
         many=True, read_only=True, source="payments"
     )
+    payment_id = serializers.SerializerMethodField()
     url_payment = serializers.SerializerMethodField()
 
     class Meta:
@@ -57,26 +75,70 @@ class BorrowingCreateSerializer(serializers.ModelSerializer):
             "book",
             "user",
             "payment",
+            "payment_id",
             "url_payment",
         )
 
     def validate_book(self, value):
-        if value.inventory == 0:
+        if value.available_inventory == 0:
             raise serializers.ValidationError(
                 "This book is not available for borrowing as inventory is 0."
             )
         return value
 
-    def get_url_payment(self, obj):
+    def get_payment_id(self, obj):
         payment = self.context.get("payment")
         if payment:
+            return payment.id
+        return None
+
+    def get_url_payment(self, obj):
+        """Empty until the Stripe session is created in the background."""
+        payment = self.context.get("payment")
+        if payment and payment.session_url:
             return payment.session_url
         return None
 
     def validate_expected_return_date(self, expected_return_date):
-        if expected_return_date <= timezone.now().date():
+        return validate_return_date(expected_return_date)
+
+
+class BorrowingBulkReturnSerializer(serializers.Serializer):
+    ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=BULK_RETURN_LIMIT,
+    )
+
+
+class BorrowingCheckoutSerializer(serializers.Serializer):
+    books = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=CHECKOUT_LIMIT,
+    )
+    expected_return_date = serializers.DateField()
+
+    def validate_books(self, book_ids):
+        if len(set(book_ids)) != len(book_ids):
+            raise serializers.ValidationError("Each book can be borrowed only once.")
+
+        books = Book.objects.with_available_inventory().in_bulk(book_ids)
+        missing = [book_id for book_id in book_ids if book_id not in books]
+        if missing:
+            raise serializers.ValidationError(f"Books {missing} do not exist.")
+
+        unavailable = [
+            books[book_id].title
+            for book_id in book_ids
+            if books[book_id].available_inventory == 0
+        ]
+        if unavailable:
             raise serializers.ValidationError(
-                "Expected return date must be after borrow date."
+                f"Books {unavailable} are not available for borrowing "
+                f"as inventory is 0."
             )
+        return [books[book_id] for book_id in book_ids]
 
-        return expected_return_date
+    def validate_expected_return_date(self, expected_return_date):
+        return validate_return_date(expected_return_date)
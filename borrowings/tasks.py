@@ -1,53 +1,451 @@
-from datetime import timedelta
+import logging
+import time
+from datetime import datetime, time as day_time, timedelta
+from itertools import count, islice
 
-from celery import shared_task
+from celery import chain, group, shared_task
+from django.conf import settings
+from django.db import transaction
 from django.db.models import Q
-
 from django.utils import timezone
 
 from borrowings.models import Borrowing
-from helpers.stripe_helper import stripe_expired_check
-from helpers.telegram_helper import TelegramHelper
-from payment.models import Payment
+from helpers.stripe_helper import (
+    PaymentGatewayUnavailable,
+    open_payment_session,
+    stripe_expired_check_bulk,
+)
+from helpers.telegram_helper import (
+    TelegramHelper,
+    claim_delivery_kick,
+    drain_queue,
+    pack_messages,
+)
+from payment.models import OutboxMessage, Payment, StripeEvent, previous_statuses
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_MAX_ATTEMPTS = 10
+STRIPE_EVENTS_BATCH_SIZE = 500
+TELEGRAM_DRAIN_SECONDS = 50
+
+NOTIFICATION_CHUNK_SIZE = 2000
+NOTIFICATION_BATCH_SIZE = 20
+NOTIFICATION_LANES = 4
+REMINDER_TIME = day_time(9, 0)
+# Reminders further ahead are not queued with an ETA when the book is
+# borrowed, the daily reconciliation run queues them once they are this
+# close. Must stay below the broker's visibility_timeout, see settings.
+REMINDER_ETA_HORIZON = timedelta(days=2)
+
+
+def reminder_line(borrowing: Borrowing) -> str:
+    return (
+        f"Dear {borrowing.user.email} your day for return book '{borrowing.book.title}' "
+        f"is {borrowing.expected_return_date}.\n"
+        f"Please make it ontime!"
+    )
+
+
+def deliver_reminders(messages) -> int:
+    """
+    Queue packed ``(borrowing_ids, message)`` pairs for Telegram. The
+    borrowings of a message that could not be queued, or that Telegram
+    later refuses (see unclaim_dropped_reminders), get their reminder
+    unclaimed, so the next reconciliation run picks them up.
+    """
+    telegram_helper = TelegramHelper()
+    queued, failed_ids = 0, []
+    for borrowing_ids, message in messages:
+        if telegram_helper.enqueue_message(
+            message,
+            dedupe_key=f"reminder:{','.join(map(str, sorted(borrowing_ids)))}",
+            borrowing_ids=borrowing_ids,
+        ):
+            queued += 1
+        else:
+            failed_ids.extend(borrowing_ids)
+    if failed_ids:
+        Borrowing.objects.filter(id__in=failed_ids).update(reminder_sent_at=None)
+    if queued:
+        schedule_telegram_delivery()
+    return len(messages)
+
+
+def unclaim_dropped_reminders(item: dict) -> None:
+    if item.get("borrowing_ids"):
+        Borrowing.objects.filter(id__in=item["borrowing_ids"]).update(
+            reminder_sent_at=None
+        )
+
+
+def claim_reminders(queryset):
+    """
+    Mark the reminders of ``queryset`` as sent with one conditional UPDATE
+    and return the claimed borrowings. Returned borrowings and reminders
+    already claimed by another task are skipped.
+    """
+    claimed_at = timezone.now()
+    claimed = queryset.filter(
+        actual_return_date__isnull=True, reminder_sent_at__isnull=True
+    ).update(reminder_sent_at=claimed_at)
+    return claimed, (
+        queryset.filter(actual_return_date__isnull=True, reminder_sent_at=claimed_at)
+        .select_related("user", "book")
+        .only("id", "expected_return_date", "user__email", "book__title")
+        .order_by("id")
+    )
 
 
 @shared_task
-def borrowing_notification() -> None:
+def send_notification_batch(messages: list) -> int:
+    """Queue a batch of packed notification messages."""
+    started = time.monotonic()
+    sent = deliver_reminders(messages)
+    logger.info(
+        "Queued %s notification messages in %.2fs",
+        sent,
+        time.monotonic() - started,
+    )
+    return sent
+
+
+@shared_task
+def send_due_reminder(borrowing_ids: list) -> int:
     """
-    The function filters all borrowings, which are overdue
-    (expected_return_date is tomorrow or less, and the book
-    is still not returned) and send a notification to the
-    telegram chat about each overdue separately with
-    detailed information.
-    If no borrowings are overdue for that day -
-    send a “No borrowings overdue today!” notification.
+    Remind about borrowings due tomorrow; scheduled with an ETA when they
+    are created. Does nothing for borrowings returned in the meantime or
+    already reminded, which also makes a redelivered ETA message harmless.
     """
+    claimed, borrowings = claim_reminders(
+        Borrowing.objects.filter(id__in=borrowing_ids)
+    )
+    if not claimed:
+        return 0
+    return deliver_reminders(
+        list(pack_messages((b.id, reminder_line(b)) for b in borrowings))
+    )
+
+
+def schedule_due_reminder(borrowing_ids: list, expected_return_date) -> None:
+    """
+    Queue send_due_reminder for REMINDER_TIME the day before the
+    borrowings are due (right away if that moment has passed). Reminders
+    beyond REMINDER_ETA_HORIZON are left to the daily reconciliation
+    run, as are reminders that could not be queued.
+    """
+    eta = timezone.make_aware(
+        datetime.combine(expected_return_date - timedelta(days=1), REMINDER_TIME)
+    )
+    if eta - timezone.now() > REMINDER_ETA_HORIZON:
+        return
+    try:
+        send_due_reminder.apply_async((borrowing_ids,), eta=max(eta, timezone.now()))
+    except Exception:
+        logger.warning("Could not schedule due reminder", exc_info=True)
+
+
+@shared_task
+def borrowing_notification() -> dict:
+    """
+    Reconciliation of the due reminders: the function finds the
+    borrowings which are due tomorrow or earlier, still not returned
+    and without a sent reminder (the ETA task failed or was never
+    queued) and sends a notification to the telegram chat about them,
+    several of them per message. The ETA reminders of borrowings due the
+    day after tomorrow are queued here (see REMINDER_ETA_HORIZON).
+    If the subtasks cannot be dispatched the claimed reminders are
+    released for the next run.
+    The reminders are claimed with one UPDATE, the borrowings are
+    streamed from the database in chunks and the packed messages are
+    spread over NOTIFICATION_LANES chains of send_notification_batch
+    subtasks, so at most that many subtasks talk to Telegram at the
+    same time.
+    """
+    started = time.monotonic()
     tomorrow = timezone.now().date() + timedelta(days=1)
-    queryset = Borrowing.objects.filter(
-        Q(expected_return_date__lte=tomorrow) & Q(actual_return_date__isnull=True)
-    )
-    if queryset.exists():
-        for borrowing in queryset:
-            telegram_helper = TelegramHelper()
-            message = (
-                f"Dear {borrowing.user.email} your day for return book '{borrowing.book.title}' "
-                f"is {borrowing.expected_return_date}.\n"
-                f"Please make it ontime!"
+    claimed, borrowings = claim_reminders(
+        Borrowing.objects.filter(expected_return_date__lte=tomorrow)
+    )
+    entries = (
+        (borrowing.id, reminder_line(borrowing))
+        for borrowing in borrowings.iterator(chunk_size=NOTIFICATION_CHUNK_SIZE)
+    )
+
+    lanes = [[] for _ in range(NOTIFICATION_LANES)]
+    messages = pack_messages(entries)
+    messages_count = 0
+    claimed_ids = []
+    for number in count():
+        batch = list(islice(messages, NOTIFICATION_BATCH_SIZE))
+        if not batch:
+            break
+        messages_count += len(batch)
+        claimed_ids.extend(id for ids, _ in batch for id in ids)
+        lanes[number % NOTIFICATION_LANES].append(send_notification_batch.si(batch))
+    collected = time.monotonic()
+
+    if messages_count:
+        try:
+            group(chain(*lane) for lane in lanes if lane).apply_async()
+        except Exception:
+            Borrowing.objects.filter(id__in=claimed_ids).update(reminder_sent_at=None)
+            logger.warning("Could not dispatch due reminders", exc_info=True)
+            raise
+    dispatched = time.monotonic()
+
+    schedule_upcoming_reminders(tomorrow + timedelta(days=1))
+
+    stats = {
+        "borrowings": claimed,
+        "messages": messages_count,
+        "subtasks": sum(len(lane) for lane in lanes),
+        "collect_seconds": round(collected - started, 3),
+        "dispatch_seconds": round(dispatched - collected, 3),
+    }
+    logger.info("Due reminders reconciliation: %s", stats)
+    return stats
+
+
+def schedule_upcoming_reminders(expected_return_date) -> None:
+    """Queue the ETA reminders of the borrowings due on the date."""
+    borrowing_ids = (
+        Borrowing.objects.filter(
+            expected_return_date=expected_return_date,
+            actual_return_date__isnull=True,
+            reminder_sent_at__isnull=True,
+        )
+        .values_list("id", flat=True)
+        .iterator(chunk_size=NOTIFICATION_CHUNK_SIZE)
+    )
+    while chunk := list(islice(borrowing_ids, NOTIFICATION_CHUNK_SIZE)):
+        schedule_due_reminder(chunk, expected_return_date)
+
+
+@shared_task
+def track_expired_stripe_sessions() -> dict:
+    """
+    The function is marking expired Stripe Sessions: Payments whose session
+    deadline (expires_at) has passed are marked as EXPIRED in bulk.
+    Stripe is asked only about pending Payments with an unknown deadline,
+    in parallel and within its rate limit.
+    PENDING and EXPIRED both count as unpaid, so UserPaymentSummary
+    does not change.
+    """
+    expired = Payment.objects.filter(expires_at__lte=timezone.now()).set_status("E")
+
+    checked = stripe_expired_check_bulk(Payment.objects.filter(expires_at__isnull=True))
+
+    stats = {
+        "expired": expired + checked["expired"],
+        "checked_with_stripe": checked["checked"],
+        "failed": checked["failed"],
+    }
+    logger.info("Expired Stripe sessions: %s", stats)
+    return stats
+
+
+def handle_outbox_message(message: OutboxMessage) -> None:
+    payload = message.payload
+
+    if message.kind == "S":
+        payment = Payment.objects.get(id=payload["payment_id"])
+        if payment.status == "S":
+            payment = open_payment_session(
+                payment,
+                payload["amount"],
+                payload["quantity"],
+                payload["redirect_urls"],
+                payload.get("line_items"),
+            )
+        if payload.get("notification"):
+            queue_notification(
+                f"{payload['notification']}\n"
+                f"Your link for payment: {payment.session_url}",
+                dedupe_key=f"outbox:{message.id}",
             )
-            telegram_helper.send_message(message)
-    else:
-        telegram_helper = TelegramHelper()
-        message = f"“No borrowings overdue today!”"
-        telegram_helper.send_message(message)
+
+    elif message.kind == "N":
+        queue_notification(payload["message"], dedupe_key=f"outbox:{message.id}")
+
+
+def queue_notification(message: str, dedupe_key: str = None) -> None:
+    """
+    Queue a Telegram message, ``dedupe_key`` names its source so a
+    redelivered outbox row is sent once. Raises when the queue is down.
+    """
+    if not TelegramHelper().enqueue_message(message, dedupe_key=dedupe_key):
+        raise RuntimeError("Telegram queue is unavailable.")
+    schedule_telegram_delivery()
 
 
 @shared_task
-def track_expired_stripe_sessions() -> None:
+def process_outbox() -> int:
     """
-    The function is checking Stripe Session for expiration
-    If the session is expired - Payment should be also marked as EXPIRED (new status)
+    Carry out a batch of pending outbox messages. Rows are claimed with
+    SKIP LOCKED, so several workers can drain the outbox side by side.
+    A failed message is retried on a later run, up to OUTBOX_MAX_ATTEMPTS;
+    while the payment gateway breaker is open messages wait without
+    spending attempts.
     """
-    queryset = Payment.objects.filter(status__exact="G")
-    if queryset.exists():
-        for payment in queryset:
-            stripe_expired_check(payment)
+    with transaction.atomic():
+        messages = list(
+            OutboxMessage.objects.select_for_update(skip_locked=True).filter(
+                processed_at__isnull=True, attempts__lt=OUTBOX_MAX_ATTEMPTS
+            )[:OUTBOX_BATCH_SIZE]
+        )
+        paused = 0
+        for message in messages:
+            try:
+                with transaction.atomic():
+                    handle_outbox_message(message)
+                message.processed_at = timezone.now()
+            except PaymentGatewayUnavailable:
+                # The breaker is open, the message waits for a later run
+                # without spending an attempt.
+                paused += 1
+                continue
+            except Exception as e:
+                logger.exception("Outbox message %s failed", message.id)
+                message.attempts += 1
+                message.last_error = str(e)
+            message.save(update_fields=["processed_at", "attempts", "last_error"])
+
+    if paused:
+        logger.warning("Payment gateway unavailable, %s outbox messages wait", paused)
+    elif len(messages) == OUTBOX_BATCH_SIZE:
+        schedule_outbox_processing()
+
+    return len(messages)
+
+
+def schedule_outbox_processing() -> None:
+    """
+    Kick process_outbox right away. If the broker is unreachable the
+    messages wait for the periodic run.
+    """
+    try:
+        process_outbox.delay()
+    except Exception:
+        logger.warning("Could not schedule outbox processing", exc_info=True)
+
+
+@shared_task
+def deliver_telegram_messages() -> dict:
+    """
+    Send queued Telegram messages for up to TELEGRAM_DRAIN_SECONDS. Runs
+    are kicked when messages are queued; schedule it every minute as a
+    safety net. A run that hits a retryable error reschedules itself
+    after the backoff Telegram asked for.
+    """
+    stats = drain_queue(TELEGRAM_DRAIN_SECONDS, on_drop=unclaim_dropped_reminders)
+    if stats["retry_in"] is not None:
+        schedule_telegram_delivery(countdown=stats["retry_in"])
+    elif stats["remaining"] and not stats.get("skipped"):
+        schedule_telegram_delivery(countdown=0)
+
+    logger.info("Telegram delivery: %s", stats)
+    return stats
+
+
+def schedule_telegram_delivery(countdown: float = None) -> None:
+    """
+    Kick deliver_telegram_messages. Without ``countdown`` the run starts
+    after TELEGRAM_COALESCE_SECONDS and is scheduled once for a burst of
+    messages, which are then sent as digests. If the broker is
+    unreachable the messages wait in the queue for the periodic run.
+    """
+    if countdown is None:
+        countdown = settings.TELEGRAM_COALESCE_SECONDS
+        if not claim_delivery_kick(countdown):
+            return
+    try:
+        deliver_telegram_messages.apply_async(countdown=countdown)
+    except Exception:
+        logger.warning("Could not schedule Telegram delivery", exc_info=True)
+
+
+@shared_task
+def process_stripe_events() -> dict:
+    """
+    Apply a batch of received Stripe webhook events: paid checkout
+    sessions mark their Payments as PAID, also when they expired locally
+    or were renewed since, and expired ones mark PENDING Payments as
+    EXPIRED, one UPDATE each. Events are claimed with SKIP
+    LOCKED; the paid notifications go through the outbox.
+    """
+    with transaction.atomic():
+        events = list(
+            StripeEvent.objects.select_for_update(skip_locked=True).filter(
+                processed_at__isnull=True
+            )[:STRIPE_EVENTS_BATCH_SIZE]
+        )
+        paid_sessions = [
+            event.session_id
+            for event in events
+            if event.type == "checkout.session.completed"
+            and event.payload.get("payment_status") == "paid"
+        ]
+        expired_sessions = [
+            event.session_id
+            for event in events
+            if event.type == "checkout.session.expired"
+        ]
+
+        # A renewed payment is still settled by its earlier sessions.
+        paying = Payment.objects.filter(
+            Q(session_id__in=paid_sessions)
+            | Q(previous_session_ids__overlap=paid_sessions)
+        )
+        if paid_sessions:
+            log_unmatched_sessions(paid_sessions, paying)
+        paid_payments = paying.filter(status__in=previous_statuses("D"))
+        paid_money = list(
+            paid_payments.select_for_update().values_list("money", flat=True)
+        )
+        paid = paid_payments.set_status("D")
+        expired = Payment.objects.filter(session_id__in=expired_sessions).set_status(
+            "E"
+        )
+
+        if paid_money:
+            OutboxMessage.objects.bulk_create(
+                OutboxMessage(
+                    kind="N", payload={"message": f"Successful payment {money} USD."}
+                )
+                for money in paid_money
+            )
+            transaction.on_commit(schedule_outbox_processing)
+
+        StripeEvent.objects.filter(id__in=[event.id for event in events]).update(
+            processed_at=timezone.now()
+        )
+
+    if len(events) == STRIPE_EVENTS_BATCH_SIZE:
+        schedule_stripe_event_processing()
+
+    return {"events": len(events), "paid": paid, "expired": expired}
+
+
+def log_unmatched_sessions(paid_sessions, payments) -> None:
+    """Paid sessions no payment knows of are left for reconciliation."""
+    known = set()
+    for session_id, previous in payments.values_list(
+        "session_id", "previous_session_ids"
+    ):
+        known.update([session_id, *previous])
+    for session_id in set(paid_sessions) - known:
+        logger.error(
+            "Stripe session %s was paid but matches no payment, "
+            "reconcile it manually",
+            session_id,
+        )
+
+
+def schedule_stripe_event_processing() -> None:
+    """Kick process_stripe_events, the periodic run catches up otherwise."""
+    try:
+        process_stripe_events.delay()
+    except Exception:
+        logger.warning("Could not schedule Stripe event processing", exc_info=True)
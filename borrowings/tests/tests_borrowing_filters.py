@@ -0,0 +1,102 @@
+import datetime
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from books.models import Book
+from borrowings.models import Borrowing
+
+BORROWING_LIST_URL = reverse("borrowings:borrowing-list")
+TODAY = datetime.date.today()
+
+
+def sample_borrowing(user, book, borrow_days_ago=0, due_in_days=3, returned=False):
+    borrowing = Borrowing.objects.create(
+        expected_return_date=TODAY + datetime.timedelta(days=3),
+        book=book,
+        user=user,
+    )
+    borrow_date = TODAY - datetime.timedelta(days=borrow_days_ago)
+    Borrowing.objects.filter(id=borrowing.id).update(
+        borrow_date=borrow_date,
+        expected_return_date=TODAY + datetime.timedelta(days=due_in_days),
+        actual_return_date=TODAY if returned else None,
+    )
+    return borrowing
+
+
+class BorrowingFilterTests(TestCase):
+
+    def setUp(self) -> None:
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            email="test@test.com", password="test_password"
+        )
+        self.client.force_authenticate(self.user)
+        self.book = Book.objects.create(
+            title="Test Title", author="Test Author", inventory=10, daily_fee=1
+        )
+        self.other_book = Book.objects.create(
+            title="Other Title", author="Test Author", inventory=10, daily_fee=1
+        )
+
+    def list_ids(self, **params):
+        res = self.client.get(BORROWING_LIST_URL, params)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        return [borrowing["id"] for borrowing in res.data["results"]]
+
+    def test_filter_by_book(self):
+        borrowing = sample_borrowing(self.user, self.book)
+        sample_borrowing(self.user, self.other_book)
+
+        self.assertEqual(self.list_ids(book_id=self.book.id), [borrowing.id])
+
+    def test_filter_overdue(self):
+        overdue = sample_borrowing(
+            self.user, self.book, borrow_days_ago=5, due_in_days=-1
+        )
+        sample_borrowing(self.user, self.book, borrow_days_ago=5, due_in_days=1)
+        sample_borrowing(
+            self.user, self.book, borrow_days_ago=5, due_in_days=-1, returned=True
+        )
+
+        self.assertEqual(self.list_ids(overdue="1"), [overdue.id])
+        self.assertNotIn(overdue.id, self.list_ids(overdue="0"))
+
+    def test_filter_borrow_date_range(self):
+        sample_borrowing(self.user, self.book, borrow_days_ago=10)
+        in_range = sample_borrowing(self.user, self.book, borrow_days_ago=5)
+        sample_borrowing(self.user, self.book, borrow_days_ago=1)
+
+        ids = self.list_ids(
+            borrow_date_from=TODAY - datetime.timedelta(days=6),
+            borrow_date_to=TODAY - datetime.timedelta(days=2),
+        )
+
+        self.assertEqual(ids, [in_range.id])
+
+    def test_invalid_filter_values(self):
+        res = self.client.get(BORROWING_LIST_URL, {"borrow_date_from": "yesterday"})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+        res = self.client.get(BORROWING_LIST_URL, {"book_id": "first"})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_pagination_walks_borrow_date_order(self):
+        for days_ago in (3, 1, 2, 1, 3):
+            sample_borrowing(self.user, self.book, borrow_days_ago=days_ago)
+        expected_ids = list(
+            Borrowing.objects.order_by("borrow_date", "id").values_list("id", flat=True)
+        )
+
+        seen_ids = []
+        url = f"{BORROWING_LIST_URL}?page_size=2"
+        while url:
+            res = self.client.get(url)
+            seen_ids.extend(borrowing["id"] for borrowing in res.data["results"])
+            url = res.data["next"]
+
+        self.assertEqual(seen_ids, expected_ids)
@@ -0,0 +1,131 @@
+import datetime
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from books.models import Book
+from borrowings.models import Borrowing
+from payment.models import Payment
+
+BORROWING_LIST_URL = reverse("borrowings:borrowing-list")
+
+
+class BorrowingReadQueriesTests(TestCase):
+
+    def setUp(self) -> None:
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            email="test@test.com", password="test_password"
+        )
+        self.admin_user = get_user_model().objects.create_superuser(
+            email="admin@test.com",
+            password="admin_password",
+        )
+
+    def create_borrowings(self, count: int) -> None:
+        for number in range(count):
+            book = Book.objects.create(
+                title=f"Title {Book.objects.count()}",
+                author="Author",
+                inventory=5,
+                daily_fee=1,
+            )
+            if number % 2:
+                book.set_shard_count(2)
+            borrowing = Borrowing.objects.create(
+                expected_return_date=datetime.date.today() + datetime.timedelta(days=3),
+                book=book,
+                user=self.user,
+            )
+            Payment.objects.create(
+                borrowing=borrowing,
+                session_url="https://checkout.stripe.com/test",
+                session_id=f"cs_test_{borrowing.id}",
+                money=3,
+            )
+
+    def count_queries(self, url) -> int:
+        with CaptureQueriesContext(connection) as context:
+            res = self.client.get(url)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        return len(context.captured_queries)
+
+    def test_list_query_count_does_not_grow(self):
+        self.client.force_authenticate(self.user)
+
+        self.create_borrowings(2)
+        queries_for_few = self.count_queries(BORROWING_LIST_URL)
+        self.create_borrowings(10)
+        queries_for_many = self.count_queries(BORROWING_LIST_URL)
+
+        self.assertEqual(queries_for_few, queries_for_many)
+
+    def test_admin_list_query_count_does_not_grow(self):
+        self.client.force_authenticate(self.admin_user)
+
+        self.create_borrowings(2)
+        queries_for_few = self.count_queries(BORROWING_LIST_URL)
+        self.create_borrowings(10)
+        queries_for_many = self.count_queries(BORROWING_LIST_URL)
+
+        self.assertEqual(queries_for_few, queries_for_many)
+
+    def test_retrieve_query_count(self):
+        self.client.force_authenticate(self.user)
+        self.create_borrowings(2)
+        borrowing = Borrowing.objects.filter(book__shard_count__gt=0).first()
+
+        with self.assertNumQueries(4):
+            self.client.get(reverse("borrowings:borrowing-detail", args=[borrowing.id]))
+
+
+class BorrowingReturnQueriesTests(TestCase):
+
+    def setUp(self) -> None:
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            email="test@test.com", password="test_password"
+        )
+        self.client.force_authenticate(self.user)
+        self.book = Book.objects.create(
+            title="Title", author="Author", inventory=5, daily_fee=1
+        )
+        self.borrowing = Borrowing.objects.create(
+            expected_return_date=datetime.date.today() + datetime.timedelta(days=3),
+            book=self.book,
+            user=self.user,
+        )
+
+    def test_return_is_one_locked_fetch_and_two_updates(self):
+        with CaptureQueriesContext(connection) as context:
+            res = self.client.post(
+                reverse("borrowings:return", args=[self.borrowing.id])
+            )
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        statements = [
+            query["sql"]
+            for query in context.captured_queries
+            if "SAVEPOINT" not in query["sql"]
+        ]
+        self.assertLessEqual(len(statements), 3)
+        self.assertTrue(statements[0].startswith("SELECT"))
+        self.assertIn("FOR UPDATE OF", statements[0])
+        self.assertIn('"books_book"', statements[0])
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.inventory, 6)
+
+    def test_second_return_does_not_release_the_copy_again(self):
+        url = reverse("borrowings:return", args=[self.borrowing.id])
+        self.client.post(url)
+
+        res = self.client.post(url)
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.inventory, 6)
@@ -0,0 +1,121 @@
+import datetime
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from books.models import Book
+from borrowings.models import Borrowing
+from payment.models import OutboxMessage, Payment, UserPaymentSummary
+
+BULK_RETURN_URL = reverse("borrowings:bulk-return")
+TODAY = datetime.date.today()
+
+
+def sample_borrowing(user, book, borrow_days_ago=1, due_in_days=3):
+    borrowing = Borrowing.objects.create(
+        expected_return_date=TODAY + datetime.timedelta(days=3),
+        book=book,
+        user=user,
+    )
+    Borrowing.objects.filter(id=borrowing.id).update(
+        borrow_date=TODAY - datetime.timedelta(days=borrow_days_ago),
+        expected_return_date=TODAY + datetime.timedelta(days=due_in_days),
+    )
+    return borrowing
+
+
+class BorrowingBulkReturnTests(TestCase):
+
+    def setUp(self) -> None:
+        self.client = APIClient()
+        self.admin_user = get_user_model().objects.create_superuser(
+            email="admin@test.com", password="admin_password"
+        )
+        self.user = get_user_model().objects.create_user(
+            email="test@test.com", password="test_password"
+        )
+        self.client.force_authenticate(self.admin_user)
+        self.book = Book.objects.create(
+            title="Test Title", author="Test Author", inventory=5, daily_fee=1
+        )
+        self.other_book = Book.objects.create(
+            title="Other Title", author="Other Author", inventory=5, daily_fee=2
+        )
+
+    def test_returns_borrowings_and_restores_inventory(self):
+        borrowings = [
+            sample_borrowing(self.user, self.book),
+            sample_borrowing(self.user, self.book),
+            sample_borrowing(self.user, self.other_book),
+        ]
+
+        res = self.client.post(
+            BULK_RETURN_URL,
+            {"ids": [borrowing.id for borrowing in borrowings]},
+            format="json",
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [item["status"] for item in res.data["results"]], ["returned"] * 3
+        )
+        self.assertFalse(
+            Borrowing.objects.filter(actual_return_date__isnull=True).exists()
+        )
+        self.book.refresh_from_db()
+        self.other_book.refresh_from_db()
+        self.assertEqual(self.book.inventory, 7)
+        self.assertEqual(self.other_book.inventory, 6)
+        self.assertFalse(Payment.objects.exists())
+
+    def test_late_returns_get_pending_fines(self):
+        late = sample_borrowing(self.user, self.other_book, 10, due_in_days=-2)
+        on_time = sample_borrowing(self.user, self.book)
+
+        res = self.client.post(
+            BULK_RETURN_URL, {"ids": [late.id, on_time.id]}, format="json"
+        )
+
+        late_result, on_time_result = res.data["results"]
+        fine = Payment.objects.get(id=late_result["fine_payment_id"])
+        self.assertEqual((fine.type, fine.status), ("F", "S"))
+        self.assertEqual(fine.money, 8)
+        self.assertIsNone(on_time_result["fine_payment_id"])
+        self.assertEqual(OutboxMessage.objects.get().payload["payment_id"], fine.id)
+        self.assertEqual(UserPaymentSummary.objects.get(user=self.user).outstanding, 1)
+
+    def test_reports_missing_and_already_returned(self):
+        borrowing = sample_borrowing(self.user, self.book)
+        self.client.post(BULK_RETURN_URL, {"ids": [borrowing.id]}, format="json")
+
+        res = self.client.post(
+            BULK_RETURN_URL, {"ids": [borrowing.id, 999999]}, format="json"
+        )
+
+        self.assertEqual(
+            [item["status"] for item in res.data["results"]],
+            ["already_returned", "not_found"],
+        )
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.inventory, 6)
+
+    def test_statement_count_does_not_grow_with_the_stack(self):
+        borrowings = [sample_borrowing(self.user, self.book) for _ in range(20)]
+
+        with self.assertNumQueries(5):
+            self.client.post(
+                BULK_RETURN_URL,
+                {"ids": [borrowing.id for borrowing in borrowings]},
+                format="json",
+            )
+
+    def test_only_admin_can_bulk_return(self):
+        borrowing = sample_borrowing(self.user, self.book)
+        self.client.force_authenticate(self.user)
+
+        res = self.client.post(BULK_RETURN_URL, {"ids": [borrowing.id]}, format="json")
+
+        self.assertEqual(res.status_code, status.HTTP_403_FORBIDDEN)
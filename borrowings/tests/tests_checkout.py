@@ -0,0 +1,135 @@
+import datetime
+from types import SimpleNamespace
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from books.models import Book
+from borrowings.models import Borrowing
+from borrowings.tasks import process_outbox
+from payment.models import OutboxMessage, Payment
+
+CHECKOUT_URL = reverse("borrowings:checkout")
+EXPECTED_RETURN_DATE = datetime.date.today() + datetime.timedelta(days=2)
+
+
+class BorrowingCheckoutTests(TestCase):
+
+    def setUp(self) -> None:
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            email="test@test.com", password="test_password"
+        )
+        self.client.force_authenticate(self.user)
+        self.books = [
+            Book.objects.create(
+                title=f"Title {number}",
+                author="Test Author",
+                inventory=2,
+                daily_fee=number,
+            )
+            for number in range(1, 4)
+        ]
+
+    def checkout(self, book_ids):
+        return self.client.post(
+            CHECKOUT_URL,
+            {"books": book_ids, "expected_return_date": EXPECTED_RETURN_DATE},
+            format="json",
+        )
+
+    def test_checkout_borrows_every_book_with_one_payment(self):
+        res = self.checkout([book.id for book in self.books])
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(res.data["borrowings"]), 3)
+        payment = Payment.objects.get()
+        self.assertEqual(payment.id, res.data["payment_id"])
+        self.assertEqual(payment.money, 12)
+        self.assertCountEqual(
+            payment.borrowings.values_list("id", flat=True), res.data["borrowings"]
+        )
+        self.assertEqual(
+            list(Book.objects.order_by("id").values_list("inventory", flat=True)),
+            [1, 1, 1],
+        )
+        line_items = OutboxMessage.objects.get().payload["line_items"]
+        self.assertEqual([item["amount"] for item in line_items], [200, 400, 600])
+
+    def test_outbox_opens_one_session_and_sends_one_message(self):
+        self.checkout([book.id for book in self.books])
+        session = SimpleNamespace(id="cs_test", url="https://checkout.stripe.com/cs")
+
+        with mock.patch(
+            "helpers.stripe_helper.stripe.checkout.Session.create",
+            return_value=session,
+        ) as create, mock.patch("borrowings.tasks.TelegramHelper") as telegram:
+            process_outbox()
+
+        create.assert_called_once()
+        self.assertEqual(len(create.call_args.kwargs["line_items"]), 3)
+        telegram.return_value.enqueue_message.assert_called_once()
+        self.assertEqual(Payment.objects.get().status, "G")
+
+    def test_unavailable_book_rolls_back_the_whole_cart(self):
+        Book.objects.filter(id=self.books[2].id).update(inventory=0)
+
+        res = self.checkout([book.id for book in self.books])
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Borrowing.objects.exists())
+        self.assertEqual(
+            list(Book.objects.order_by("id").values_list("inventory", flat=True)),
+            [2, 2, 0],
+        )
+
+    def test_book_taken_during_checkout_rolls_back_the_whole_cart(self):
+        reserve = Book.objects.reserve
+        last_book = self.books[2]
+
+        def reserve_all_but_last(book):
+            return book.id != last_book.id and reserve(book)
+
+        with mock.patch.object(
+            Book.objects, "reserve", side_effect=reserve_all_but_last
+        ):
+            res = self.checkout([book.id for book in self.books])
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Borrowing.objects.exists())
+        self.assertFalse(Payment.objects.exists())
+        self.assertFalse(OutboxMessage.objects.exists())
+        self.assertEqual(
+            list(Book.objects.order_by("id").values_list("inventory", flat=True)),
+            [2, 2, 2],
+        )
+
+    def test_cart_payment_is_listed_with_every_borrowing(self):
+        res = self.checkout([book.id for book in self.books])
+        payment = Payment.objects.get()
+
+        payment_res = self.client.get(
+            reverse("payment:payment-detail", args=[payment.id])
+        )
+        borrowings_res = self.client.get(reverse("borrowings:borrowing-list"))
+
+        self.assertCountEqual(payment_res.data["borrowings"], res.data["borrowings"])
+        for borrowing in borrowings_res.data["results"]:
+            self.assertEqual(borrowing["cart_payments"], [str(payment)])
+
+    def test_duplicate_books_are_rejected(self):
+        res = self.checkout([self.books[0].id, self.books[0].id])
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_user_with_unpaid_payment_cannot_checkout(self):
+        self.checkout([self.books[0].id])
+
+        res = self.checkout([self.books[1].id])
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Borrowing.objects.count(), 1)
@@ -0,0 +1,160 @@
+import datetime
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from books.models import Book
+from borrowings.models import Borrowing
+from helpers.payment_gateway import InMemoryGateway
+from helpers.stripe_helper import create_pending_payment
+from payment.models import Payment
+
+BORROWING_URL = reverse("borrowings:borrowing-list")
+EXPECTED_RETURN_DATE = datetime.date.today() + datetime.timedelta(days=2)
+
+
+@override_settings(
+    PAYMENT_GATEWAY={"BACKEND": "helpers.payment_gateway.InMemoryGateway"}
+)
+class IdempotencyKeyTests(TestCase):
+
+    def setUp(self) -> None:
+        caches["idempotency"].clear()
+        InMemoryGateway.reset()
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            email="test@test.com", password="test_password"
+        )
+        self.client.force_authenticate(self.user)
+        self.book = Book.objects.create(
+            title="Test Title", author="Test Author", inventory=5, daily_fee=1
+        )
+
+    def borrow(self, key, book=None):
+        return self.client.post(
+            BORROWING_URL,
+            {
+                "book": (book or self.book).id,
+                "expected_return_date": EXPECTED_RETURN_DATE,
+                "user": self.user.id,
+            },
+            headers={"Idempotency-Key": key},
+        )
+
+    def late_borrowing(self):
+        borrowing = Borrowing.objects.create(
+            expected_return_date=EXPECTED_RETURN_DATE, book=self.book, user=self.user
+        )
+        Borrowing.objects.filter(id=borrowing.id).update(
+            borrow_date=datetime.date.today() - datetime.timedelta(days=10),
+            expected_return_date=datetime.date.today() - datetime.timedelta(days=3),
+        )
+        return borrowing
+
+    def test_retried_borrow_is_replayed(self):
+        first = self.borrow("borrow-1")
+        retry = self.borrow("borrow-1")
+
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(Borrowing.objects.count(), 1)
+        self.assertEqual(Payment.objects.count(), 1)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.inventory, 4)
+
+    def test_keys_are_scoped_to_the_user(self):
+        self.borrow("borrow-1")
+        other = get_user_model().objects.create_user(
+            email="other@test.com", password="test_password"
+        )
+        self.client.force_authenticate(other)
+
+        res = self.borrow("borrow-1")
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn("Idempotent-Replayed", res.headers)
+        self.assertEqual(Borrowing.objects.count(), 2)
+
+    def test_anonymous_requests_are_not_replayed(self):
+        borrowing = self.late_borrowing()
+        url = reverse("borrowings:return", args=[borrowing.id])
+        self.client.force_authenticate(None)
+
+        first = self.client.post(url, headers={"Idempotency-Key": "return-1"})
+        second = self.client.post(url, headers={"Idempotency-Key": "return-1"})
+
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertNotIn("Idempotent-Replayed", second.headers)
+
+    def test_key_reused_for_another_request_is_rejected(self):
+        other_book = Book.objects.create(
+            title="Other Title", author="Test Author", inventory=5, daily_fee=1
+        )
+        self.borrow("borrow-1")
+
+        res = self.borrow("borrow-1", book=other_book)
+
+        self.assertEqual(res.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(Borrowing.objects.count(), 1)
+
+    def test_retry_while_first_request_runs_is_rejected(self):
+        retries = []
+
+        def retry_meanwhile(*args, **kwargs):
+            retries.append(self.borrow("borrow-1"))
+            return create_pending_payment(*args, **kwargs)
+
+        with mock.patch(
+            "borrowings.views.create_pending_payment", side_effect=retry_meanwhile
+        ):
+            first = self.borrow("borrow-1")
+
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retries[0].status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(self.borrow("borrow-1").data, first.data)
+
+    def test_failed_request_can_be_retried(self):
+        with mock.patch(
+            "borrowings.views.create_pending_payment", side_effect=RuntimeError
+        ):
+            with self.assertRaises(ValueError):
+                self.borrow("borrow-1")
+
+        res = self.borrow("borrow-1")
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn("Idempotent-Replayed", res.headers)
+
+    def test_retried_return_is_replayed(self):
+        borrowing = self.late_borrowing()
+        url = reverse("borrowings:return", args=[borrowing.id])
+
+        first = self.client.post(url, headers={"Idempotency-Key": "return-1"})
+        retry = self.client.post(url, headers={"Idempotency-Key": "return-1"})
+
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(retry.status_code, status.HTTP_200_OK)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(Payment.objects.filter(type="F").count(), 1)
+        self.assertEqual(len(InMemoryGateway._sessions), 1)
+
+    def test_retried_renewal_opens_one_session(self):
+        payment = Payment.objects.create(
+            status="E", borrowing=self.late_borrowing(), money=2
+        )
+        url = reverse("payment:renew", args=[payment.id])
+
+        first = self.client.post(url, headers={"Idempotency-Key": "renew-1"})
+        retry = self.client.post(url, headers={"Idempotency-Key": "renew-1"})
+
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(len(InMemoryGateway._sessions), 1)
@@ -220,8 +220,8 @@ class AuthenticatedLibraryServiceApiTests(TestCase):
         }
         res_user = self.client.post(BORROWING_LIST_URL, borrow_data)
         res_list_user = self.client.get(BORROWING_LIST_URL)
-        self.assertEqual(len(res_list_user.data), 1)
-        self.assertEqual(res_list_user.data[0]["user"], self.user.email)
+        self.assertEqual(len(res_list_user.data["results"]), 1)
+        self.assertEqual(res_list_user.data["results"][0]["user"], self.user.email)
 
     def test_admin_list_borrowings(self):
 
@@ -245,7 +245,7 @@ class AuthenticatedLibraryServiceApiTests(TestCase):
         res_admin = self.client.post(BORROWING_LIST_URL, borrow_data)
         res_list_admin = self.client.get(BORROWING_LIST_URL)
 
-        self.assertIn(res_list_user.data[0], res_list_admin.data)
+        self.assertIn(res_list_user.data["results"][0], res_list_admin.data["results"])
 
     def test_return_borrowing_book(self):
         self.client.force_authenticate(self.user)
@@ -367,8 +367,8 @@ class AuthenticatedLibraryServiceApiTests(TestCase):
             BORROWING_LIST_URL, {"is_active": {is_active_parameter}}
         )
 
-        self.assertEqual(len(res_list_user.data), 1)
-        self.assertEqual(res_list_user.data[0]["user"], self.user.email)
+        self.assertEqual(len(res_list_user.data["results"]), 1)
+        self.assertEqual(res_list_user.data["results"][0]["user"], self.user.email)
 
         borrowing_user_1 = Borrowing.objects.get(id=borrowing_user_1_id)
         borrowing_user_2 = Borrowing.objects.get(id=borrowing_user_2_id)
@@ -378,9 +378,9 @@ class AuthenticatedLibraryServiceApiTests(TestCase):
         serialize_user_2 = BorrowingListSerializer(borrowing_user_2)
         serialize_admin = BorrowingListSerializer(borrowing_admin)
 
-        self.assertIn(serialize_user_2.data, res_list_user.data)
-        self.assertNotIn(serialize_user_1.data, res_list_user.data)
-        self.assertNotIn(serialize_admin.data, res_list_user.data)
+        self.assertIn(serialize_user_2.data, res_list_user.data["results"])
+        self.assertNotIn(serialize_user_1.data, res_list_user.data["results"])
+        self.assertNotIn(serialize_admin.data, res_list_user.data["results"])
 
     def test_admin_is_active_list_borrowing(self):
         self.client.force_authenticate(self.user)
@@ -444,9 +444,9 @@ class AuthenticatedLibraryServiceApiTests(TestCase):
         serialize_user_2 = BorrowingListSerializer(borrowing_user_2)
         serialize_admin = BorrowingListSerializer(borrowing_admin)
 
-        self.assertIn(serialize_user_2.data, res_list_user.data)
-        self.assertNotIn(serialize_user_1.data, res_list_user.data)
-        self.assertIn(serialize_admin.data, res_list_user.data)
+        self.assertIn(serialize_user_2.data, res_list_user.data["results"])
+        self.assertNotIn(serialize_user_1.data, res_list_user.data["results"])
+        self.assertIn(serialize_admin.data, res_list_user.data["results"])
 
     def test_admin_is_active_and_user_id_list_borrowing(self):
         self.client.force_authenticate(self.user)
@@ -512,9 +512,9 @@ class AuthenticatedLibraryServiceApiTests(TestCase):
         serialize_user_2 = BorrowingListSerializer(borrowing_user_2)
         serialize_admin = BorrowingListSerializer(borrowing_admin)
 
-        self.assertIn(serialize_user_2.data, res_list_user.data)
-        self.assertNotIn(serialize_user_1.data, res_list_user.data)
-        self.assertNotIn(serialize_admin.data, res_list_user.data)
+        self.assertIn(serialize_user_2.data, res_list_user.data["results"])
+        self.assertNotIn(serialize_user_1.data, res_list_user.data["results"])
+        self.assertNotIn(serialize_admin.data, res_list_user.data["results"])
 
     def test_admin_is_active_and_user_id_list_borrowing_not_active(self):
         self.client.force_authenticate(self.user)
@@ -580,6 +580,6 @@ class AuthenticatedLibraryServiceApiTests(TestCase):
         serialize_user_2 = BorrowingListSerializer(borrowing_user_2)
         serialize_admin = BorrowingListSerializer(borrowing_admin)
 
-        self.assertNotIn(serialize_user_2.data, res_list_user.data)
-        self.assertIn(serialize_user_1.data, res_list_user.data)
-        self.assertNotIn(serialize_admin.data, res_list_user.data)
+        self.assertNotIn(serialize_user_2.data, res_list_user.data["results"])
+        self.assertIn(serialize_user_1.data, res_list_user.data["results"])
+        self.assertNotIn(serialize_admin.data, res_list_user.data["results"])
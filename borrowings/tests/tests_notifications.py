@@ -0,0 +1,376 @@
+import datetime
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from redis.exceptions import RedisError
+from rest_framework.test import APIClient
+
+from books.models import Book
+from borrowings.models import Borrowing
+from borrowings.tasks import (
+    REMINDER_TIME,
+    borrowing_notification,
+    deliver_telegram_messages,
+    handle_outbox_message,
+    pack_messages,
+    schedule_telegram_delivery,
+    send_due_reminder,
+)
+from helpers import telegram_helper
+from helpers.telegram_helper import (
+    PROCESSING_KEY,
+    QUEUE_KEY,
+    TELEGRAM_MESSAGE_LIMIT,
+    TelegramHelper,
+    drain_queue,
+    get_redis,
+    telegram_queue_stats,
+)
+from library_service_api.celery import app
+from payment.models import OutboxMessage
+
+BORROWING_LIST_URL = reverse("borrowings:borrowing-list")
+TODAY = datetime.date.today()
+
+
+def telegram_response(status_code=200, body=None):
+    return mock.Mock(
+        ok=status_code < 400,
+        status_code=status_code,
+        text=str(body),
+        json=mock.Mock(return_value=body or {"ok": True}),
+    )
+
+
+class PackMessagesTests(TestCase):
+
+    def test_lines_are_packed_within_the_limit(self):
+        lines = [f"line {number} " + "x" * 40 for number in range(100)]
+
+        messages = list(pack_messages(enumerate(lines), limit=500))
+
+        self.assertTrue(all(len(message) <= 500 for _, message in messages))
+        self.assertEqual(len(messages), 10)
+        self.assertEqual(
+            "\n\n".join(message for _, message in messages), "\n\n".join(lines)
+        )
+        self.assertEqual(
+            [ids for ids, _ in messages],
+            [list(range(n, n + 10)) for n in range(0, 100, 10)],
+        )
+
+    def test_oversized_line_is_truncated(self):
+        messages = list(pack_messages([(1, "x" * 50)], limit=20))
+
+        self.assertEqual(messages, [([1], "x" * 20)])
+
+
+@mock.patch("borrowings.tasks.TelegramHelper")
+class DueReminderTests(TestCase):
+
+    def setUp(self) -> None:
+        app.conf.task_always_eager = True
+        self.addCleanup(setattr, app.conf, "task_always_eager", False)
+        self.user = get_user_model().objects.create_user(
+            email="test@test.com", password="test_password"
+        )
+        self.book = Book.objects.create(
+            title="Test Title", author="Test Author", inventory=10, daily_fee=1
+        )
+
+    def sample_borrowings(self, number, due_in_days=1):
+        borrowings = Borrowing.objects.bulk_create(
+            Borrowing(
+                expected_return_date=TODAY + datetime.timedelta(days=2),
+                book=self.book,
+                user=self.user,
+            )
+            for _ in range(number)
+        )
+        Borrowing.objects.filter(id__in=[b.id for b in borrowings]).update(
+            borrow_date=TODAY - datetime.timedelta(days=10),
+            expected_return_date=TODAY + datetime.timedelta(days=due_in_days),
+        )
+        return borrowings
+
+    def sent_messages(self, telegram):
+        return [
+            call.args[0]
+            for call in telegram.return_value.enqueue_message.call_args_list
+        ]
+
+    def borrow(self, expected_return_date):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with mock.patch("borrowings.views.schedule_outbox_processing"), mock.patch(
+            "borrowings.tasks.send_due_reminder.apply_async"
+        ) as apply_async, self.captureOnCommitCallbacks(execute=True):
+            res = client.post(
+                BORROWING_LIST_URL,
+                {
+                    "expected_return_date": expected_return_date,
+                    "book": self.book.id,
+                    "user": self.user.id,
+                },
+            )
+        return res, apply_async
+
+    def test_borrow_schedules_reminder_for_the_day_before(self, telegram):
+        expected_return_date = TODAY + datetime.timedelta(days=2)
+
+        res, apply_async = self.borrow(expected_return_date)
+
+        apply_async.assert_called_once_with(
+            ([res.data["id"]],),
+            eta=timezone.make_aware(
+                datetime.datetime.combine(
+                    expected_return_date - datetime.timedelta(days=1), REMINDER_TIME
+                )
+            ),
+        )
+
+    def test_distant_reminder_is_left_to_the_daily_run(self, telegram):
+        _, apply_async = self.borrow(TODAY + datetime.timedelta(days=30))
+
+        apply_async.assert_not_called()
+
+    def test_daily_run_schedules_reminders_due_after_tomorrow(self, telegram):
+        upcoming = self.sample_borrowings(3, due_in_days=2)
+        self.sample_borrowings(2, due_in_days=3)
+
+        with mock.patch(
+            "borrowings.tasks.send_due_reminder.apply_async"
+        ) as apply_async:
+            borrowing_notification()
+
+        apply_async.assert_called_once()
+        self.assertCountEqual(
+            apply_async.call_args.args[0][0], [b.id for b in upcoming]
+        )
+
+    def test_failed_dispatch_releases_the_claims(self, telegram):
+        self.sample_borrowings(3)
+
+        with mock.patch(
+            "borrowings.tasks.group", side_effect=ConnectionError("broker down")
+        ), self.assertRaises(ConnectionError):
+            borrowing_notification()
+
+        self.assertFalse(
+            Borrowing.objects.filter(reminder_sent_at__isnull=False).exists()
+        )
+        self.assertEqual(borrowing_notification()["borrowings"], 3)
+
+    def test_reminder_is_sent_once(self, telegram):
+        (borrowing,) = self.sample_borrowings(1)
+
+        self.assertEqual(send_due_reminder([borrowing.id]), 1)
+        self.assertEqual(send_due_reminder([borrowing.id]), 0)
+
+        self.assertEqual(len(self.sent_messages(telegram)), 1)
+        borrowing.refresh_from_db()
+        self.assertIsNotNone(borrowing.reminder_sent_at)
+
+    def test_reminder_for_returned_borrowing_is_skipped(self, telegram):
+        (borrowing,) = self.sample_borrowings(1)
+        Borrowing.objects.filter(id=borrowing.id).update(actual_return_date=TODAY)
+
+        self.assertEqual(send_due_reminder([borrowing.id]), 0)
+        telegram.return_value.enqueue_message.assert_not_called()
+
+    def test_failed_reminder_is_left_for_reconciliation(self, telegram):
+        (borrowing,) = self.sample_borrowings(1)
+        telegram.return_value.enqueue_message.return_value = False
+
+        send_due_reminder([borrowing.id])
+
+        borrowing.refresh_from_db()
+        self.assertIsNone(borrowing.reminder_sent_at)
+
+    def test_reconciliation_packs_unreminded_borrowings(self, telegram):
+        reminded = self.sample_borrowings(3)
+        send_due_reminder([borrowing.id for borrowing in reminded])
+        telegram.reset_mock()
+        self.sample_borrowings(300)
+        self.sample_borrowings(5, due_in_days=5)
+
+        with self.assertNumQueries(3):
+            stats = borrowing_notification()
+
+        messages = self.sent_messages(telegram)
+        self.assertEqual(stats["borrowings"], 300)
+        self.assertEqual(stats["messages"], len(messages))
+        self.assertLess(len(messages), 30)
+        self.assertTrue(all(len(m) <= TELEGRAM_MESSAGE_LIMIT for m in messages))
+        self.assertEqual(sum(m.count("Please make it ontime!") for m in messages), 300)
+
+    def test_reconciliation_without_pending_reminders(self, telegram):
+        self.sample_borrowings(2, due_in_days=5)
+
+        stats = borrowing_notification()
+
+        self.assertEqual(stats["messages"], 0)
+        telegram.return_value.enqueue_message.assert_not_called()
+
+
+@override_settings(
+    TELEGRAM_QUEUE_URL="redis://redis:6379/15",
+    TELEGRAM_MAX_RPS=1000,
+    TELEGRAM_CHAT_MESSAGES_PER_MINUTE=60000,
+)
+class TelegramQueueTests(TestCase):
+
+    def setUp(self) -> None:
+        get_redis().flushdb()
+        self.addCleanup(get_redis().flushdb)
+        patcher = mock.patch.object(telegram_helper, "get_session")
+        self.post = patcher.start().return_value.post
+        self.post.return_value = telegram_response()
+        self.addCleanup(patcher.stop)
+
+    def sent_texts(self):
+        return [call.kwargs["data"]["text"] for call in self.post.call_args_list]
+
+    def test_queued_messages_are_sent_as_one_digest_with_timeouts(self):
+        for number in range(3):
+            self.assertTrue(TelegramHelper().enqueue_message(f"message {number}"))
+
+        stats = drain_queue(5)
+
+        self.assertEqual(
+            (stats["sent"], stats["digests"], stats["remaining"]), (3, 1, 0)
+        )
+        self.assertEqual(self.sent_texts(), ["message 0\n\nmessage 1\n\nmessage 2"])
+        self.assertEqual(self.post.call_args.kwargs["timeout"], (3, 10))
+        queue_stats = telegram_queue_stats()
+        self.assertEqual(
+            {name: queue_stats[name] for name in ("queued", "enqueued", "sent")},
+            {"queued": 0, "enqueued": 3, "sent": 3},
+        )
+        self.assertEqual(queue_stats["digests"], 1)
+        self.assertIsNotNone(queue_stats["flush_latency_avg_seconds"])
+
+    def test_burst_is_split_into_digests_within_the_message_limit(self):
+        lines = [f"Borrowing {number} " + "x" * 200 for number in range(500)]
+        for line in lines:
+            TelegramHelper().enqueue_message(line)
+
+        stats = drain_queue(5, batch_size=500)
+
+        texts = self.sent_texts()
+        self.assertEqual(stats["sent"], 500)
+        self.assertLess(len(texts), 40)
+        self.assertTrue(all(len(text) <= TELEGRAM_MESSAGE_LIMIT for text in texts))
+        self.assertEqual("\n\n".join(texts), "\n\n".join(lines))
+
+    @mock.patch("borrowings.tasks.schedule_telegram_delivery")
+    def test_redelivered_outbox_row_is_sent_once(self, schedule):
+        first, second = OutboxMessage.objects.bulk_create(
+            OutboxMessage(kind="N", payload={"message": "Successful payment 2.00 USD."})
+            for _ in range(2)
+        )
+
+        for message in (first, second, first):
+            handle_outbox_message(message)
+        drain_queue(5)
+
+        self.assertEqual(
+            self.sent_texts(),
+            ["Successful payment 2.00 USD.\n\nSuccessful payment 2.00 USD."],
+        )
+        self.assertEqual(telegram_queue_stats()["deduplicated"], 1)
+
+    def test_content_dedupe_is_opt_in(self):
+        for _ in range(2):
+            TelegramHelper().enqueue_message("same text", dedupe_by_content=True)
+        TelegramHelper().enqueue_message("same text")
+
+        drain_queue(5)
+
+        self.assertEqual(self.sent_texts(), ["same text\n\nsame text"])
+        self.assertEqual(telegram_queue_stats()["deduplicated"], 1)
+
+    def test_dedupe_marker_is_not_left_by_a_failed_enqueue(self):
+        helper = TelegramHelper()
+        with mock.patch.object(
+            get_redis(), "evalsha", side_effect=RedisError("connection lost")
+        ):
+            self.assertFalse(helper.enqueue_message("text", dedupe_key="outbox:1"))
+
+        self.assertTrue(helper.enqueue_message("text", dedupe_key="outbox:1"))
+        self.assertEqual(get_redis().llen(QUEUE_KEY), 1)
+
+    def test_burst_schedules_one_delayed_drain(self):
+        with mock.patch(
+            "borrowings.tasks.deliver_telegram_messages.apply_async"
+        ) as apply_async:
+            for _ in range(5):
+                schedule_telegram_delivery()
+
+        apply_async.assert_called_once_with(countdown=2)
+
+    def test_rate_limited_digest_waits_at_the_head_of_the_queue(self):
+        TelegramHelper().enqueue_message("first")
+        TelegramHelper().enqueue_message("second")
+        self.post.return_value = telegram_response(
+            429, {"ok": False, "parameters": {"retry_after": 7}}
+        )
+
+        stats = drain_queue(5)
+
+        self.assertEqual((stats["retried"], stats["retry_in"]), (2, 7))
+        self.assertEqual(get_redis().llen(QUEUE_KEY), 2)
+        self.post.return_value = telegram_response()
+        drain_queue(5)
+        self.assertEqual(self.sent_texts(), ["first\n\nsecond"] * 2)
+
+    def test_refused_reminder_is_unclaimed(self):
+        user = get_user_model().objects.create_user(
+            email="test@test.com", password="test_password"
+        )
+        book = Book.objects.create(
+            title="Test Title", author="Test Author", inventory=10, daily_fee=1
+        )
+        borrowing = Borrowing.objects.create(
+            expected_return_date=TODAY + datetime.timedelta(days=1),
+            book=book,
+            user=user,
+        )
+        self.post.return_value = telegram_response(400, {"ok": False})
+
+        with mock.patch("borrowings.tasks.schedule_telegram_delivery"):
+            send_due_reminder([borrowing.id])
+            self.assertIsNotNone(
+                Borrowing.objects.get(id=borrowing.id).reminder_sent_at
+            )
+            stats = deliver_telegram_messages()
+
+        self.assertEqual(stats["dropped"], 1)
+        self.assertIsNone(Borrowing.objects.get(id=borrowing.id).reminder_sent_at)
+
+    def test_message_of_a_dead_drainer_is_sent_again(self):
+        TelegramHelper().enqueue_message("in flight")
+        get_redis().lmove(QUEUE_KEY, PROCESSING_KEY, "LEFT", "RIGHT")
+
+        stats = drain_queue(5)
+
+        self.assertEqual(stats["sent"], 1)
+        self.assertEqual(self.sent_texts(), ["in flight"])
+        self.assertEqual(get_redis().llen(PROCESSING_KEY), 0)
+
+    def test_only_one_drainer_runs_at_a_time(self):
+        TelegramHelper().enqueue_message("message")
+
+        with get_redis().lock("telegram:queue:lock", timeout=5):
+            stats = drain_queue(5)
+
+        self.assertTrue(stats["skipped"])
+        self.post.assert_not_called()
+
+    @override_settings(TELEGRAM_QUEUE_URL="redis://localhost:1/0")
+    def test_unavailable_queue_is_reported(self):
+        self.assertFalse(TelegramHelper().enqueue_message("message"))
+        self.assertEqual(telegram_queue_stats(), {"available": False})
@@ -0,0 +1,167 @@
+import datetime
+from types import SimpleNamespace
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from books.models import Book
+from borrowings.models import Borrowing
+from borrowings.tasks import process_outbox, OUTBOX_MAX_ATTEMPTS
+from helpers.payment_gateway import gateway_breaker
+from payment.models import OutboxMessage, Payment
+
+BORROWING_LIST_URL = reverse("borrowings:borrowing-list")
+
+
+def fake_session(*args, **kwargs):
+    return SimpleNamespace(
+        id="cs_test_123", url="https://checkout.stripe.com/c/pay/cs_test_123"
+    )
+
+
+class BorrowingOutboxTests(TestCase):
+
+    def setUp(self) -> None:
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            email="test@test.com", password="test_password"
+        )
+        self.client.force_authenticate(self.user)
+        self.book = Book.objects.create(
+            title="Test Title", author="Test Author", inventory=10, daily_fee=1
+        )
+
+    def borrow(self):
+        return self.client.post(
+            BORROWING_LIST_URL,
+            {
+                "expected_return_date": datetime.date.today()
+                + datetime.timedelta(days=2),
+                "book": self.book.id,
+                "user": self.user.id,
+            },
+        )
+
+    def test_borrow_records_session_pending_payment(self):
+        with mock.patch("helpers.stripe_helper.create_stripe_session") as create:
+            res = self.borrow()
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        create.assert_not_called()
+        payment = Payment.objects.get(id=res.data["payment_id"])
+        self.assertEqual(payment.status, "S")
+        self.assertIsNone(res.data["url_payment"])
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.payload["payment_id"], payment.id)
+        self.assertEqual(message.payload["amount"], 200)
+
+    def test_process_outbox_opens_session_and_notifies(self):
+        res = self.borrow()
+
+        with (
+            mock.patch(
+                "helpers.stripe_helper.create_stripe_session", side_effect=fake_session
+            ) as create,
+            mock.patch("borrowings.tasks.TelegramHelper") as telegram,
+        ):
+            processed = process_outbox()
+
+        self.assertEqual(processed, 1)
+        self.assertEqual(
+            create.call_args.kwargs["idempotency_key"],
+            f"payment-{res.data['payment_id']}-session",
+        )
+        payment = Payment.objects.get(id=res.data["payment_id"])
+        self.assertEqual(payment.status, "G")
+        self.assertEqual(payment.session_id, "cs_test_123")
+        self.assertIn(payment.session_url, telegram().enqueue_message.call_args.args[0])
+        self.assertIsNotNone(OutboxMessage.objects.get().processed_at)
+
+    def test_failed_message_is_retried_later(self):
+        self.borrow()
+
+        with mock.patch(
+            "helpers.stripe_helper.create_stripe_session",
+            side_effect=RuntimeError("Stripe is down"),
+        ):
+            process_outbox()
+
+        message = OutboxMessage.objects.get()
+        self.assertIsNone(message.processed_at)
+        self.assertEqual(message.attempts, 1)
+        self.assertEqual(message.last_error, "Stripe is down")
+
+        message.attempts = OUTBOX_MAX_ATTEMPTS
+        message.save()
+        self.assertEqual(process_outbox(), 0)
+
+
+class PaymentGatewayBreakerTests(TestCase):
+
+    def setUp(self) -> None:
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            email="test@test.com", password="test_password"
+        )
+        self.client.force_authenticate(self.user)
+        self.book = Book.objects.create(
+            title="Test Title", author="Test Author", inventory=10, daily_fee=1
+        )
+        gateway_breaker.reset()
+        gateway_breaker.state = gateway_breaker.OPEN
+        gateway_breaker.opened_at = float("inf")
+        self.addCleanup(gateway_breaker.reset)
+
+    def test_late_return_records_session_pending_fine(self):
+        borrowing = Borrowing.objects.create(
+            expected_return_date=datetime.date.today() + datetime.timedelta(days=2),
+            book=self.book,
+            user=self.user,
+        )
+        Borrowing.objects.filter(id=borrowing.id).update(
+            borrow_date=datetime.date.today() - datetime.timedelta(days=10),
+            expected_return_date=datetime.date.today() - datetime.timedelta(days=3),
+        )
+
+        with mock.patch(
+            "helpers.stripe_helper.stripe.checkout.Session.create"
+        ) as create:
+            res = self.client.post(reverse("borrowings:return", args=[borrowing.id]))
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        create.assert_not_called()
+        fine = Payment.objects.get(id=res.data["fine_payment_id"])
+        self.assertEqual((fine.type, fine.status), ("F", "S"))
+        self.assertIsNone(res.data["url_for_payment"])
+        self.assertEqual(OutboxMessage.objects.get().payload["payment_id"], fine.id)
+
+    def test_outbox_waits_while_breaker_is_open(self):
+        self.client.post(
+            BORROWING_LIST_URL,
+            {
+                "expected_return_date": datetime.date.today()
+                + datetime.timedelta(days=2),
+                "book": self.book.id,
+                "user": self.user.id,
+            },
+        )
+
+        process_outbox()
+
+        message = OutboxMessage.objects.get()
+        self.assertIsNone(message.processed_at)
+        self.assertEqual(message.attempts, 0)
+
+    def test_breaker_state_is_in_metrics(self):
+        admin_user = get_user_model().objects.create_superuser(
+            email="admin@test.com", password="admin_password"
+        )
+        self.client.force_authenticate(admin_user)
+
+        res = self.client.get(reverse("metrics"))
+
+        self.assertEqual(res.data["payment_gateway_breaker"]["state"], "open")
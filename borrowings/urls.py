@@ -1,13 +1,24 @@
 from django.urls import path, include
 from rest_framework import routers
 
-from borrowings.views import BorrowingViewSet, BorrowingReturnView
+from borrowings.views import (
+    BorrowingViewSet,
+    BorrowingReturnView,
+    BorrowingBulkReturnView,
+    BorrowingCheckoutView,
+)
 from payment.views import StripeSuccessView, StripeCancelView
 
 router = routers.DefaultRouter()
 router.register("borrowings", BorrowingViewSet)
 
 urlpatterns = [
+    path(
+        "borrowings/return/",
+        BorrowingBulkReturnView.as_view(),
+        name="bulk-return",
+    ),
+    path("borrowings/checkout/", BorrowingCheckoutView.as_view(), name="checkout"),
     path("", include(router.urls)),
     path("borrowings/<int:id>/return/", BorrowingReturnView.as_view(), name="return"),
     path("stripe/success/", StripeSuccessView.as_view(), name="stripe-success"),
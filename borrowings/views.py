@@ -1,23 +1,43 @@
+import logging
+from collections import Counter
 from datetime import date
 from decimal import Decimal
 
+from asgiref.sync import sync_to_async
 from django.db import transaction
-from django.db.models import Q
+from django.db.models import Q, Prefetch
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from drf_spectacular.utils import extend_schema, OpenApiParameter
 from rest_framework import viewsets, status
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.exceptions import ValidationError
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from books.cache import invalidate_catalog
+from books.models import Book
 from borrowings.models import Borrowing
+from borrowings.pagination import BorrowingCursorPagination
 from borrowings.serializers import (
     BorrowingListSerializer,
     BorrowingCreateSerializer,
+    BorrowingBulkReturnSerializer,
+    BorrowingCheckoutSerializer,
 )
-from helpers.stripe_helper import create_payment
-from helpers.telegram_helper import TelegramHelper
+from borrowings.tasks import schedule_due_reminder, schedule_outbox_processing
+from helpers.async_views import AsyncAPIView
+from helpers.idempotency import idempotent
+from helpers.stripe_helper import (
+    PaymentGatewayUnavailable,
+    aopen_payment_session,
+    create_pending_payment,
+    create_pending_payments,
+    get_stripe_redirect_urls,
+)
+from payment.models import UserPaymentSummary
+
+logger = logging.getLogger(__name__)
 
 FINE_MULTIPLIER = 2
 
@@ -40,16 +60,30 @@ def calculate_amount(last_day: date, first_day: date, rate: Decimal) -> int:
     return int((amount * 100).quantize(Decimal("0")))
 
 
+def parse_date_param(params, name: str) -> date | None:
+    value = params.get(name)
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise ValidationError({name: "Date must be in YYYY-MM-DD format."})
+
+
 class BorrowingViewSet(viewsets.ModelViewSet):
     queryset = Borrowing.objects.all()
     serializer_class = BorrowingListSerializer
     permission_classes = (IsAuthenticated,)
+    pagination_class = BorrowingCursorPagination
 
     def get_queryset(self):
         queryset = super().get_queryset()
+        params = self.request.query_params
 
-        is_active = self.request.query_params.get("is_active")
-        user_id = self.request.query_params.get("user_id")
+        is_active = params.get("is_active")
+        user_id = params.get("user_id")
+        book_id = params.get("book_id")
+        overdue = params.get("overdue")
         filters = Q()
         if is_active:
             if is_active == "1":
@@ -58,9 +92,36 @@ class BorrowingViewSet(viewsets.ModelViewSet):
                 filters &= ~Q(actual_return_date__isnull=True)
         if user_id:
             filters &= Q(user__id=user_id)
+        if book_id:
+            if not book_id.isdigit():
+                raise ValidationError({"book_id": "A valid integer is required."})
+            filters &= Q(book_id=book_id)
+        if overdue:
+            overdue_filter = Q(
+                actual_return_date__isnull=True,
+                expected_return_date__lt=timezone.now().date(),
+            )
+            filters &= overdue_filter if overdue == "1" else ~overdue_filter
+
+        for param, lookup in (
+            ("borrow_date_from", "borrow_date__gte"),
+            ("borrow_date_to", "borrow_date__lte"),
+            ("expected_return_date_from", "expected_return_date__gte"),
+            ("expected_return_date_to", "expected_return_date__lte"),
+        ):
+            value = parse_date_param(params, param)
+            if value:
+                filters &= Q(**{lookup: value})
 
         queryset = queryset.filter(filters)
 
+        if self.action in ["list", "retrieve"]:
+            queryset = queryset.select_related("user").prefetch_related(
+                Prefetch("book", queryset=Book.objects.with_available_inventory()),
+                "payments",
+                "cart_payments",
+            )
+
         if self.action == "list" and not self.request.user.is_staff:
             queryset = queryset.filter(user=self.request.user)
             return queryset
@@ -86,6 +147,41 @@ class BorrowingViewSet(viewsets.ModelViewSet):
                 "all users’ borrowings, if not specified, but if "
                 "specified - only for concrete user ex. ?user_id=2",
             ),
+            OpenApiParameter(
+                "book_id",
+                type=int,
+                description="Filter by book id ex. ?book_id=5",
+            ),
+            OpenApiParameter(
+                "overdue",
+                type=str,
+                description="Filtering by overdue borrowings (not returned and "
+                "expected return date has passed - 1, the rest - 0) ex. ?overdue=1",
+            ),
+            OpenApiParameter(
+                "borrow_date_from",
+                type=date,
+                description="Borrowings borrowed on or after the date "
+                "ex. ?borrow_date_from=2024-10-01",
+            ),
+            OpenApiParameter(
+                "borrow_date_to",
+                type=date,
+                description="Borrowings borrowed on or before the date "
+                "ex. ?borrow_date_to=2024-10-31",
+            ),
+            OpenApiParameter(
+                "expected_return_date_from",
+                type=date,
+                description="Borrowings due on or after the date "
+                "ex. ?expected_return_date_from=2024-10-01",
+            ),
+            OpenApiParameter(
+                "expected_return_date_to",
+                type=date,
+                description="Borrowings due on or before the date "
+                "ex. ?expected_return_date_to=2024-10-31",
+            ),
         ]
     )
     def list(self, request, *args, **kwargs):
@@ -101,12 +197,14 @@ class BorrowingViewSet(viewsets.ModelViewSet):
 
     @transaction.atomic()
     def perform_create(self, serializer):
+        book = serializer.validated_data["book"]
+        if not Book.objects.reserve(book):
+            raise ValidationError(
+                {"book": "This book is not available for borrowing as inventory is 0."}
+            )
+        invalidate_catalog(book.id)
 
         try:
-            book = serializer.validated_data["book"]
-
-            book.inventory -= 1
-            book.save()
             borrowing = serializer.save(user=self.request.user)
             amount = calculate_amount(
                 borrowing.expected_return_date,
@@ -114,40 +212,38 @@ class BorrowingViewSet(viewsets.ModelViewSet):
                 borrowing.book.daily_fee,
             )
 
-            payment = create_payment(
+            payment = create_pending_payment(
                 request=self.request,
                 borrowing=borrowing,
                 amount=amount,
-                status_payment="G",
                 type_payment="P",
+                notification=(
+                    f"Book '{borrowing.book.title}' has borrowed by user {borrowing.user.email}.\n"
+                    f"Expected return date: {borrowing.expected_return_date}."
+                ),
+            )
+            transaction.on_commit(schedule_outbox_processing)
+            transaction.on_commit(
+                lambda: schedule_due_reminder(
+                    [borrowing.id], borrowing.expected_return_date
+                )
             )
 
             serializer.context["payment"] = payment
 
-            telegram_helper = TelegramHelper()
-            message = (
-                f"Book '{borrowing.book.title}' has borrowed by user {borrowing.user.email}.\n"
-                f"Expected return date: {borrowing.expected_return_date}.\n"
-                f"Your link for payment: {payment.session_url}"
-            )
-            telegram_helper.send_message(message)
-
         except Exception as e:
             raise ValueError(f"Error occurred while creating payment: {str(e)}")
 
+    @idempotent
     def create(self, request, *args, **kwargs):
         """
         Before creating borrowing - simply check the number of pending payments
-        If at least one exists - forbid borrowing
+        (kept in UserPaymentSummary). If at least one exists - forbid borrowing
         """
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
 
-        queryset = self.queryset.filter(user=self.request.user).filter(
-            Q(payments__status="G") | Q(payments__status="E")
-        )
-
-        if queryset.count() > 0:
+        if UserPaymentSummary.has_outstanding(self.request.user.id):
             return Response(
                 {
                     "massage": "You have at least one unpaid payment. "
@@ -160,48 +256,34 @@ class BorrowingViewSet(viewsets.ModelViewSet):
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
 
-class BorrowingReturnView(APIView):
-    """Return book function"""
+class BorrowingReturnView(AsyncAPIView):
+    """
+    Return book function. The return and a late fine (as a SESSION_PENDING
+    payment with its outbox message) are saved in one transaction, then
+    the fine's Stripe session is opened without holding a thread; if that
+    fails the outbox task opens it later.
+    """
 
     serializer_class = BorrowingCreateSerializer
 
-    @transaction.atomic
-    def post(self, request, id):
+    @idempotent
+    async def post(self, request, id):
         try:
 
-            borrowing = get_object_or_404(Borrowing, id=id)
-            if borrowing.actual_return_date is None:
-                borrowing.actual_return_date = timezone.now().date()
-                borrowing.book.inventory += 1
-                borrowing.book.save()
-                borrowing.save()
-
-                if borrowing.actual_return_date > borrowing.expected_return_date:
-                    fine_amount = borrowing.book.daily_fee * FINE_MULTIPLIER
-                    amount = calculate_amount(
-                        borrowing.actual_return_date,
-                        borrowing.expected_return_date,
-                        fine_amount,
-                    )
-
-                    payment = create_payment(
-                        request=self.request,
-                        borrowing=borrowing,
-                        amount=amount,
-                        status_payment="G",
-                        type_payment="F",
-                    )
-
-                    return Response(
-                        {
-                            "user": borrowing.user.email,
-                            "returned_book": borrowing.book.title,
-                            "fine_payment": payment.money,
-                            "url_for_payment": payment.session_url,
-                        },
-                        status=status.HTTP_200_OK,
-                    )
+            borrowing, returned, fine, amount = await sync_to_async(
+                self.return_borrowing
+            )(id)
+            if not returned:
+                return Response(
+                    {
+                        "detail": f"User {borrowing.user.email} "
+                        f"already have returned book {borrowing.book.title} "
+                        f"on {borrowing.actual_return_date}"
+                    },
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
 
+            if fine is None:
                 return Response(
                     {
                         "detail": f"User {borrowing.user.email} have "
@@ -209,14 +291,260 @@ class BorrowingReturnView(APIView):
                     },
                     status=status.HTTP_200_OK,
                 )
-            else:
-                return Response(
-                    {
-                        "detail": f"User {borrowing.user.email} "
-                        f"already have returned book {borrowing.book.title} "
-                        f"on {borrowing.actual_return_date}"
-                    },
-                    status=status.HTTP_400_BAD_REQUEST,
+
+            try:
+                await aopen_payment_session(
+                    fine, amount, 1, get_stripe_redirect_urls(request)
                 )
+            except PaymentGatewayUnavailable:
+                # Degraded mode: the session is opened by the outbox task.
+                await sync_to_async(schedule_outbox_processing)()
+            except Exception:
+                logger.warning(
+                    "Fine session of payment %s is left to the outbox",
+                    fine.id,
+                    exc_info=True,
+                )
+                await sync_to_async(schedule_outbox_processing)()
+
+            return Response(
+                {
+                    "user": borrowing.user.email,
+                    "returned_book": borrowing.book.title,
+                    "fine_payment": fine.money,
+                    "fine_payment_id": fine.id,
+                    "url_for_payment": fine.session_url or None,
+                },
+                status=status.HTTP_200_OK,
+            )
+
         except Exception as e:
             raise ValueError(f"Error occurred while creating payment: {str(e)}")
+
+    @transaction.atomic
+    def return_borrowing(self, id) -> tuple:
+        """
+        Mark the borrowing returned and record its late fine. Returns the
+        borrowing, whether this call returned it, the fine payment and
+        its amount in cents.
+
+        The borrowing is fetched with its book and user and locked in one
+        query, so of two concurrent returns only one puts the copy back.
+        An on-time return is that SELECT and two UPDATEs.
+        """
+        borrowing = get_object_or_404(
+            Borrowing.objects.select_for_update(of=("self",)).select_related(
+                "book", "user"
+            ),
+            id=id,
+        )
+        if borrowing.actual_return_date is not None:
+            return borrowing, False, None, None
+
+        borrowing.actual_return_date = timezone.now().date()
+        borrowing.save(update_fields=["actual_return_date"])
+        Book.objects.release(borrowing.book)
+        invalidate_catalog(borrowing.book_id)
+
+        if borrowing.actual_return_date <= borrowing.expected_return_date:
+            return borrowing, True, None, None
+
+        fine_amount = borrowing.book.daily_fee * FINE_MULTIPLIER
+        amount = calculate_amount(
+            borrowing.actual_return_date,
+            borrowing.expected_return_date,
+            fine_amount,
+        )
+        fine = create_pending_payment(
+            request=self.request,
+            borrowing=borrowing,
+            amount=amount,
+            type_payment="F",
+        )
+        return borrowing, True, fine, amount
+
+
+class BorrowingBulkReturnView(APIView):
+    """
+    Return a stack of books at once: one UPDATE marks the borrowings
+    returned, one UPDATE per book puts the copies back and the late fines
+    are recorded together as pending payments (Stripe sessions are created
+    by the outbox task).
+    """
+
+    serializer_class = BorrowingBulkReturnSerializer
+    permission_classes = (IsAdminUser,)
+
+    @transaction.atomic
+    def post(self, request):
+        serializer = self.serializer_class(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids = list(dict.fromkeys(serializer.validated_data["ids"]))
+        today = timezone.now().date()
+
+        borrowings = {
+            borrowing.id: borrowing
+            for borrowing in Borrowing.objects.select_for_update(of=("self",))
+            .select_related("book", "user")
+            .filter(id__in=ids)
+            .order_by("id")
+        }
+        returned = [
+            borrowing
+            for borrowing in borrowings.values()
+            if borrowing.actual_return_date is None
+        ]
+
+        fines = {}
+        if returned:
+            Borrowing.objects.filter(
+                id__in=[borrowing.id for borrowing in returned]
+            ).update(actual_return_date=today)
+
+            books = {borrowing.book_id: borrowing.book for borrowing in returned}
+            for book_id, quantity in Counter(
+                borrowing.book_id for borrowing in returned
+            ).items():
+                Book.objects.release(books[book_id], quantity=quantity)
+            invalidate_catalog(*books)
+
+            late = [
+                borrowing
+                for borrowing in returned
+                if today > borrowing.expected_return_date
+            ]
+            if late:
+                payments = create_pending_payments(
+                    request,
+                    [
+                        (
+                            borrowing,
+                            calculate_amount(
+                                today,
+                                borrowing.expected_return_date,
+                                borrowing.book.daily_fee * FINE_MULTIPLIER,
+                            ),
+                            None,
+                        )
+                        for borrowing in late
+                    ],
+                    type_payment="F",
+                )
+                fines = {payment.borrowing_id: payment for payment in payments}
+                transaction.on_commit(schedule_outbox_processing)
+
+        results = []
+        for borrowing_id in ids:
+            borrowing = borrowings.get(borrowing_id)
+            if borrowing is None:
+                results.append({"id": borrowing_id, "status": "not_found"})
+            elif borrowing.actual_return_date is not None:
+                results.append(
+                    {
+                        "id": borrowing_id,
+                        "status": "already_returned",
+                        "actual_return_date": borrowing.actual_return_date,
+                    }
+                )
+            else:
+                fine = fines.get(borrowing_id)
+                results.append(
+                    {
+                        "id": borrowing_id,
+                        "status": "returned",
+                        "user": borrowing.user.email,
+                        "returned_book": borrowing.book.title,
+                        "fine_payment_id": fine.id if fine else None,
+                        "fine_payment": fine.money if fine else None,
+                    }
+                )
+
+        return Response({"results": results}, status=status.HTTP_200_OK)
+
+
+class BorrowingCheckoutView(APIView):
+    """
+    Borrow several books at once: the copies are reserved in one
+    transaction and a single payment with one Stripe line item per book
+    covers all the new borrowings.
+    """
+
+    serializer_class = BorrowingCheckoutSerializer
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request):
+        serializer = self.serializer_class(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        books = serializer.validated_data["books"]
+        expected_return_date = serializer.validated_data["expected_return_date"]
+
+        if UserPaymentSummary.has_outstanding(request.user.id):
+            return Response(
+                {
+                    "massage": "You have at least one unpaid payment. "
+                    "You can't borrow new book.",
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        with transaction.atomic():
+            # Reserve in id order so concurrent carts do not deadlock.
+            for book in sorted(books, key=lambda book: book.id):
+                if not Book.objects.reserve(book):
+                    raise ValidationError(
+                        {
+                            "books": f"Book '{book.title}' is not available "
+                            f"for borrowing as inventory is 0."
+                        }
+                    )
+            invalidate_catalog(*(book.id for book in books))
+
+            borrowings = Borrowing.objects.bulk_create(
+                Borrowing(
+                    expected_return_date=expected_return_date,
+                    book=book,
+                    user=request.user,
+                )
+                for book in books
+            )
+            line_items = [
+                {
+                    "name": f"Borrowing of '{borrowing.book.title}'",
+                    "amount": calculate_amount(
+                        borrowing.expected_return_date,
+                        borrowing.borrow_date,
+                        borrowing.book.daily_fee,
+                    ),
+                    "quantity": 1,
+                }
+                for borrowing in borrowings
+            ]
+            titles = ", ".join(f"'{book.title}'" for book in books)
+            payment = create_pending_payment(
+                request=request,
+                borrowing=borrowings[0],
+                amount=sum(item["amount"] for item in line_items),
+                type_payment="P",
+                notification=(
+                    f"Books {titles} have borrowed by user {request.user.email}.\n"
+                    f"Expected return date: {expected_return_date}."
+                ),
+                line_items=line_items,
+            )
+            payment.borrowings.set(borrowings)
+            transaction.on_commit(schedule_outbox_processing)
+            transaction.on_commit(
+                lambda: schedule_due_reminder(
+                    [borrowing.id for borrowing in borrowings], expected_return_date
+                )
+            )
+
+        return Response(
+            {
+                "borrowings": [borrowing.id for borrowing in borrowings],
+                "expected_return_date": expected_return_date,
+                "payment_id": payment.id,
+                "money": payment.money,
+            },
+            status=status.HTTP_201_CREATED,
+        )
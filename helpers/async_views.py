@@ -0,0 +1,41 @@
+from inspect import isawaitable
+
+from asgiref.sync import sync_to_async
+from rest_framework.views import APIView
+
+
+class AsyncAPIView(APIView):
+    """
+    APIView whose handlers are coroutines. Under ASGI a request waiting on
+    the payment gateway holds no thread. Authentication, permissions and
+    throttling are the same as for APIView and run in a worker thread,
+    since they may hit the database; handlers use the async ORM or wrap
+    transactions in sync_to_async.
+    """
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(
+                    self, request.method.lower(), self.http_method_not_allowed
+                )
+            else:
+                handler = self.http_method_not_allowed
+
+            response = handler(request, *args, **kwargs)
+            if isawaitable(response):
+                response = await response
+
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
@@ -0,0 +1,159 @@
+import threading
+import time
+from collections import deque
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency while its breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Rolling-window circuit breaker.
+
+    Every call is recorded with its outcome and duration. Once the last
+    ``window`` seconds hold at least ``min_calls`` calls and either the
+    share of failures reaches ``failure_rate`` or the share of calls
+    slower than ``slow_call_seconds`` reaches ``slow_call_rate``, the
+    breaker opens and calls fail fast with CircuitOpenError. After
+    ``open_seconds`` one trial call is let through (half-open): success
+    closes the breaker, failure opens it again. State is per process.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        name: str,
+        window: float = 60,
+        min_calls: int = 10,
+        failure_rate: float = 0.5,
+        slow_call_seconds: float = 5,
+        slow_call_rate: float = 0.5,
+        open_seconds: float = 30,
+        failure_exceptions: tuple = (Exception,),
+    ):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.failure_exceptions = failure_exceptions
+
+        self.lock = threading.Lock()
+        self.calls = deque()
+        self.state = self.CLOSED
+        self.opened_at = None
+        self.trial_running = False
+        self.times_opened = 0
+        self.rejected_calls = 0
+
+    def call(self, function, *args, **kwargs):
+        self._before_call()
+        started = time.monotonic()
+        try:
+            result = function(*args, **kwargs)
+        except self.failure_exceptions:
+            self._after_call(False, time.monotonic() - started)
+            raise
+        except BaseException:
+            self._after_call(True, time.monotonic() - started)
+            raise
+        self._after_call(True, time.monotonic() - started)
+        return result
+
+    async def call_async(self, function, *args, **kwargs):
+        """call() for a coroutine function."""
+        self._before_call()
+        started = time.monotonic()
+        try:
+            result = await function(*args, **kwargs)
+        except self.failure_exceptions:
+            self._after_call(False, time.monotonic() - started)
+            raise
+        except BaseException:
+            self._after_call(True, time.monotonic() - started)
+            raise
+        self._after_call(True, time.monotonic() - started)
+        return result
+
+    def _before_call(self) -> None:
+        with self.lock:
+            if self.state == self.CLOSED:
+                return
+            if (
+                self.state == self.OPEN
+                and time.monotonic() - self.opened_at >= self.open_seconds
+            ):
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self.trial_running:
+                self.trial_running = True
+                return
+            self.rejected_calls += 1
+            raise CircuitOpenError(f"Circuit breaker '{self.name}' is open.")
+
+    def _after_call(self, success: bool, duration: float) -> None:
+        now = time.monotonic()
+        slow = duration >= self.slow_call_seconds
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.trial_running = False
+                if success and not slow:
+                    self.state = self.CLOSED
+                    self.calls.clear()
+                else:
+                    self._open(now)
+                return
+
+            self.calls.append((now, success, slow))
+            self._trim(now)
+            if self.state == self.CLOSED and len(self.calls) >= self.min_calls:
+                failures = sum(1 for _, ok, _ in self.calls if not ok)
+                slow_calls = sum(1 for _, _, is_slow in self.calls if is_slow)
+                if (
+                    failures / len(self.calls) >= self.failure_rate
+                    or slow_calls / len(self.calls) >= self.slow_call_rate
+                ):
+                    self._open(now)
+
+    def _open(self, now: float) -> None:
+        self.state = self.OPEN
+        self.opened_at = now
+        self.times_opened += 1
+
+    def _trim(self, now: float) -> None:
+        while self.calls and now - self.calls[0][0] > self.window:
+            self.calls.popleft()
+
+    @property
+    def is_open(self) -> bool:
+        with self.lock:
+            return self.state != self.CLOSED
+
+    def reset(self) -> None:
+        with self.lock:
+            self.calls.clear()
+            self.state = self.CLOSED
+            self.opened_at = None
+            self.trial_running = False
+
+    def stats(self) -> dict:
+        with self.lock:
+            self._trim(time.monotonic())
+            calls = len(self.calls)
+            failures = sum(1 for _, ok, _ in self.calls if not ok)
+            slow_calls = sum(1 for _, _, is_slow in self.calls if is_slow)
+            return {
+                "state": self.state,
+                "window_calls": calls,
+                "window_failure_rate": round(failures / calls, 4) if calls else None,
+                "window_slow_call_rate": (
+                    round(slow_calls / calls, 4) if calls else None
+                ),
+                "times_opened": self.times_opened,
+                "rejected_calls": self.rejected_calls,
+            }
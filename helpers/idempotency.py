@@ -0,0 +1,166 @@
+"""
+Idempotency-Key support for POST handlers.
+
+A client that retries a request sends the same ``Idempotency-Key``
+header. The first response (anything but a server error) is stored in
+the ``idempotency`` cache for IDEMPOTENCY_KEY_TTL seconds together with
+a fingerprint of the request, and retries get that response back
+without running the handler again, so a retried borrow, return or
+renewal does not open another Stripe session. Keys are scoped to the
+user; requests of anonymous users have no scope to share and are
+handled as if they had no key. A key reused for a different request is
+answered with 422, a retry that arrives while the first request is
+still running with 409.
+"""
+
+import hashlib
+import json
+import logging
+from functools import wraps
+from inspect import iscoroutinefunction
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from redis.exceptions import RedisError
+from rest_framework import status
+from rest_framework.response import Response
+
+logger = logging.getLogger(__name__)
+
+CACHE_ALIAS = "idempotency"
+HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+LOCK_TIMEOUT = 60
+
+
+def _cache():
+    return caches[CACHE_ALIAS]
+
+
+def request_fingerprint(request, view_kwargs: dict) -> str:
+    data = request.data
+    if hasattr(data, "lists"):
+        data = dict(data.lists())
+    payload = json.dumps(
+        [request.method, request.path, view_kwargs, data],
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _begin(request, view_kwargs: dict):
+    """
+    Returns ``(response, state)``: a response to answer with right away
+    (a replay or an error), or the state _finish() needs after the
+    handler ran. Both are None without the header or when the cache is
+    unavailable or the user is anonymous.
+    """
+    key = request.headers.get(HEADER)
+    if key is None or not request.user.is_authenticated:
+        return None, None
+    if not key or len(key) > MAX_KEY_LENGTH:
+        return (
+            Response(
+                {"detail": f"{HEADER} must be 1 to {MAX_KEY_LENGTH} characters."},
+                status=status.HTTP_400_BAD_REQUEST,
+            ),
+            None,
+        )
+
+    digest = hashlib.sha256(key.encode()).hexdigest()
+    cache_key = f"idempotency:{request.user.pk}:{digest}"
+    fingerprint = request_fingerprint(request, view_kwargs)
+    try:
+        stored = _cache().get(cache_key)
+        if stored is None:
+            if _cache().add(f"{cache_key}:lock", 1, timeout=LOCK_TIMEOUT):
+                return None, (cache_key, fingerprint)
+            stored = _cache().get(cache_key)
+    except RedisError:
+        logger.warning("Idempotency cache is unavailable", exc_info=True)
+        return None, None
+
+    if stored is None:
+        return (
+            Response(
+                {"detail": f"A request with this {HEADER} is in progress."},
+                status=status.HTTP_409_CONFLICT,
+            ),
+            None,
+        )
+    if stored["fingerprint"] != fingerprint:
+        return (
+            Response(
+                {"detail": f"This {HEADER} was used for a different request."},
+                status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            ),
+            None,
+        )
+    return (
+        Response(
+            stored["data"],
+            status=stored["status"],
+            headers={"Idempotent-Replayed": "true"},
+        ),
+        None,
+    )
+
+
+def _finish(state, response) -> None:
+    cache_key, fingerprint = state
+    try:
+        if response is not None and response.status_code < 500:
+            _cache().set(
+                cache_key,
+                {
+                    "fingerprint": fingerprint,
+                    "status": response.status_code,
+                    "data": response.data,
+                },
+                timeout=settings.IDEMPOTENCY_KEY_TTL,
+            )
+        _cache().delete(f"{cache_key}:lock")
+    except RedisError:
+        logger.warning("Idempotency cache is unavailable", exc_info=True)
+
+
+def idempotent(handler):
+    """Make a (sync or async) APIView handler honour Idempotency-Key."""
+
+    if iscoroutinefunction(handler):
+
+        @wraps(handler)
+        async def async_wrapper(view, request, *args, **kwargs):
+            response, state = await sync_to_async(_begin)(request, kwargs)
+            if response is not None:
+                return response
+            if state is None:
+                return await handler(view, request, *args, **kwargs)
+
+            response = None
+            try:
+                response = await handler(view, request, *args, **kwargs)
+                return response
+            finally:
+                await sync_to_async(_finish)(state, response)
+
+        return async_wrapper
+
+    @wraps(handler)
+    def wrapper(view, request, *args, **kwargs):
+        response, state = _begin(request, kwargs)
+        if response is not None:
+            return response
+        if state is None:
+            return handler(view, request, *args, **kwargs)
+
+        response = None
+        try:
+            response = handler(view, request, *args, **kwargs)
+            return response
+        finally:
+            _finish(state, response)
+
+    return wrapper
@@ -0,0 +1,140 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from collections import namedtuple
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination
+from rest_framework.utils.urls import replace_query_param
+
+KeysetCursor = namedtuple("KeysetCursor", ["position", "reverse"])
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Cursor pagination keyed on the whole ordering tuple.
+
+    DRF's CursorPagination stores only the first ordering field in the
+    cursor and walks ties with an OFFSET. Here the cursor keeps the value
+    of every ordering field, so each page is a single index range scan
+    however deep it is. The last ordering field must be unique (``id``)
+    and none of the fields may be NULL.
+    """
+
+    page_size = 20
+    page_size_query_param = "page_size"
+    max_page_size = 100
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        reverse = self.cursor is not None and self.cursor.reverse
+
+        if reverse:
+            queryset = queryset.order_by(*self._reverse_ordering(self.ordering))
+        else:
+            queryset = queryset.order_by(*self.ordering)
+
+        if self.cursor is not None:
+            queryset = queryset.filter(self._seek_filter(self.cursor))
+
+        results = list(queryset[: self.page_size + 1])
+        has_following = len(results) > self.page_size
+        self.page = results[: self.page_size]
+
+        if reverse:
+            self.page.reverse()
+            self.has_next = True
+            self.has_previous = has_following
+        else:
+            self.has_next = has_following
+            self.has_previous = self.cursor is not None
+
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(
+            KeysetCursor(position=self._get_position(self.page[-1]), reverse=False)
+        )
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(
+            KeysetCursor(position=self._get_position(self.page[0]), reverse=True)
+        )
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+
+        try:
+            tokens = json.loads(urlsafe_b64decode(encoded.encode("ascii")))
+            position = tokens["p"]
+            reverse = bool(tokens.get("r", 0))
+        except (BinasciiError, KeyError, TypeError, UnicodeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+        if not isinstance(position, list) or len(position) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+
+        return KeysetCursor(position=position, reverse=reverse)
+
+    def encode_cursor(self, cursor):
+        tokens = {"p": cursor.position}
+        if cursor.reverse:
+            tokens["r"] = 1
+
+        payload = json.dumps(tokens, cls=DjangoJSONEncoder, separators=(",", ":"))
+        encoded = urlsafe_b64encode(payload.encode("ascii")).decode("ascii")
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def _get_position(self, instance):
+        position = []
+        for field in self.ordering:
+            field_name = field.lstrip("-")
+            if isinstance(instance, dict):
+                position.append(instance[field_name])
+            else:
+                position.append(getattr(instance, field_name))
+        return json.loads(json.dumps(position, cls=DjangoJSONEncoder))
+
+    @staticmethod
+    def _reverse_ordering(ordering):
+        return tuple(
+            field[1:] if field.startswith("-") else f"-{field}" for field in ordering
+        )
+
+    def _seek_filter(self, cursor):
+        """
+        Build ``(f1, f2, ..., fn) > (v1, v2, ..., vn)`` as nested ORs,
+        led by a plain range on the first field so the planner can
+        start an index scan right at the cursor.
+        """
+        fields = [
+            (field.lstrip("-"), field.startswith("-") != cursor.reverse)
+            for field in self.ordering
+        ]
+
+        condition = None
+        for (name, descending), value in reversed(list(zip(fields, cursor.position))):
+            after = Q(**{f"{name}__{'lt' if descending else 'gt'}": value})
+            if condition is None:
+                condition = after
+            else:
+                condition = after | (Q(**{name: value}) & condition)
+
+        first_name, first_descending = fields[0]
+        first_lookup = f"{first_name}__{'lte' if first_descending else 'gte'}"
+        return Q(**{first_lookup: cursor.position[0]}) & condition
@@ -0,0 +1,380 @@
+"""
+Checkout gateways behind helpers.stripe_helper.
+
+The backend is selected with the PAYMENT_GATEWAY setting, the same way
+CACHES selects a cache backend::
+
+    PAYMENT_GATEWAY = {
+        "BACKEND": "helpers.payment_gateway.InMemoryGateway",
+        "OPTIONS": {"latency": 0.2, "failure_rate": 0.05},
+    }
+
+StripeGateway talks to Stripe. InMemoryGateway is a local stand-in that
+returns Stripe-compatible session objects, so borrow/return/renew can be
+load-tested without the network. Every operation has an ``a``-prefixed
+coroutine twin for the async views.
+"""
+
+import asyncio
+import logging
+import random
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import requests
+import stripe
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from requests.adapters import HTTPAdapter
+
+from helpers.circuit_breaker import CircuitBreaker
+from helpers.rate_limit import TokenBucket, backoff_delay
+
+logger = logging.getLogger(__name__)
+
+SESSION_LIFETIME = 24 * 60 * 60
+
+
+class PaymentGateway(ABC):
+    """
+    Checkout session operations used by helpers.stripe_helper. A backend
+    implements create_session and retrieve_session, the rest has defaults.
+    """
+
+    def __init__(self, max_workers: int = 8, **options):
+        self.max_workers = max_workers
+        self.options = options
+
+    @abstractmethod
+    def create_session(
+        self,
+        line_items: list,
+        success_url: str,
+        cancel_url: str,
+        idempotency_key: str = None,
+    ):
+        """
+        Create a checkout session for ``line_items`` (Stripe's format) and
+        return an object with Stripe's ``checkout.Session`` attributes.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def retrieve_session(self, session_id: str):
+        raise NotImplementedError
+
+    async def acreate_session(self, *args, **kwargs):
+        return await sync_to_async(self.create_session, thread_sensitive=False)(
+            *args, **kwargs
+        )
+
+    async def aretrieve_session(self, session_id: str):
+        return await sync_to_async(self.retrieve_session, thread_sensitive=False)(
+            session_id
+        )
+
+    def retrieve_sessions(self, session_ids) -> dict:
+        """
+        Retrieve many sessions on a pool of ``max_workers`` threads.
+        Returns ``{session_id: session}``, a failed lookup maps to the
+        exception it raised.
+        """
+
+        def retrieve(session_id):
+            try:
+                return self.retrieve_session(session_id)
+            except Exception as e:
+                return e
+
+        session_ids = list(session_ids)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return dict(zip(session_ids, executor.map(retrieve, session_ids)))
+
+
+class LoopLocalAIOHTTPClient(stripe.AIOHTTPClient):
+    """
+    Stripe's aiohttp client with one aiohttp session per event loop, an
+    aiohttp session only works on the loop it was created on. Under ASGI
+    every request shares the server loop and its connection pool; under
+    WSGI each async_to_sync call runs on a loop of its own, whose session
+    is closed when asyncio.run() shuts the loop's async generators down.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # {loop: (session, async generator holding it open)}
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    @property
+    def _session(self):
+        session, _ = self._sessions[asyncio.get_running_loop()]
+        return session
+
+    async def _hold_session(self, loop):
+        with self._lock:
+            self._cached_session = None
+            session = super()._session
+        try:
+            yield session
+        finally:
+            with self._lock:
+                if self._sessions.get(loop, (None,))[0] is session:
+                    del self._sessions[loop]
+            await session.close()
+
+    async def request_stream_async(self, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        session, _ = self._sessions.get(loop, (None, None))
+        if session is None or session.closed:
+            with self._lock:
+                # Loops closed without asyncio.run() never finalize theirs.
+                for stale in [loop for loop in self._sessions if loop.is_closed()]:
+                    del self._sessions[stale]
+            holder = self._hold_session(loop)
+            self._sessions[loop] = (await anext(holder), holder)
+        return await super().request_stream_async(*args, **kwargs)
+
+
+class StripeGateway(PaymentGateway):
+    """
+    Calls Stripe over one pooled keep-alive HTTP session with explicit
+    timeouts. Calls are paced by a token bucket of
+    ``max_requests_per_second`` (Stripe allows 100 in live mode and 25 in
+    test mode) and 429 responses are retried with jittered backoff. The
+    async operations go through LoopLocalAIOHTTPClient, whose connection
+    pool belongs to the event loop of the ASGI server.
+    """
+
+    def __init__(
+        self,
+        timeout: float = 10,
+        max_requests_per_second: float = 25,
+        max_retries: int = 5,
+        **options,
+    ):
+        super().__init__(**options)
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(max_requests_per_second)
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+        session.mount("https://", adapter)
+        stripe.default_http_client = stripe.RequestsClient(
+            timeout=timeout,
+            session=session,
+            async_fallback_client=LoopLocalAIOHTTPClient(
+                timeout=aiohttp.ClientTimeout(total=timeout)
+            ),
+        )
+
+    def _request(self, method, *args, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                return method(*args, **kwargs)
+            except stripe.error.RateLimitError:
+                if attempt == self.max_retries:
+                    raise
+                delay = backoff_delay(attempt)
+                logger.warning("Stripe rate limit hit, retrying in %.2fs", delay)
+                time.sleep(delay)
+
+    async def _arequest(self, method, *args, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire_async()
+            try:
+                return await method(*args, **kwargs)
+            except stripe.error.RateLimitError:
+                if attempt == self.max_retries:
+                    raise
+                delay = backoff_delay(attempt)
+                logger.warning("Stripe rate limit hit, retrying in %.2fs", delay)
+                await asyncio.sleep(delay)
+
+    @staticmethod
+    def _session_params(line_items, success_url, cancel_url, idempotency_key):
+        return {
+            "payment_method_types": ["card"],
+            "line_items": line_items,
+            "mode": "payment",
+            "success_url": success_url,
+            "cancel_url": cancel_url,
+            "idempotency_key": idempotency_key,
+        }
+
+    def create_session(
+        self,
+        line_items: list,
+        success_url: str,
+        cancel_url: str,
+        idempotency_key: str = None,
+    ):
+        return self._request(
+            stripe.checkout.Session.create,
+            **self._session_params(
+                line_items, success_url, cancel_url, idempotency_key
+            ),
+        )
+
+    def retrieve_session(self, session_id: str):
+        return self._request(stripe.checkout.Session.retrieve, session_id)
+
+    async def acreate_session(
+        self,
+        line_items: list,
+        success_url: str,
+        cancel_url: str,
+        idempotency_key: str = None,
+    ):
+        return await self._arequest(
+            stripe.checkout.Session.create_async,
+            **self._session_params(
+                line_items, success_url, cancel_url, idempotency_key
+            ),
+        )
+
+    async def aretrieve_session(self, session_id: str):
+        return await self._arequest(stripe.checkout.Session.retrieve_async, session_id)
+
+
+class InMemoryGateway(PaymentGateway):
+    """
+    Keeps sessions in process memory. ``latency`` (seconds) is added to
+    every call and ``failure_rate`` (0..1) of the calls raise Stripe's
+    APIConnectionError. complete_session/expire_session move a session
+    the way a customer or Stripe would.
+    """
+
+    _sessions = {}
+    _idempotency_keys = {}
+    _lock = threading.Lock()
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0, **options):
+        super().__init__(**options)
+        self.latency = latency
+        self.failure_rate = failure_rate
+
+    def _call(self):
+        if self.latency:
+            time.sleep(self.latency)
+        self._inject_failure()
+
+    async def _acall(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self._inject_failure()
+
+    def _inject_failure(self):
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise stripe.error.APIConnectionError("Injected gateway failure.")
+
+    def create_session(self, *args, **kwargs):
+        self._call()
+        return self._create_session(*args, **kwargs)
+
+    def retrieve_session(self, session_id: str):
+        self._call()
+        return self._retrieve_session(session_id)
+
+    async def acreate_session(self, *args, **kwargs):
+        await self._acall()
+        return self._create_session(*args, **kwargs)
+
+    async def aretrieve_session(self, session_id: str):
+        await self._acall()
+        return self._retrieve_session(session_id)
+
+    def _create_session(
+        self,
+        line_items: list,
+        success_url: str,
+        cancel_url: str,
+        idempotency_key: str = None,
+    ):
+        with self._lock:
+            if idempotency_key in self._idempotency_keys:
+                return self._sessions[self._idempotency_keys[idempotency_key]]
+
+            session_id = f"cs_test_{uuid.uuid4().hex}"
+            session = stripe.checkout.Session.construct_from(
+                {
+                    "id": session_id,
+                    "object": "checkout.session",
+                    "url": f"https://checkout.stripe.com/c/pay/{session_id}",
+                    "status": "open",
+                    "payment_status": "unpaid",
+                    "amount_total": sum(
+                        item["price_data"]["unit_amount"] * item.get("quantity", 1)
+                        for item in line_items
+                    ),
+                    "expires_at": int(time.time()) + SESSION_LIFETIME,
+                    "success_url": success_url,
+                    "cancel_url": cancel_url,
+                },
+                None,
+            )
+            self._sessions[session_id] = session
+            if idempotency_key:
+                self._idempotency_keys[idempotency_key] = session_id
+        return session
+
+    def _retrieve_session(self, session_id: str):
+        try:
+            return self._sessions[session_id]
+        except KeyError:
+            raise stripe.error.InvalidRequestError(
+                f"No such checkout.session: '{session_id}'", "id"
+            )
+
+    def complete_session(self, session_id: str) -> None:
+        session = self._sessions[session_id]
+        session.status = "complete"
+        session.payment_status = "paid"
+
+    def expire_session(self, session_id: str) -> None:
+        session = self._sessions[session_id]
+        session.status = "expired"
+        session.expires_at = int(time.time())
+
+    @classmethod
+    def reset(cls) -> None:
+        with cls._lock:
+            cls._sessions.clear()
+            cls._idempotency_keys.clear()
+
+
+_gateway = None
+
+# Opens when the gateway keeps failing or answering slowly, see
+# helpers.stripe_helper for the calls it guards.
+gateway_breaker = CircuitBreaker(
+    "payment_gateway",
+    failure_exceptions=(
+        stripe.error.APIConnectionError,
+        stripe.error.APIError,
+        stripe.error.RateLimitError,
+    ),
+)
+
+
+def get_payment_gateway() -> PaymentGateway:
+    global _gateway
+    if _gateway is None:
+        config = settings.PAYMENT_GATEWAY
+        _gateway = import_string(config["BACKEND"])(**config.get("OPTIONS", {}))
+    return _gateway
+
+
+@receiver(setting_changed)
+def reset_payment_gateway(setting, **kwargs):
+    global _gateway
+    if setting == "PAYMENT_GATEWAY":
+        _gateway = None
@@ -0,0 +1,63 @@
+import asyncio
+import random
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: ``rate`` tokens per second with bursts of up
+    to ``capacity`` tokens. The limit is per process.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens: float = 1) -> float:
+        """Take ``tokens``, sleeping until they are available. Returns the wait."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill(time.monotonic())
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return waited
+                delay = (tokens - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    async def acquire_async(self, tokens: float = 1) -> float:
+        """acquire() that waits with asyncio.sleep instead of blocking."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill(time.monotonic())
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return waited
+                delay = (tokens - self.tokens) / self.rate
+            await asyncio.sleep(delay)
+            waited += delay
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 30.0) -> float:
+    """Exponential backoff with full jitter for the ``attempt``-th retry."""
+    return random.uniform(0, min(cap, base * 2**attempt))
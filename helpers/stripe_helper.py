@@ -1,14 +1,23 @@
 import os
+from contextlib import contextmanager
+from datetime import datetime, timezone as dt_timezone
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, DateTimeField, F, Value, When
 from django.http import HttpRequest
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework.response import Response
 from django.core.exceptions import ValidationError
 
 import stripe
 
 from borrowings.models import Borrowing
-from payment.models import Payment, STATUS_CHOICES, TYPE_CHOICES
+from helpers.circuit_breaker import CircuitOpenError
+from helpers.payment_gateway import gateway_breaker, get_payment_gateway
+from payment.models import OutboxMessage, Payment, STATUS_CHOICES, TYPE_CHOICES
 from rest_framework.exceptions import APIException
 from rest_framework import status
 
@@ -22,37 +31,116 @@ class StripePaymentException(APIException):
     default_code = "stripe_payment_error"
 
 
-def create_stripe_session(request, amount, quantity=1, currency="usd"):
+class PaymentGatewayUnavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Payments are temporarily unavailable. Please try again later."
+    default_code = "payment_gateway_unavailable"
+
+
+def get_stripe_redirect_urls(request: HttpRequest) -> dict:
+    return {
+        "success_url": (
+            request.build_absolute_uri(reverse("borrowings:stripe-success"))
+            + "?session_id={CHECKOUT_SESSION_ID}"
+        ),
+        "cancel_url": (
+            request.build_absolute_uri(reverse("borrowings:stripe-cancel"))
+            + "?session_id={CHECKOUT_SESSION_ID}"
+        ),
+    }
+
+
+def session_expires_at(session) -> datetime | None:
+    """Deadline of a Stripe Checkout session (``expires_at`` is a unix time)."""
+    expires_at = getattr(session, "expires_at", None)
+    if expires_at is None:
+        return None
+    return datetime.fromtimestamp(expires_at, tz=dt_timezone.utc)
+
+
+def create_stripe_session(
+    request,
+    amount,
+    quantity=1,
+    currency="usd",
+    redirect_urls=None,
+    idempotency_key=None,
+    line_items=None,
+):
+    """
+    ``line_items`` is a list of ``{"name", "amount", "quantity"}`` dicts,
+    one per product. Without it the session has a single line item.
+    """
+    with stripe_errors():
+        return gateway_breaker.call(
+            get_payment_gateway().create_session,
+            **_session_params(
+                request, amount, quantity, currency, redirect_urls, line_items
+            ),
+            idempotency_key=idempotency_key,
+        )
 
-    success_url = (
-        request.build_absolute_uri(reverse("borrowings:stripe-success"))
-        + "?session_id={CHECKOUT_SESSION_ID}"
-    )
-    cancel_url = (
-        request.build_absolute_uri(reverse("borrowings:stripe-cancel"))
-        + "?session_id={CHECKOUT_SESSION_ID}"
-    )
 
-    try:
-        session = stripe.checkout.Session.create(
-            payment_method_types=["card"],
-            line_items=[
-                {
-                    "price_data": {
-                        "currency": currency,
-                        "product_data": {
-                            "name": "Payment for the book borrowing",
-                        },
-                        "unit_amount": amount,
-                    },
-                    "quantity": quantity,
-                }
-            ],
-            mode="payment",
-            success_url=success_url,
-            cancel_url=cancel_url,
+async def acreate_stripe_session(
+    request,
+    amount,
+    quantity=1,
+    currency="usd",
+    redirect_urls=None,
+    idempotency_key=None,
+    line_items=None,
+):
+    """create_stripe_session() for async views."""
+    with stripe_errors():
+        return await gateway_breaker.call_async(
+            get_payment_gateway().acreate_session,
+            **_session_params(
+                request, amount, quantity, currency, redirect_urls, line_items
+            ),
+            idempotency_key=idempotency_key,
         )
-        return session
+
+
+def _session_params(request, amount, quantity, currency, redirect_urls, line_items):
+    if redirect_urls is None:
+        redirect_urls = get_stripe_redirect_urls(request)
+
+    if line_items is None:
+        line_items = [
+            {
+                "name": "Payment for the book borrowing",
+                "amount": amount,
+                "quantity": quantity,
+            }
+        ]
+
+    return {
+        "line_items": [
+            {
+                "price_data": {
+                    "currency": currency,
+                    "product_data": {
+                        "name": item["name"],
+                    },
+                    "unit_amount": item["amount"],
+                },
+                "quantity": item.get("quantity", 1),
+            }
+            for item in line_items
+        ],
+        "success_url": redirect_urls["success_url"],
+        "cancel_url": redirect_urls["cancel_url"],
+    }
+
+
+@contextmanager
+def stripe_errors():
+    """Turn gateway errors into API errors."""
+    try:
+        yield
+
+    except CircuitOpenError:
+        raise PaymentGatewayUnavailable()
 
     except stripe.error.CardError as e:
         raise ValidationError(
@@ -114,9 +202,13 @@ def create_payment(
             session_url=session.url,
             session_id=session.id,
             money=amount / 100,
+            expires_at=session_expires_at(session),
         )
         return payment
 
+    except PaymentGatewayUnavailable:
+        raise
+
     except StripePaymentException as e:
         raise StripePaymentException(f"Payment failed: {str(e)}")
 
@@ -124,18 +216,188 @@ def create_payment(
         raise ValidationError({"detail": f"An unexpected error occurred: {str(e)}"})
 
 
+def create_pending_payment(
+    request: HttpRequest,
+    borrowing: Borrowing,
+    amount: int,
+    type_payment: str,
+    notification: str = None,
+    quantity: int = 1,
+    line_items: list = None,
+):
+    """
+    Record the payment without a Stripe session and queue the session
+    creation (and the notification with the payment link) in the outbox.
+    Must be called inside the transaction that creates the borrowing.
+    ``line_items`` (see create_stripe_session) bills several books in
+    one session.
+    """
+    return create_pending_payments(
+        request,
+        [(borrowing, amount, notification)],
+        type_payment,
+        quantity,
+        line_items=line_items,
+    )[0]
+
+
+def create_pending_payments(
+    request: HttpRequest,
+    entries,
+    type_payment: str,
+    quantity: int = 1,
+    line_items: list = None,
+) -> list:
+    """
+    Batch version of create_pending_payment: ``entries`` are
+    ``(borrowing, amount, notification)`` tuples, the payments and their
+    outbox messages are inserted with one statement each.
+    """
+    if type_payment not in dict(TYPE_CHOICES):
+        raise ValueError(
+            f"Invalid type value: {type_payment}."
+            f"Must be one of {list(TYPE_CHOICES)}"
+        )
+
+    payments = Payment.objects.bulk_create(
+        Payment(
+            status="S",
+            type=type_payment,
+            borrowing=borrowing,
+            money=amount / 100,
+        )
+        for borrowing, amount, _ in entries
+    )
+    redirect_urls = get_stripe_redirect_urls(request)
+    OutboxMessage.objects.bulk_create(
+        OutboxMessage(
+            kind="S",
+            payload={
+                "payment_id": payment.id,
+                "amount": amount,
+                "quantity": quantity,
+                "redirect_urls": redirect_urls,
+                "notification": notification,
+                "line_items": line_items,
+            },
+        )
+        for payment, (_, amount, notification) in zip(payments, entries)
+    )
+    return payments
+
+
+def open_payment_session(
+    payment: Payment, amount: int, quantity, redirect_urls, line_items=None
+):
+    """
+    Create the Stripe session of a SESSION_PENDING payment and move it to
+    PENDING. The idempotency key makes a retried outbox message reuse the
+    session created by a previous attempt.
+    """
+    session = create_stripe_session(
+        None,
+        amount,
+        quantity,
+        redirect_urls=redirect_urls,
+        idempotency_key=f"payment-{payment.id}-session",
+        line_items=line_items,
+    )
+    payment.transition(
+        "G",
+        session_url=session.url,
+        session_id=session.id,
+        expires_at=session_expires_at(session),
+    )
+    return payment
+
+
+async def aopen_payment_session(
+    payment: Payment, amount: int, quantity, redirect_urls, line_items=None
+):
+    """
+    open_payment_session() for async views. It shares the idempotency key
+    with the outbox message of the payment, so whichever of them runs
+    second gets the same session. The payment's outbox message is marked
+    processed together with the transition unless it still has a
+    notification to send.
+    """
+    session = await acreate_stripe_session(
+        None,
+        amount,
+        quantity,
+        redirect_urls=redirect_urls,
+        idempotency_key=f"payment-{payment.id}-session",
+        line_items=line_items,
+    )
+    await sync_to_async(_record_opened_session)(payment, session)
+    return payment
+
+
+@transaction.atomic
+def _record_opened_session(payment: Payment, session) -> None:
+    payment.transition(
+        "G",
+        session_url=session.url,
+        session_id=session.id,
+        expires_at=session_expires_at(session),
+    )
+    OutboxMessage.objects.filter(
+        kind="S",
+        processed_at__isnull=True,
+        payload__payment_id=payment.id,
+        payload__notification=None,
+    ).update(processed_at=timezone.now())
+
+
+def renewed_session_fields(payment: Payment, session) -> dict:
+    """Fields of a payment renewed with ``session``, the old one is kept."""
+    previous = payment.previous_session_ids
+    if payment.session_id:
+        previous = [*previous, payment.session_id]
+    return {
+        "session_url": session.url,
+        "session_id": session.id,
+        "expires_at": session_expires_at(session),
+        "previous_session_ids": previous,
+    }
+
+
 def renew_payment(request: HttpRequest, payment: Payment):
 
     try:
         amount = int(payment.money * 100)
         session = create_stripe_session(request, amount)
-        payment.session_url = session.url
-        payment.session_id = session.id
-        payment.status = "G"
-        payment.save()
+        # A concurrent renew that wins keeps its own session, the one
+        # created here is left to expire on Stripe's side.
+        payment.transition("G", **renewed_session_fields(payment, session))
 
         return payment
 
+    except PaymentGatewayUnavailable:
+        raise
+
+    except StripePaymentException as e:
+        raise StripePaymentException(f"Payment failed: {str(e)}")
+
+    except Exception as e:
+        raise ValidationError({"detail": f"An unexpected error occurred: {str(e)}"})
+
+
+async def arenew_payment(request: HttpRequest, payment: Payment):
+    """renew_payment() for async views."""
+
+    try:
+        amount = int(payment.money * 100)
+        session = await acreate_stripe_session(request, amount)
+        await sync_to_async(payment.transition)(
+            "G", **renewed_session_fields(payment, session)
+        )
+
+        return payment
+
+    except PaymentGatewayUnavailable:
+        raise
+
     except StripePaymentException as e:
         raise StripePaymentException(f"Payment failed: {str(e)}")
 
@@ -146,11 +408,12 @@ def renew_payment(request: HttpRequest, payment: Payment):
 def stripe_success_check(payment: Payment):
 
     try:
-        session = stripe.checkout.Session.retrieve(payment.session_id)
+        session = gateway_breaker.call(
+            get_payment_gateway().retrieve_session, payment.session_id
+        )
 
         if session.payment_status == "paid":
-            payment.status = "D"
-            payment.save()
+            payment.transition("D")
 
             return Response(
                 {"message": "Payment was successful."}, status=status.HTTP_200_OK
@@ -171,18 +434,99 @@ def stripe_success_check(payment: Payment):
 def stripe_expired_check(payment: Payment):
 
     try:
-        session = stripe.checkout.Session.retrieve(payment.session_id)
+        session = gateway_breaker.call(
+            get_payment_gateway().retrieve_session, payment.session_id
+        )
 
         if session.status == "expired":
-            payment.status = "E"
-            payment.save()
+            payment.transition("E")
 
             return Response(
                 {"message": "The session is expired."}, status=status.HTTP_200_OK
             )
 
+        # Remember the deadline, the session expires locally from now on.
+        payment.expires_at = session_expires_at(session)
+        Payment.objects.filter(
+            id=payment.id, status="G", session_id=payment.session_id
+        ).update(expires_at=payment.expires_at)
+
     except stripe.error.StripeError as e:
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     except Exception as e:
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+def stripe_expired_check_bulk(payments, chunk_size: int = 1000) -> dict:
+    """
+    Batch version of stripe_expired_check for PENDING payments: the
+    sessions are retrieved in parallel through the gateway's rate-limited
+    pool, expired ones mark their payments EXPIRED with one UPDATE per
+    chunk and the deadlines of the open ones are stored with another.
+    Both writes match the session that was checked, so a payment renewed
+    in the meantime keeps its new session untouched.
+    """
+    stats = {"checked": 0, "expired": 0, "failed": 0}
+    rows = (
+        payments.filter(status="G")
+        .exclude(session_id="")
+        .values_list("id", "session_id")
+    )
+    for chunk in _chunks(rows.iterator(chunk_size=chunk_size), chunk_size):
+        sessions = get_payment_gateway().retrieve_sessions(
+            session_id for _, session_id in chunk
+        )
+        expired, deadlines = {}, {}
+        for payment_id, session_id in chunk:
+            session = sessions[session_id]
+            if isinstance(session, Exception):
+                stats["failed"] += 1
+            elif session.status == "expired":
+                expired[payment_id] = session_id
+            else:
+                deadlines[payment_id] = (session_id, session_expires_at(session))
+
+        stats["checked"] += len(chunk)
+        stats["expired"] += Payment.objects.filter(
+            id__in=expired, session_id__in=expired.values()
+        ).set_status("E")
+        if deadlines:
+            Payment.objects.filter(
+                id__in=deadlines,
+                status="G",
+                session_id__in=[session_id for session_id, _ in deadlines.values()],
+            ).update(
+                expires_at=Case(
+                    *(
+                        When(session_id=session_id, then=Value(expires_at))
+                        for session_id, expires_at in deadlines.values()
+                    ),
+                    default=F("expires_at"),
+                    output_field=DateTimeField(),
+                )
+            )
+
+    return stats
+
+
+def _chunks(iterable, size: int):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def construct_webhook_event(payload: bytes, signature: str):
+    """
+    Verify the Stripe-Signature header of a webhook request against
+    STRIPE_WEBHOOK_SECRET. Raises ValueError for a malformed payload and
+    stripe.error.SignatureVerificationError for a bad signature.
+    """
+    return stripe.Webhook.construct_event(
+        payload, signature, settings.STRIPE_WEBHOOK_SECRET
+    )
@@ -1,8 +1,116 @@
+"""
+Telegram notifications.
+
+Messages are not sent from the code that produces them: enqueue_message()
+appends them to a Redis list and the deliver_telegram_messages Celery
+task drains it with drain_queue(). Draining holds a Redis lock, so one
+worker sends at a time and the token buckets below really pace every
+message against Telegram's limits (about 30 messages per second overall
+and 20 per minute to one group chat). A message being sent sits in a
+processing list, a drainer that dies leaves it there for the next one.
+"""
+
+import hashlib
+import json
+import logging
+import math
 import os
+import threading
+import time
 
+import redis
 import requests
-
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from dotenv import load_dotenv
+from redis.exceptions import RedisError
+from requests.adapters import HTTPAdapter
+
+from helpers.rate_limit import TokenBucket, backoff_delay
+
+logger = logging.getLogger(__name__)
+
+QUEUE_KEY = "telegram:queue"
+PROCESSING_KEY = "telegram:queue:processing"
+DRAIN_LOCK_KEY = "telegram:queue:lock"
+STATS_KEY = "telegram:stats"
+DEDUPE_KEY_PREFIX = "telegram:dedupe:"
+KICK_KEY = "telegram:queue:kick"
+MAX_ATTEMPTS = 8
+TELEGRAM_MESSAGE_LIMIT = 4096
+COALESCE_BATCH_SIZE = 200
+
+# Queue the message unless its dedupe key is set, in one step, so a
+# marker is never left behind for a message that was not queued.
+ENQUEUE_ONCE_SCRIPT = """
+if redis.call("SET", KEYS[1], 1, "NX", "EX", ARGV[1]) then
+    redis.call("RPUSH", KEYS[2], ARGV[2])
+    redis.call("HINCRBY", KEYS[3], "enqueued", 1)
+    return 1
+end
+redis.call("HINCRBY", KEYS[3], "deduplicated", 1)
+return 0
+"""
+
+_session = None
+_redis = None
+_buckets = {}
+_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """Keep-alive HTTP session shared by every TelegramHelper of the process."""
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            _session.mount("https://", HTTPAdapter(pool_maxsize=4, max_retries=0))
+        return _session
+
+
+def get_redis() -> redis.Redis:
+    global _redis
+    with _lock:
+        if _redis is None:
+            _redis = redis.Redis.from_url(settings.TELEGRAM_QUEUE_URL)
+        return _redis
+
+
+def _bucket(chat_id=None) -> TokenBucket:
+    """The chat's token bucket, or the global one without ``chat_id``."""
+    key = "global" if chat_id is None else f"chat:{chat_id}"
+    with _lock:
+        if key not in _buckets:
+            if chat_id is None:
+                _buckets[key] = TokenBucket(settings.TELEGRAM_MAX_RPS)
+            else:
+                _buckets[key] = TokenBucket(
+                    settings.TELEGRAM_CHAT_MESSAGES_PER_MINUTE / 60, capacity=1
+                )
+        return _buckets[key]
+
+
+@receiver(setting_changed)
+def reset_telegram_clients(setting, **kwargs):
+    global _redis
+    if setting == "TELEGRAM_QUEUE_URL":
+        _redis = None
+    elif setting in ("TELEGRAM_MAX_RPS", "TELEGRAM_CHAT_MESSAGES_PER_MINUTE"):
+        _buckets.clear()
+
+
+class TelegramDeliveryError(Exception):
+    """
+    Telegram did not take the message. ``retryable`` is False when
+    sending it again cannot help (a 4xx other than 429), ``retry_after``
+    is the wait Telegram asked for.
+    """
+
+    def __init__(self, message, retryable=True, retry_after=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
 
 
 class TelegramHelper:
@@ -17,18 +125,274 @@ class TelegramHelper:
         self.chat_id = os.getenv("TELEGRAM_CHAT_ID")
         self.api_url = f"https://api.telegram.org/bot{self.token}/sendMessage"
 
-    def send_message(self, message):
-        payload = {"chat_id": self.chat_id, "text": message}
+    def post(self, message, chat_id=None) -> dict:
+        """Send one message right away, raising TelegramDeliveryError."""
+        payload = {"chat_id": chat_id or self.chat_id, "text": message}
         try:
-            response = requests.post(self.api_url, data=payload)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.Timeout:
-            print("Error: timeout request")
-            return None
-        except requests.exceptions.HTTPError as http_err:
-            print(f"HTTP error occurred: {http_err}")
-            return None
+            response = get_session().post(
+                self.api_url,
+                data=payload,
+                timeout=(
+                    settings.TELEGRAM_CONNECT_TIMEOUT,
+                    settings.TELEGRAM_READ_TIMEOUT,
+                ),
+            )
         except requests.exceptions.RequestException as e:
-            print(f"Error sending message to Telegram: {e}")
+            raise TelegramDeliveryError(f"Telegram request failed: {e}")
+
+        if response.ok:
+            return response.json()
+
+        try:
+            retry_after = response.json().get("parameters", {}).get("retry_after")
+        except ValueError:
+            retry_after = None
+        raise TelegramDeliveryError(
+            f"Telegram answered {response.status_code}: {response.text[:200]}",
+            retryable=response.status_code == 429 or response.status_code >= 500,
+            retry_after=retry_after,
+        )
+
+    def send_message(self, message):
+        """Send one message right away, returns None when it failed."""
+        try:
+            return self.post(message)
+        except TelegramDeliveryError:
+            logger.warning("Telegram message was not sent", exc_info=True)
             return None
+
+    def enqueue_message(
+        self,
+        message,
+        dedupe_key: str = None,
+        dedupe_by_content: bool = False,
+        **meta,
+    ) -> bool:
+        """
+        Queue the message for deliver_telegram_messages. A message whose
+        ``dedupe_key`` (ex. the id of the outbox row that produced it) was
+        queued in the last TELEGRAM_DEDUPE_SECONDS is counted and skipped;
+        with ``dedupe_by_content`` the key is a hash of the chat and the
+        text. Without either every message is queued. ``meta`` is kept
+        with the message and handed back if it is dropped. Returns False
+        when the queue is unavailable.
+        """
+        if dedupe_key is None and dedupe_by_content:
+            dedupe_key = hashlib.sha1(f"{self.chat_id}:{message}".encode()).hexdigest()
+        item = {
+            "chat_id": self.chat_id,
+            "text": message,
+            "attempts": 0,
+            "queued_at": time.time(),
+            **meta,
+        }
+        try:
+            client = get_redis()
+            if dedupe_key is None:
+                pipe = client.pipeline()
+                pipe.rpush(QUEUE_KEY, json.dumps(item))
+                pipe.hincrby(STATS_KEY, "enqueued")
+                pipe.execute()
+            else:
+                client.register_script(ENQUEUE_ONCE_SCRIPT)(
+                    keys=[f"{DEDUPE_KEY_PREFIX}{dedupe_key}", QUEUE_KEY, STATS_KEY],
+                    args=[settings.TELEGRAM_DEDUPE_SECONDS, json.dumps(item)],
+                )
+        except RedisError:
+            logger.warning("Telegram queue is unavailable", exc_info=True)
+            return False
+        return True
+
+
+def pack_messages(entries, limit: int = TELEGRAM_MESSAGE_LIMIT):
+    """
+    Join ``(key, line)`` entries into as few messages as fit into
+    ``limit`` characters, yielding ``(keys, message)`` pairs.
+    """
+    keys, message = [], ""
+    for key, line in entries:
+        line = line[:limit]
+        if message and len(message) + len("\n\n") + len(line) > limit:
+            yield keys, message
+            keys, message = [], ""
+        keys.append(key)
+        message = f"{message}\n\n{line}" if message else line
+    if message:
+        yield keys, message
+
+
+def coalesce(items: list):
+    """
+    Merge queued messages into digests, one series per chat in the order
+    the chats first appear. Yields ``(chat_id, items, text)`` where
+    ``items`` are the queued messages the digest covers.
+    """
+    chats = {}
+    for item in items:
+        chats.setdefault(item["chat_id"], []).append(item)
+
+    for chat_id, chat_items in chats.items():
+        for digest_items, digest in pack_messages(
+            (item, item["text"]) for item in chat_items
+        ):
+            yield chat_id, digest_items, digest
+
+
+def drain_queue(
+    time_budget: float, on_drop=None, batch_size: int = COALESCE_BATCH_SIZE
+) -> dict:
+    """
+    Send queued messages for up to ``time_budget`` seconds, taking up to
+    ``batch_size`` of them at a time and sending them as digests (see
+    coalesce). A digest that fails with a retryable error goes back to
+    the head of the queue with the rest of its batch and draining stops,
+    ``retry_in`` in the result says when to resume. Messages of a digest
+    that cannot be sent or has used MAX_ATTEMPTS are dropped and passed
+    to ``on_drop``. Returns the counts of this run and the number of
+    messages still queued.
+    """
+    stats = {"sent": 0, "digests": 0, "retried": 0, "dropped": 0, "retry_in": None}
+    client = get_redis()
+    lock = client.lock(DRAIN_LOCK_KEY, timeout=time_budget + 60)
+    if not lock.acquire(blocking=False):
+        return {**stats, "remaining": client.llen(QUEUE_KEY), "skipped": True}
+
+    try:
+        client.delete(KICK_KEY)
+        while client.lmove(PROCESSING_KEY, QUEUE_KEY, "RIGHT", "LEFT"):
+            pass
+
+        helper = TelegramHelper()
+        deadline = time.monotonic() + time_budget
+        while stats["retry_in"] is None and time.monotonic() < deadline:
+            raws = []
+            while len(raws) < batch_size:
+                raw = client.lmove(QUEUE_KEY, PROCESSING_KEY, "LEFT", "RIGHT")
+                if raw is None:
+                    break
+                raws.append(raw)
+            if not raws:
+                break
+
+            items = [json.loads(raw) for raw in raws]
+            digests = list(coalesce(items))
+            for position, (chat_id, digest_items, text) in enumerate(digests):
+                outcome, retry_in = _send_digest(
+                    client, helper, chat_id, digest_items, text
+                )
+                stats[outcome] += len(digest_items)
+                if outcome == "sent":
+                    stats["digests"] += 1
+                elif outcome == "dropped" and on_drop:
+                    for item in digest_items:
+                        on_drop(item)
+                elif outcome == "retried":
+                    stats["retry_in"] = retry_in
+                    unsent = [
+                        item
+                        for _, later_items, _ in digests[position:]
+                        for item in later_items
+                    ]
+                    break
+            else:
+                unsent = []
+
+            pipe = client.pipeline()
+            if unsent:
+                pipe.lpush(QUEUE_KEY, *(json.dumps(item) for item in reversed(unsent)))
+            pipe.delete(PROCESSING_KEY)
+            pipe.execute()
+    finally:
+        lock.release()
+
+    stats["remaining"] = client.llen(QUEUE_KEY)
+    return stats
+
+
+def _send_digest(client, helper, chat_id, items, text) -> tuple:
+    """
+    Send one digest. Returns ``sent``, ``retried`` or ``dropped`` and,
+    for a failure, the wait before the next attempt.
+    """
+    _bucket().acquire()
+    _bucket(chat_id).acquire()
+    try:
+        helper.post(text, chat_id)
+    except TelegramDeliveryError as e:
+        attempts = max(item["attempts"] for item in items) + 1
+        outcome = "dropped"
+        if e.retryable and attempts < MAX_ATTEMPTS:
+            outcome = "retried"
+        for item in items:
+            item["attempts"] = attempts
+        logger.warning(
+            "Telegram digest of %s messages %s after %s attempts: %s",
+            len(items),
+            outcome,
+            attempts,
+            e,
+        )
+        client.hincrby(STATS_KEY, outcome, len(items))
+        return outcome, e.retry_after or backoff_delay(attempts)
+
+    latency = time.time() - min(item["queued_at"] for item in items)
+    pipe = client.pipeline()
+    pipe.hincrby(STATS_KEY, "sent", len(items))
+    pipe.hincrby(STATS_KEY, "digests")
+    pipe.hincrbyfloat(STATS_KEY, "flush_latency_total", latency)
+    pipe.hset(STATS_KEY, "flush_latency_last", latency)
+    pipe.execute()
+    return "sent", None
+
+
+def claim_delivery_kick(delay: float) -> bool:
+    """
+    True for the first producer that asks within ``delay`` seconds, so a
+    burst of messages schedules one coalescing drain instead of one per
+    message. The drain clears the claim when it starts.
+    """
+    try:
+        return bool(get_redis().set(KICK_KEY, 1, nx=True, ex=math.ceil(delay) + 1))
+    except RedisError:
+        return True
+
+
+def telegram_queue_stats() -> dict:
+    """
+    Buffer depth (``queued``), delivery counters and the flush latency,
+    the time the oldest message of a digest waited in the queue.
+    """
+    try:
+        client = get_redis()
+        counters = {
+            name.decode(): float(value)
+            for name, value in client.hgetall(STATS_KEY).items()
+        }
+        queued = client.llen(QUEUE_KEY)
+        in_flight = client.llen(PROCESSING_KEY)
+    except RedisError:
+        return {"available": False}
+
+    digests = counters.get("digests", 0)
+    return {
+        "available": True,
+        "queued": queued,
+        "in_flight": in_flight,
+        **{
+            name: int(counters.get(name, 0))
+            for name in (
+                "enqueued",
+                "deduplicated",
+                "sent",
+                "digests",
+                "retried",
+                "dropped",
+            )
+        },
+        "flush_latency_avg_seconds": (
+            round(counters["flush_latency_total"] / digests, 3) if digests else None
+        ),
+        "flush_latency_last_seconds": (
+            round(counters["flush_latency_last"], 3) if digests else None
+        ),
+    }
@@ -42,6 +42,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     "books",
     "rest_framework",
     "user",
@@ -96,6 +97,24 @@ DATABASES = {
     }
 }
 
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "catalog": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": os.getenv("CATALOG_CACHE_URL", "redis://redis:6379/1"),
+    },
+    "idempotency": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": os.getenv("IDEMPOTENCY_CACHE_URL", "redis://redis:6379/3"),
+    },
+}
+
+# Responses to requests with an Idempotency-Key header are replayed to
+# retries for this many seconds (see helpers.idempotency).
+IDEMPOTENCY_KEY_TTL = int(os.getenv("IDEMPOTENCY_KEY_TTL", str(24 * 60 * 60)))
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -168,9 +187,50 @@ STATIC_URL = "static/"
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
+# Checkout gateway, helpers.payment_gateway.InMemoryGateway runs without
+# Stripe (latency in seconds and failure rate are for load tests)
+PAYMENT_GATEWAY = {
+    "BACKEND": os.getenv(
+        "PAYMENT_GATEWAY_BACKEND", "helpers.payment_gateway.StripeGateway"
+    ),
+    "OPTIONS": {
+        "timeout": float(os.getenv("STRIPE_TIMEOUT", "10")),
+        "max_requests_per_second": float(os.getenv("STRIPE_MAX_RPS", "25")),
+        "max_workers": int(os.getenv("STRIPE_MAX_WORKERS", "8")),
+    },
+}
+if PAYMENT_GATEWAY["BACKEND"].endswith("InMemoryGateway"):
+    PAYMENT_GATEWAY["OPTIONS"] = {
+        "latency": float(os.getenv("PAYMENT_GATEWAY_LATENCY", "0")),
+        "failure_rate": float(os.getenv("PAYMENT_GATEWAY_FAILURE_RATE", "0")),
+        "max_workers": int(os.getenv("STRIPE_MAX_WORKERS", "8")),
+    }
+
+# Stripe webhook signing secret (whsec_...)
+STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
+
+# Telegram notifications go through a Redis queue drained by the
+# borrowings.tasks.deliver_telegram_messages task.
+TELEGRAM_QUEUE_URL = os.getenv("TELEGRAM_QUEUE_URL", "redis://redis:6379/2")
+TELEGRAM_CONNECT_TIMEOUT = float(os.getenv("TELEGRAM_CONNECT_TIMEOUT", "3"))
+TELEGRAM_READ_TIMEOUT = float(os.getenv("TELEGRAM_READ_TIMEOUT", "10"))
+TELEGRAM_MAX_RPS = float(os.getenv("TELEGRAM_MAX_RPS", "25"))
+TELEGRAM_CHAT_MESSAGES_PER_MINUTE = float(
+    os.getenv("TELEGRAM_CHAT_MESSAGES_PER_MINUTE", "20")
+)
+# Messages queued within the window are sent as one digest per chat,
+# a message queued again from the same source (outbox row, reminder)
+# within TELEGRAM_DEDUPE_SECONDS is sent once.
+TELEGRAM_COALESCE_SECONDS = float(os.getenv("TELEGRAM_COALESCE_SECONDS", "2"))
+TELEGRAM_DEDUPE_SECONDS = int(os.getenv("TELEGRAM_DEDUPE_SECONDS", "60"))
+
 # Celery Configuration Options
 CELERY_BROKER_URL = "redis://redis:6379/0"
 CELERY_RESULT_BACKEND = "redis://redis:6379/0"
 CELERY_TIMEZONE = "Europe/Bratislava"
 CELERY_TASK_TRACK_STARTED = True
 CELERY_TASK_TIME_LIMIT = 30 * 60
+# Redis redelivers a message that is not acknowledged within the
+# visibility timeout, ETA tasks included. Due reminders are queued at
+# most borrowings.tasks.REMINDER_ETA_HORIZON (2 days) ahead.
+CELERY_BROKER_TRANSPORT_OPTIONS = {"visibility_timeout": 3 * 24 * 60 * 60}
@@ -19,6 +19,8 @@ from django.contrib import admin
 from django.urls import path, include
 from drf_spectacular.views import SpectacularSwaggerView, SpectacularAPIView
 
+from library_service_api.views import MetricsView
+
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("api/v1/schema/", SpectacularAPIView.as_view(), name="schema"),
@@ -31,4 +33,5 @@ urlpatterns = [
     path("api/v1/users/", include("user.urls", namespace="user")),
     path("api/v1/borrowings-service/", include("borrowings.urls"), name="borrowing"),
     path("api/v1/payment-service/", include("payment.urls"), name="payment"),
+    path("api/v1/metrics/", MetricsView.as_view(), name="metrics"),
 ]
@@ -0,0 +1,22 @@
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from books.cache import catalog_cache_stats
+from helpers.payment_gateway import gateway_breaker
+from helpers.telegram_helper import telegram_queue_stats
+
+
+class MetricsView(APIView):
+    """Runtime counters of the service for admin users"""
+
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request):
+        return Response(
+            {
+                "catalog_cache": catalog_cache_stats(),
+                "payment_gateway_breaker": gateway_breaker.stats(),
+                "telegram": telegram_queue_stats(),
+            }
+        )
@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from payment.models import Payment
+from payment.models import OutboxMessage, Payment, StripeEvent, UserPaymentSummary
 
 
 class PaymentAdmin(admin.ModelAdmin):
@@ -39,3 +39,30 @@ class PaymentAdmin(admin.ModelAdmin):
 
 
 admin.site.register(Payment, PaymentAdmin)
+
+
+class OutboxMessageAdmin(admin.ModelAdmin):
+    list_display = ("id", "kind", "created_at", "processed_at", "attempts")
+    list_filter = ("kind", "processed_at")
+    readonly_fields = ("created_at",)
+
+
+admin.site.register(OutboxMessage, OutboxMessageAdmin)
+
+
+class UserPaymentSummaryAdmin(admin.ModelAdmin):
+    list_display = ("user", "outstanding")
+    readonly_fields = ("user", "outstanding")
+
+
+admin.site.register(UserPaymentSummary, UserPaymentSummaryAdmin)
+
+
+class StripeEventAdmin(admin.ModelAdmin):
+    list_display = ("event_id", "type", "session_id", "received_at", "processed_at")
+    list_filter = ("type", "processed_at")
+    search_fields = ("event_id", "session_id")
+    readonly_fields = ("received_at",)
+
+
+admin.site.register(StripeEvent, StripeEventAdmin)
@@ -0,0 +1,136 @@
+import asyncio
+import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.test import AsyncClient, Client, override_settings
+from django.urls import reverse
+from rest_framework_simplejwt.tokens import AccessToken
+
+from books.models import Book
+from borrowings.models import Borrowing
+from payment.models import Payment
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures how many payment renewals per second the renew view "
+        "serves on a pool of request threads (WSGI) and on one event loop "
+        "(ASGI), at the same concurrency, against a gateway that answers "
+        "with a fixed latency"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--payments", type=int, default=200)
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=50,
+            help="Requests in flight: request threads for WSGI, "
+            "outstanding requests on the event loop for ASGI.",
+        )
+        parser.add_argument(
+            "--latency",
+            type=float,
+            default=0.2,
+            help="Seconds every InMemoryGateway call takes.",
+        )
+
+    def handle(self, *args, **options):
+        user = get_user_model().objects.create_user(
+            email=f"payment-benchmark-{time.time()}@example.com", password=None
+        )
+        book = Book.objects.create(
+            title=f"Payment benchmark {time.time()}",
+            author="Benchmark",
+            inventory=1,
+            daily_fee=1,
+        )
+        borrowing = Borrowing.objects.create(
+            expected_return_date=datetime.date.today() + datetime.timedelta(days=1),
+            book=book,
+            user=user,
+        )
+        headers = {"Authorize": f"Bearer {AccessToken.for_user(user)}"}
+        gateway = {
+            "BACKEND": "helpers.payment_gateway.InMemoryGateway",
+            "OPTIONS": {"latency": options["latency"]},
+        }
+        try:
+            with override_settings(
+                PAYMENT_GATEWAY=gateway, ALLOWED_HOSTS=["testserver"]
+            ):
+                threaded, threaded_failed = self.run_threads(
+                    borrowing, headers, options
+                )
+                coroutines, coroutines_failed = self.run_async(
+                    borrowing, headers, options
+                )
+        finally:
+            user.delete()
+            book.delete()
+
+        concurrency = options["concurrency"]
+        self.stdout.write(
+            f"WSGI, {concurrency} threads: {threaded:.0f} renewals/s"
+            f" ({threaded_failed} failed)"
+        )
+        self.stdout.write(
+            f"ASGI, {concurrency} in flight: {coroutines:.0f} renewals/s"
+            f" ({coroutines_failed} failed)"
+        )
+        self.stdout.write(self.style.SUCCESS(f"speedup: x{coroutines / threaded:.2f}"))
+
+    def expired_payments(self, borrowing, options) -> list:
+        # The throttle history lives in the local memory cache, start
+        # every run with a clean one.
+        caches["default"].clear()
+        Payment.objects.filter(borrowing=borrowing).delete()
+        return Payment.objects.bulk_create(
+            Payment(status="E", borrowing=borrowing, money=1)
+            for _ in range(options["payments"])
+        )
+
+    def run_threads(self, borrowing, headers, options) -> tuple:
+        payments = self.expired_payments(borrowing, options)
+        client = Client(headers=headers)
+
+        def renew(payment):
+            try:
+                return client.post(reverse("payment:renew", args=[payment.id]))
+            finally:
+                close_old_connections()
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as executor:
+            responses = list(executor.map(renew, payments))
+        return self.result(payments, responses, started)
+
+    def run_async(self, borrowing, headers, options) -> tuple:
+        payments = self.expired_payments(borrowing, options)
+        client = AsyncClient(headers=headers)
+
+        async def renew_all():
+            semaphore = asyncio.Semaphore(options["concurrency"])
+
+            async def renew(payment):
+                async with semaphore:
+                    return await client.post(
+                        reverse("payment:renew", args=[payment.id])
+                    )
+
+            return await asyncio.gather(*(renew(payment) for payment in payments))
+
+        started = time.monotonic()
+        responses = asyncio.run(renew_all())
+        return self.result(payments, responses, started)
+
+    @staticmethod
+    def result(payments, responses, started) -> tuple:
+        elapsed = time.monotonic() - started
+        failed = sum(1 for response in responses if response.status_code != 200)
+        return len(payments) / elapsed, failed
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Count
+
+from payment.models import Payment, UNPAID_STATUSES, UserPaymentSummary
+
+
+class Command(BaseCommand):
+    help = (
+        "Recounts every user's outstanding payments (UserPaymentSummary) "
+        "from the payments table"
+    )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            # Payments stay readable, but status changes wait for the rebuild.
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"LOCK TABLE {connection.ops.quote_name(Payment._meta.db_table)} "
+                    "IN SHARE MODE"
+                )
+
+            outstanding = (
+                Payment.objects.filter(status__in=UNPAID_STATUSES)
+                .values("borrowing__user")
+                .annotate(total=Count("id"))
+            )
+            summaries = [
+                UserPaymentSummary(
+                    user_id=row["borrowing__user"], outstanding=row["total"]
+                )
+                for row in outstanding
+            ]
+            UserPaymentSummary.objects.update(outstanding=0)
+            UserPaymentSummary.objects.bulk_create(
+                summaries,
+                update_conflicts=True,
+                unique_fields=["user"],
+                update_fields=["outstanding"],
+            )
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Rebuilt payment counters, {len(summaries)} users "
+                f"have outstanding payments."
+            )
+        )
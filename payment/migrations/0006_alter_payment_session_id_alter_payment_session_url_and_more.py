@@ -0,0 +1,77 @@
+# Generated by Django 5.1.1 on 2026-10-18 05:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("payment", "0005_alter_payment_status"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="payment",
+            name="session_id",
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name="payment",
+            name="session_url",
+            field=models.URLField(blank=True, max_length=500),
+        ),
+        migrations.AlterField(
+            model_name="payment",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("S", "SESSION_PENDING"),
+                    ("G", "PENDING"),
+                    ("D", "PAID"),
+                    ("E", "EXPIRED"),
+                ],
+                default="G",
+                max_length=1,
+            ),
+        ),
+        migrations.CreateModel(
+            name="OutboxMessage",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[("S", "PAYMENT_SESSION"), ("N", "NOTIFICATION")],
+                        max_length=1,
+                    ),
+                ),
+                ("payload", models.JSONField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "processed_at",
+                    models.DateTimeField(blank=True, default=None, null=True),
+                ),
+                ("attempts", models.PositiveIntegerField(default=0)),
+                ("last_error", models.TextField(blank=True)),
+            ],
+            options={
+                "verbose_name_plural": "outbox messages",
+                "ordering": ["id"],
+                "indexes": [
+                    models.Index(
+                        condition=models.Q(("processed_at__isnull", True)),
+                        fields=["id"],
+                        name="outbox_pending_idx",
+                    )
+                ],
+            },
+        ),
+    ]
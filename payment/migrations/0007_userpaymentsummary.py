@@ -0,0 +1,51 @@
+# Generated by Django 5.1.1 on 2026-10-18 05:49
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def fill_summaries(apps, schema_editor):
+    Payment = apps.get_model("payment", "Payment")
+    UserPaymentSummary = apps.get_model("payment", "UserPaymentSummary")
+    outstanding = (
+        Payment.objects.filter(status__in=("S", "G", "E"))
+        .values("borrowing__user")
+        .annotate(total=Count("id"))
+    )
+    UserPaymentSummary.objects.bulk_create(
+        UserPaymentSummary(user_id=row["borrowing__user"], outstanding=row["total"])
+        for row in outstanding
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("payment", "0006_alter_payment_session_id_alter_payment_session_url_and_more"),
+        ("user", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UserPaymentSummary",
+            fields=[
+                (
+                    "user",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="payment_summary",
+                        serialize=False,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                ("outstanding", models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                "verbose_name_plural": "user payment summaries",
+            },
+        ),
+        migrations.RunPython(fill_summaries, migrations.RunPython.noop),
+    ]
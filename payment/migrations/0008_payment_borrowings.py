@@ -0,0 +1,21 @@
+# Generated by Django 5.1.1 on 2026-10-18 05:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("borrowings", "0010_borrowing_borrowing_date_id_idx_and_more"),
+        ("payment", "0007_userpaymentsummary"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="payment",
+            name="borrowings",
+            field=models.ManyToManyField(
+                blank=True, related_name="cart_payments", to="borrowings.borrowing"
+            ),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.1 on 2026-10-18 05:58
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("borrowings", "0011_borrowing_reminder_sent_at"),
+        ("payment", "0008_payment_borrowings"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="payment",
+            name="created_at",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name="payment",
+            name="expires_at",
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="payment",
+            index=models.Index(
+                condition=models.Q(("status", "G")),
+                fields=["expires_at"],
+                name="payment_pending_expiry_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.1.1 on 2026-10-18 06:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("payment", "0009_payment_created_at_expires_at"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StripeEvent",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("event_id", models.CharField(max_length=255, unique=True)),
+                ("type", models.CharField(max_length=255)),
+                ("session_id", models.CharField(blank=True, max_length=255)),
+                ("payload", models.JSONField()),
+                ("received_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "processed_at",
+                    models.DateTimeField(blank=True, default=None, null=True),
+                ),
+            ],
+            options={
+                "verbose_name_plural": "stripe events",
+                "ordering": ["id"],
+                "indexes": [
+                    models.Index(
+                        condition=models.Q(("processed_at__isnull", True)),
+                        fields=["id"],
+                        name="stripe_event_pending_idx",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-18 06:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("borrowings", "0011_borrowing_reminder_sent_at"),
+        ("payment", "0010_stripeevent"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="payment",
+            index=models.Index(fields=["money", "id"], name="payment_money_id_idx"),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.1.1 on 2026-10-18 06:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("borrowings", "0011_borrowing_reminder_sent_at"),
+        ("payment", "0011_payment_money_id_idx"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="payment",
+            index=models.Index(
+                condition=models.Q(("session_id", ""), _negated=True),
+                fields=["session_id"],
+                name="payment_session_id_idx",
+            ),
+        ),
+    ]
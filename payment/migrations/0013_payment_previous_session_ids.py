@@ -0,0 +1,32 @@
+# Generated by Django 5.1.1 on 2026-10-18 07:03
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("borrowings", "0011_borrowing_reminder_sent_at"),
+        ("payment", "0012_payment_session_id_idx"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="payment",
+            name="previous_session_ids",
+            field=django.contrib.postgres.fields.ArrayField(
+                base_field=models.CharField(max_length=255),
+                blank=True,
+                default=list,
+                size=None,
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="payment",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["previous_session_ids"], name="payment_previous_sessions_idx"
+            ),
+        ),
+    ]
@@ -1,9 +1,20 @@
-from django.db import models
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
 
 from borrowings.models import Borrowing
 
 
 STATUS_CHOICES = (
+    ("S", "SESSION_PENDING"),
     ("G", "PENDING"),
     ("D", "PAID"),
     ("E", "EXPIRED"),
@@ -14,6 +25,72 @@ TYPE_CHOICES = (
     ("F", "FINE"),
 )
 
+# Statuses that block the user from borrowing new books.
+UNPAID_STATUSES = ("S", "G", "E")
+
+# Allowed moves of a single payment, see Payment.transition().
+STATUS_TRANSITIONS = {
+    "S": ("G",),
+    "G": ("D", "E"),
+    # A session paid right before it expired settles the payment anyway.
+    "E": ("G", "D"),
+}
+
+
+def previous_statuses(status: str) -> tuple:
+    """Statuses a payment may move to ``status`` from."""
+    return tuple(
+        source for source, targets in STATUS_TRANSITIONS.items() if status in targets
+    )
+
+
+class PaymentQuerySet(models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        """Create the payments and count the unpaid ones per user at once."""
+        with transaction.atomic():
+            payments = super().bulk_create(objs, *args, **kwargs)
+            outstanding = Counter(
+                payment.borrowing.user_id
+                for payment in payments
+                if payment.status in UNPAID_STATUSES
+            )
+            for user_id, count in outstanding.items():
+                UserPaymentSummary.adjust(user_id, count)
+
+        for payment in payments:
+            payment._loaded_status = payment.status
+        return payments
+
+    def set_status(self, status: str) -> int:
+        """
+        Move the selected payments to ``status`` with one UPDATE, keeping
+        UserPaymentSummary in step. Only payments whose current status may
+        move there (see STATUS_TRANSITIONS) change, the rest are left as
+        they are. Returns the number of changed payments.
+        """
+        with transaction.atomic():
+            rows = list(
+                self.filter(status__in=previous_statuses(status))
+                .select_for_update(of=("self",))
+                .values_list("id", "status", "borrowing__user_id")
+            )
+            if not rows:
+                return 0
+
+            Payment.objects.filter(id__in=[row[0] for row in rows]).update(
+                status=status
+            )
+            is_unpaid = status in UNPAID_STATUSES
+            outstanding = Counter(
+                user_id
+                for _, old_status, user_id in rows
+                if (old_status in UNPAID_STATUSES) != is_unpaid
+            )
+            for user_id, count in outstanding.items():
+                UserPaymentSummary.adjust(user_id, count if is_unpaid else -count)
+
+        return len(rows)
+
 
 class Payment(models.Model):
     status = models.CharField(max_length=1, choices=STATUS_CHOICES, default="G")
@@ -21,15 +98,217 @@ class Payment(models.Model):
     borrowing = models.ForeignKey(
         Borrowing, on_delete=models.CASCADE, related_name="payments"
     )
-    session_url = models.URLField(max_length=500)
-    session_id = models.CharField(max_length=255)
+    # Every borrowing paid by the payment when it covers a cart checkout,
+    # ``borrowing`` is then the first of them.
+    borrowings = models.ManyToManyField(
+        Borrowing, related_name="cart_payments", blank=True
+    )
+    session_url = models.URLField(max_length=500, blank=True)
+    session_id = models.CharField(max_length=255, blank=True)
+    # Sessions replaced by renewals, a late payment of one still counts.
+    previous_session_ids = ArrayField(
+        models.CharField(max_length=255), default=list, blank=True
+    )
     money = models.DecimalField(max_digits=8, decimal_places=2)
+    created_at = models.DateTimeField(default=timezone.now)
+    # Deadline of the current Stripe session, None while it is unknown.
+    expires_at = models.DateTimeField(blank=True, null=True, default=None)
+
+    objects = PaymentQuerySet.as_manager()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_status = instance.__dict__.get("status")
+        return instance
+
+    def save(self, *args, **kwargs):
+        """Keep the owner's UserPaymentSummary in step with the status."""
+        was_unpaid = getattr(self, "_loaded_status", None) in UNPAID_STATUSES
+        is_unpaid = self.status in UNPAID_STATUSES
+
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if was_unpaid != is_unpaid:
+                UserPaymentSummary.adjust(
+                    self.borrowing.user_id, 1 if is_unpaid else -1
+                )
+        self._loaded_status = self.status
+
+    def transition(self, status: str, **fields) -> bool:
+        """
+        Move the payment from its current status to ``status`` with one
+        ``UPDATE ... WHERE status = <current>`` that writes only the status
+        and ``fields``. Returns True when this call made the move; when
+        another worker changed the row first nothing is written, the
+        instance is reloaded and False is returned, so a transition that
+        already happened is a no-op.
+        """
+        expected = self.status
+        if expected == status:
+            return False
+        if status not in STATUS_TRANSITIONS.get(expected, ()):
+            raise ValueError(
+                f"Invalid payment transition: {expected} -> {status}. "
+                f"Allowed: {STATUS_TRANSITIONS}"
+            )
+
+        with transaction.atomic():
+            won = Payment.objects.filter(id=self.id, status=expected).update(
+                status=status, **fields
+            )
+            was_unpaid = expected in UNPAID_STATUSES
+            is_unpaid = status in UNPAID_STATUSES
+            if won and was_unpaid != is_unpaid:
+                UserPaymentSummary.adjust(
+                    self.borrowing.user_id, 1 if is_unpaid else -1
+                )
+
+        if won:
+            self.status = status
+            for name, value in fields.items():
+                setattr(self, name, value)
+        else:
+            self.refresh_from_db()
+        self._loaded_status = self.status
+        return bool(won)
 
     def __str__(self):
-        return f"{self.borrowing.id} {self.status} {self.type} {self.money}"
+        return f"{self.borrowing_id} {self.status} {self.type} {self.money}"
 
     class Meta:
         verbose_name_plural = "payments"
         ordering = [
             "money",
         ]
+        indexes = [
+            models.Index(fields=["money", "id"], name="payment_money_id_idx"),
+            models.Index(
+                fields=["expires_at"],
+                condition=models.Q(status="G"),
+                name="payment_pending_expiry_idx",
+            ),
+            # Webhook batches and the redirect pages look payments up by
+            # session, payments without one yet are left out.
+            models.Index(
+                fields=["session_id"],
+                condition=~models.Q(session_id=""),
+                name="payment_session_id_idx",
+            ),
+            GinIndex(
+                fields=["previous_session_ids"],
+                name="payment_previous_sessions_idx",
+            ),
+        ]
+
+
+@receiver(post_delete, sender=Payment)
+def release_outstanding_payment(sender, instance, **kwargs):
+    if getattr(instance, "_loaded_status", instance.status) in UNPAID_STATUSES:
+        user_id = (
+            Borrowing.objects.filter(id=instance.borrowing_id)
+            .values_list("user_id", flat=True)
+            .first()
+        )
+        if user_id:
+            UserPaymentSummary.adjust(user_id, -1)
+
+
+class UserPaymentSummary(models.Model):
+    """
+    Number of the user's payments in UNPAID_STATUSES, maintained by
+    Payment.save() and Payment.objects.bulk_create() so the borrow gate
+    is a primary key lookup.
+    Rebuild with ``manage.py rebuild_payment_counters``.
+    """
+
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="payment_summary",
+    )
+    outstanding = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def adjust(cls, user_id: int, delta: int) -> None:
+        counter = {"outstanding": Greatest(F("outstanding") + delta, 0)}
+        if cls.objects.filter(user_id=user_id).update(**counter) or delta < 0:
+            return
+
+        _, created = cls.objects.get_or_create(
+            user_id=user_id, defaults={"outstanding": delta}
+        )
+        if not created:
+            cls.objects.filter(user_id=user_id).update(**counter)
+
+    @classmethod
+    def has_outstanding(cls, user_id: int) -> bool:
+        return cls.objects.filter(user_id=user_id, outstanding__gt=0).exists()
+
+    def __str__(self):
+        return f"{self.user_id}: {self.outstanding} outstanding"
+
+    class Meta:
+        verbose_name_plural = "user payment summaries"
+
+
+class OutboxMessage(models.Model):
+    """
+    Side effect recorded in the same transaction as the data it belongs to
+    and carried out later by the process_outbox task.
+    """
+
+    KIND_CHOICES = (
+        ("S", "PAYMENT_SESSION"),
+        ("N", "NOTIFICATION"),
+    )
+
+    kind = models.CharField(max_length=1, choices=KIND_CHOICES)
+    payload = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(blank=True, null=True, default=None)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f"{self.id} {self.kind} {self.processed_at or 'pending'}"
+
+    class Meta:
+        verbose_name_plural = "outbox messages"
+        ordering = ["id"]
+        indexes = [
+            models.Index(
+                fields=["id"],
+                condition=models.Q(processed_at__isnull=True),
+                name="outbox_pending_idx",
+            ),
+        ]
+
+
+class StripeEvent(models.Model):
+    """
+    Webhook event received from Stripe. The unique ``event_id`` drops
+    redeliveries, the rows are the queue drained by process_stripe_events.
+    """
+
+    event_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=255)
+    session_id = models.CharField(max_length=255, blank=True)
+    payload = models.JSONField()
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(blank=True, null=True, default=None)
+
+    def __str__(self):
+        return f"{self.event_id} {self.type}"
+
+    class Meta:
+        verbose_name_plural = "stripe events"
+        ordering = ["id"]
+        indexes = [
+            models.Index(
+                fields=["id"],
+                condition=models.Q(processed_at__isnull=True),
+                name="stripe_event_pending_idx",
+            ),
+        ]
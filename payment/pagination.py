@@ -0,0 +1,5 @@
+from helpers.pagination import KeysetPagination
+
+
+class PaymentCursorPagination(KeysetPagination):
+    ordering = ("money", "id")
@@ -8,6 +8,8 @@ class PaymentListSerializer(serializers.ModelSerializer):
     borrowing = BorrowingListWithoutPaymentSerializer(read_only=True)
     status = serializers.CharField(source="get_status_display", read_only=True)
     type = serializers.CharField(source="get_type_display", read_only=True)
+    # Every borrowing of a cart checkout, empty for a single borrowing.
+    borrowings = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
 
     class Meta:
         model = Payment
@@ -16,10 +18,14 @@ class PaymentListSerializer(serializers.ModelSerializer):
             "status",
             "type",
             "borrowing",
+            "borrowings",
             "session_url",
             "session_id",
             "money",
+            "created_at",
+            "expires_at",
         )
+        read_only_fields = ("created_at", "expires_at")
 
     def validate_money(self, value):
         if value <= 0 or value >= 1000000:
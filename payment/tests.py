@@ -1,3 +1,917 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import hashlib
+import hmac
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import stripe
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection
+from django.test import AsyncClient, RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from books.models import Book
+from borrowings.models import Borrowing
+from borrowings.tasks import (
+    process_outbox,
+    process_stripe_events,
+    track_expired_stripe_sessions,
+)
+from helpers.payment_gateway import (
+    InMemoryGateway,
+    PaymentGateway,
+    StripeGateway,
+    get_payment_gateway,
+)
+from helpers.circuit_breaker import CircuitBreaker, CircuitOpenError
+from helpers.rate_limit import TokenBucket
+from helpers.stripe_helper import (
+    StripePaymentException,
+    create_stripe_session,
+    renew_payment,
+    stripe_expired_check,
+    stripe_success_check,
+)
+from payment.models import OutboxMessage, Payment, StripeEvent, UserPaymentSummary
+
+BORROWING_LIST_URL = reverse("borrowings:borrowing-list")
+PAYMENT_LIST_URL = reverse("payment:payment-list")
+WEBHOOK_URL = reverse("payment:stripe-webhook")
+STRIPE_SUCCESS_URL = reverse("borrowings:stripe-success")
+WEBHOOK_SECRET = "whsec_test_secret"
+
+
+def outstanding(user) -> int:
+    summary = UserPaymentSummary.objects.filter(user=user).first()
+    return summary.outstanding if summary else 0
+
+
+class UserPaymentSummaryTests(TestCase):
+
+    def setUp(self) -> None:
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            email="test@test.com", password="test_password"
+        )
+        self.client.force_authenticate(self.user)
+        self.book = Book.objects.create(
+            title="Test Title", author="Test Author", inventory=10, daily_fee=1
+        )
+        self.borrowing = Borrowing.objects.create(
+            expected_return_date=datetime.date.today() + datetime.timedelta(days=2),
+            book=self.book,
+            user=self.user,
+        )
+
+    def sample_payment(self, **params) -> Payment:
+        defaults = {"status": "G", "borrowing": self.borrowing, "money": 2}
+        defaults.update(params)
+        return Payment.objects.create(**defaults)
+
+    def borrow(self):
+        return self.client.post(
+            BORROWING_LIST_URL,
+            {
+                "expected_return_date": datetime.date.today()
+                + datetime.timedelta(days=2),
+                "book": self.book.id,
+                "user": self.user.id,
+            },
+        )
+
+    def test_counter_follows_status_transitions(self):
+        payment = self.sample_payment(status="S")
+        self.assertEqual(outstanding(self.user), 1)
+
+        payment.status = "E"
+        payment.save()
+        self.assertEqual(outstanding(self.user), 1)
+
+        payment = Payment.objects.get(id=payment.id)
+        payment.status = "D"
+        payment.save()
+        self.assertEqual(outstanding(self.user), 0)
+
+    def test_deleting_unpaid_payment_decrements_counter(self):
+        self.sample_payment()
+        self.sample_payment(status="D")
+
+        Payment.objects.filter(status="G").delete()
+
+        self.assertEqual(outstanding(self.user), 0)
+
+    def test_user_with_unpaid_payment_cannot_borrow(self):
+        self.sample_payment(status="E")
+
+        res = self.borrow()
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_user_can_borrow_after_paying(self):
+        payment = self.sample_payment()
+        payment.status = "D"
+        payment.save()
+
+        res = self.borrow()
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(outstanding(self.user), 1)
+
+    def test_rebuild_command_repairs_counters(self):
+        self.sample_payment()
+        self.sample_payment(status="D")
+        UserPaymentSummary.objects.filter(user=self.user).update(outstanding=5)
+
+        call_command("rebuild_payment_counters", stdout=StringIO())
+
+        self.assertEqual(outstanding(self.user), 1)
+
+
+class PaymentExpiryTests(TestCase):
+
+    def setUp(self) -> None:
+        user = get_user_model().objects.create_user(
+            email="test@test.com", password="test_password"
+        )
+        book = Book.objects.create(
+            title="Test Title", author="Test Author", inventory=10, daily_fee=1
+        )
+        self.borrowing = Borrowing.objects.create(
+            expected_return_date=datetime.date.today() + datetime.timedelta(days=2),
+            book=book,
+            user=user,
+        )
+
+    def sample_payment(self, expires_in=None, status="G") -> Payment:
+        expires_at = None
+        if expires_in is not None:
+            expires_at = timezone.now() + datetime.timedelta(minutes=expires_in)
+        return Payment.objects.create(
+            status=status,
+            borrowing=self.borrowing,
+            money=2,
+            session_id="cs_test",
+            expires_at=expires_at,
+        )
+
+    def test_renewed_session_deadline_is_stored(self):
+        payment = self.sample_payment(expires_in=-10, status="E")
+        deadline = timezone.now().replace(microsecond=0) + datetime.timedelta(hours=24)
+        session = SimpleNamespace(
+            id="cs_test",
+            url="https://checkout.stripe.com/cs",
+            expires_at=int(deadline.timestamp()),
+        )
+
+        with mock.patch(
+            "helpers.stripe_helper.stripe.checkout.Session.create", return_value=session
+        ):
+            renew_payment(RequestFactory().post("/"), payment)
+
+        payment.refresh_from_db()
+        self.assertEqual(payment.expires_at, deadline)
+
+    def test_sessions_past_deadline_expire_without_stripe_calls(self):
+        expired = self.sample_payment(expires_in=-1)
+        open_session = self.sample_payment(expires_in=60)
+
+        with mock.patch(
+            "helpers.stripe_helper.stripe.checkout.Session.retrieve"
+        ) as retrieve:
+            stats = track_expired_stripe_sessions()
+
+        retrieve.assert_not_called()
+        self.assertEqual(stats, {"expired": 1, "checked_with_stripe": 0, "failed": 0})
+        self.assertEqual(Payment.objects.get(id=expired.id).status, "E")
+        self.assertEqual(Payment.objects.get(id=open_session.id).status, "G")
+
+    def test_unknown_deadline_is_asked_once(self):
+        payment = self.sample_payment()
+        deadline = timezone.now().replace(microsecond=0) + datetime.timedelta(hours=1)
+        session = SimpleNamespace(status="open", expires_at=int(deadline.timestamp()))
+
+        with mock.patch(
+            "helpers.stripe_helper.stripe.checkout.Session.retrieve",
+            return_value=session,
+        ) as retrieve:
+            track_expired_stripe_sessions()
+            track_expired_stripe_sessions()
+
+        retrieve.assert_called_once()
+        payment.refresh_from_db()
+        self.assertEqual((payment.status, payment.expires_at), ("G", deadline))
+
+
+class PaymentTransitionTests(TestCase):
+
+    def setUp(self) -> None:
+        self.user = get_user_model().objects.create_user(
+            email="test@test.com", password="test_password"
+        )
+        book = Book.objects.create(
+            title="Test Title", author="Test Author", inventory=10, daily_fee=1
+        )
+        borrowing = Borrowing.objects.create(
+            expected_return_date=datetime.date.today() + datetime.timedelta(days=2),
+            book=book,
+            user=self.user,
+        )
+        self.payment = Payment.objects.create(
+            status="G", borrowing=borrowing, money=2, session_id="cs_test"
+        )
+
+    def test_transition_is_won_once(self):
+        first = Payment.objects.get(id=self.payment.id)
+        second = Payment.objects.get(id=self.payment.id)
+
+        self.assertTrue(first.transition("D"))
+        self.assertFalse(second.transition("D"))
+        self.assertFalse(first.transition("D"))
+
+        self.assertEqual(second.status, "D")
+        self.assertEqual(outstanding(self.user), 0)
+
+    def test_stale_worker_does_not_overwrite_winner(self):
+        paid = Payment.objects.get(id=self.payment.id)
+        sweep = Payment.objects.get(id=self.payment.id)
+
+        paid.transition("D")
+        self.assertFalse(sweep.transition("E"))
+
+        self.assertEqual(sweep.status, "D")
+        self.assertEqual(Payment.objects.get(id=self.payment.id).status, "D")
+
+    def test_only_status_and_given_fields_are_written(self):
+        self.payment.money = 99
+        self.payment.transition("E", session_url="https://checkout.stripe.com/cs")
+
+        payment = Payment.objects.get(id=self.payment.id)
+        self.assertEqual(payment.status, "E")
+        self.assertEqual(payment.session_url, "https://checkout.stripe.com/cs")
+        self.assertEqual(payment.money, 2)
+
+    def test_disallowed_transition_is_rejected(self):
+        self.payment.transition("D")
+
+        with self.assertRaises(ValueError):
+            self.payment.transition("G")
+
+    def test_success_check_marks_payment_paid_once(self):
+        session = SimpleNamespace(payment_status="paid")
+        with mock.patch(
+            "helpers.stripe_helper.stripe.checkout.Session.retrieve",
+            return_value=session,
+        ):
+            stripe_success_check(Payment.objects.get(id=self.payment.id))
+            res = stripe_success_check(Payment.objects.get(id=self.payment.id))
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(Payment.objects.get(id=self.payment.id).status, "D")
+        self.assertEqual(outstanding(self.user), 0)
+
+
+class PaymentListTests(TestCase):
+
+    def setUp(self) -> None:
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            email="test@test.com", password="test_password"
+        )
+        self.other_user = get_user_model().objects.create_user(
+            email="other@test.com", password="test_password"
+        )
+        self.admin_user = get_user_model().objects.create_superuser(
+            email="admin@test.com", password="admin_password"
+        )
+        self.book = Book.objects.create(
+            title="Test Title", author="Test Author", inventory=10, daily_fee=1
+        )
+        self.sharded_book = Book.objects.create(
+            title="Other Title", author="Test Author", inventory=10, daily_fee=1
+        )
+        self.sharded_book.set_shard_count(2)
+
+    def create_payments(self, count: int, user=None, **params) -> list:
+        borrowings = Borrowing.objects.bulk_create(
+            Borrowing(
+                expected_return_date=datetime.date.today() + datetime.timedelta(days=2),
+                book=self.sharded_book if number % 2 else self.book,
+                user=user or self.user,
+            )
+            for number in range(count)
+        )
+        return Payment.objects.bulk_create(
+            Payment(borrowing=borrowing, money=number % 50 + 1, **params)
+            for number, borrowing in enumerate(borrowings)
+        )
+
+    def count_queries(self, url, params=None) -> int:
+        with CaptureQueriesContext(connection) as context:
+            res = self.client.get(url, params)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        return len(context.captured_queries)
+
+    def list_ids(self, **params) -> list:
+        res = self.client.get(PAYMENT_LIST_URL, params)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        return [payment["id"] for payment in res.data["results"]]
+
+    def test_list_query_count_stays_flat(self):
+        self.client.force_authenticate(self.admin_user)
+
+        self.create_payments(10)
+        queries_for_few = self.count_queries(PAYMENT_LIST_URL)
+        self.create_payments(9990)
+        queries_for_many = self.count_queries(PAYMENT_LIST_URL)
+        queries_for_filtered = self.count_queries(
+            PAYMENT_LIST_URL, {"status": "PENDING", "page_size": 100}
+        )
+
+        self.assertEqual(queries_for_few, queries_for_many)
+        self.assertEqual(queries_for_few, queries_for_filtered)
+
+    def test_own_list_query_count_stays_flat(self):
+        self.client.force_authenticate(self.user)
+
+        self.create_payments(10)
+        queries_for_few = self.count_queries(PAYMENT_LIST_URL)
+        self.create_payments(9990)
+        queries_for_many = self.count_queries(PAYMENT_LIST_URL)
+
+        self.assertEqual(queries_for_few, queries_for_many)
+
+    def test_retrieve_query_count(self):
+        self.client.force_authenticate(self.user)
+        payment = self.create_payments(2)[1]
+
+        with self.assertNumQueries(3):
+            res = self.client.get(reverse("payment:payment-detail", args=[payment.id]))
+
+        self.assertEqual(res.data["borrowing"]["book"]["inventory"], 10)
+
+    def test_pagination_walks_money_order(self):
+        self.client.force_authenticate(self.user)
+        self.create_payments(7)
+        expected_ids = list(
+            Payment.objects.order_by("money", "id").values_list("id", flat=True)
+        )
+
+        seen_ids = []
+        url = f"{PAYMENT_LIST_URL}?page_size=3"
+        while url:
+            res = self.client.get(url)
+            seen_ids.extend(payment["id"] for payment in res.data["results"])
+            url = res.data["next"]
+
+        self.assertEqual(seen_ids, expected_ids)
+
+    def test_filters(self):
+        self.client.force_authenticate(self.admin_user)
+        paid = self.create_payments(1, status="D")
+        fines = self.create_payments(1, type="F")
+        others = self.create_payments(1, user=self.other_user)
+
+        self.assertEqual(self.list_ids(status="PAID"), [paid[0].id])
+        self.assertEqual(self.list_ids(status="D"), [paid[0].id])
+        self.assertEqual(self.list_ids(type="fine"), [fines[0].id])
+        self.assertEqual(self.list_ids(user_id=self.other_user.id), [others[0].id])
+
+    def test_user_sees_only_own_payments(self):
+        self.client.force_authenticate(self.user)
+        own = self.create_payments(1)
+        self.create_payments(1, user=self.other_user)
+
+        self.assertEqual(self.list_ids(), [own[0].id])
+        self.assertEqual(self.list_ids(user_id=self.other_user.id), [])
+
+    def test_invalid_filter_values(self):
+        self.client.force_authenticate(self.user)
+
+        res = self.client.get(PAYMENT_LIST_URL, {"status": "LOST"})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+        res = self.client.get(PAYMENT_LIST_URL, {"user_id": "me"})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+def stripe_event(event_id, event_type, session_id, payment_status="paid") -> bytes:
+    return json.dumps(
+        {
+            "id": event_id,
+            "object": "event",
+            "type": event_type,
+            "data": {
+                "object": {
+                    "id": session_id,
+                    "object": "checkout.session",
+                    "payment_status": payment_status,
+                }
+            },
+        }
+    ).encode()
+
+
+def sign(payload: bytes, secret: str = WEBHOOK_SECRET) -> str:
+    timestamp = int(time.time())
+    signature = hmac.new(
+        secret.encode(), f"{timestamp}.".encode() + payload, hashlib.sha256
+    ).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+@override_settings(STRIPE_WEBHOOK_SECRET=WEBHOOK_SECRET)
+class StripeWebhookTests(TestCase):
+
+    def setUp(self) -> None:
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            email="test@test.com", password="test_password"
+        )
+        book = Book.objects.create(
+            title="Test Title", author="Test Author", inventory=10, daily_fee=1
+        )
+        borrowing = Borrowing.objects.create(
+            expected_return_date=datetime.date.today() + datetime.timedelta(days=2),
+            book=book,
+            user=self.user,
+        )
+        self.payments = [
+            Payment.objects.create(
+                status="G", borrowing=borrowing, money=2, session_id=f"cs_{number}"
+            )
+            for number in range(3)
+        ]
+
+    def post_event(self, payload, signature=None):
+        with mock.patch("payment.views.schedule_stripe_event_processing"):
+            return self.client.post(
+                WEBHOOK_URL,
+                payload,
+                content_type="application/json",
+                HTTP_STRIPE_SIGNATURE=signature or sign(payload),
+            )
+
+    def test_invalid_signature_is_rejected(self):
+        payload = stripe_event("evt_1", "checkout.session.completed", "cs_0")
+
+        res = self.post_event(payload, sign(payload, secret="whsec_other"))
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(StripeEvent.objects.exists())
+
+    def test_redelivered_event_is_stored_once(self):
+        payload = stripe_event("evt_1", "checkout.session.completed", "cs_0")
+
+        self.post_event(payload)
+        res = self.post_event(payload)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(StripeEvent.objects.count(), 1)
+
+    def test_events_update_payments_in_bulk(self):
+        self.post_event(stripe_event("evt_1", "checkout.session.completed", "cs_0"))
+        self.post_event(stripe_event("evt_2", "checkout.session.completed", "cs_1"))
+        self.post_event(stripe_event("evt_3", "checkout.session.expired", "cs_2"))
+
+        with mock.patch("borrowings.tasks.schedule_outbox_processing"):
+            stats = process_stripe_events()
+
+        self.assertEqual(stats, {"events": 3, "paid": 2, "expired": 1})
+        self.assertEqual(
+            [Payment.objects.get(id=p.id).status for p in self.payments],
+            ["D", "D", "E"],
+        )
+        self.assertEqual(UserPaymentSummary.objects.get(user=self.user).outstanding, 1)
+        self.assertEqual(OutboxMessage.objects.filter(kind="N").count(), 2)
+        self.assertFalse(StripeEvent.objects.filter(processed_at__isnull=True).exists())
+
+    def test_unpaid_completed_session_stays_pending(self):
+        self.post_event(
+            stripe_event("evt_1", "checkout.session.completed", "cs_0", "unpaid")
+        )
+
+        process_stripe_events()
+
+        self.assertEqual(Payment.objects.get(id=self.payments[0].id).status, "G")
+
+    def test_completed_session_pays_locally_expired_payment(self):
+        Payment.objects.filter(id=self.payments[0].id).update(status="S")
+        Payment.objects.filter(id=self.payments[1].id).update(status="E")
+        self.post_event(stripe_event("evt_1", "checkout.session.completed", "cs_0"))
+        self.post_event(stripe_event("evt_2", "checkout.session.completed", "cs_1"))
+
+        stats = process_stripe_events()
+
+        self.assertEqual(stats["paid"], 1)
+        self.assertEqual(
+            [Payment.objects.get(id=p.id).status for p in self.payments[:2]],
+            ["S", "D"],
+        )
+        self.assertEqual(OutboxMessage.objects.filter(kind="N").count(), 1)
+
+    def test_completed_session_pays_renewed_payment(self):
+        payment = self.payments[1]
+        payment.transition("E")
+        session = SimpleNamespace(id="cs_renewed", url="https://stripe.test/cs")
+        with mock.patch(
+            "helpers.stripe_helper.create_stripe_session", return_value=session
+        ):
+            renew_payment(None, payment)
+        self.post_event(stripe_event("evt_1", "checkout.session.completed", "cs_1"))
+
+        stats = process_stripe_events()
+
+        self.assertEqual(stats["paid"], 1)
+        payment.refresh_from_db()
+        self.assertEqual(payment.session_id, "cs_renewed")
+        self.assertEqual(payment.previous_session_ids, ["cs_1"])
+        self.assertEqual(payment.status, "D")
+
+    def test_unmatched_paid_session_is_logged(self):
+        self.post_event(
+            stripe_event("evt_1", "checkout.session.completed", "cs_unknown")
+        )
+
+        with self.assertLogs("borrowings.tasks", "ERROR") as logs:
+            stats = process_stripe_events()
+
+        self.assertEqual(stats["paid"], 0)
+        self.assertIn("cs_unknown", logs.output[0])
+
+    def test_success_redirect_reads_local_state(self):
+        Payment.objects.filter(id=self.payments[0].id).set_status("D")
+
+        with mock.patch(
+            "helpers.stripe_helper.stripe.checkout.Session.retrieve"
+        ) as retrieve:
+            res = self.client.get(STRIPE_SUCCESS_URL, {"session_id": "cs_0"})
+
+        retrieve.assert_not_called()
+        self.assertEqual(res.data["payment_status"], "D")
+        self.assertEqual(res.data["message"], "Payment was successful!")
+
+    def test_success_redirect_requires_session_id(self):
+        Payment.objects.filter(id=self.payments[0].id).update(session_id="")
+
+        for params in ({}, {"session_id": ""}):
+            res = self.client.get(STRIPE_SUCCESS_URL, params)
+
+            self.assertEqual(res.status_code, 400)
+
+
+IN_MEMORY_GATEWAY = {"BACKEND": "helpers.payment_gateway.InMemoryGateway"}
+
+
+@override_settings(PAYMENT_GATEWAY=IN_MEMORY_GATEWAY)
+class InMemoryGatewayTests(TestCase):
+
+    def setUp(self) -> None:
+        InMemoryGateway.reset()
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            email="test@test.com", password="test_password"
+        )
+        self.client.force_authenticate(self.user)
+        self.book = Book.objects.create(
+            title="Test Title", author="Test Author", inventory=10, daily_fee=1
+        )
+
+    def borrow_and_open_session(self) -> Payment:
+        res = self.client.post(
+            BORROWING_LIST_URL,
+            {
+                "expected_return_date": datetime.date.today()
+                + datetime.timedelta(days=2),
+                "book": self.book.id,
+                "user": self.user.id,
+            },
+        )
+        with mock.patch("borrowings.tasks.TelegramHelper"):
+            process_outbox()
+        return Payment.objects.get(id=res.data["payment_id"])
+
+    def test_borrow_opens_session_without_stripe(self):
+        payment = self.borrow_and_open_session()
+
+        session = get_payment_gateway().retrieve_session(payment.session_id)
+        self.assertEqual(payment.status, "G")
+        self.assertEqual(payment.session_url, session.url)
+        self.assertEqual(session.amount_total, 200)
+        self.assertIsNotNone(payment.expires_at)
+
+    def test_expired_session_can_be_renewed(self):
+        payment = self.borrow_and_open_session()
+        get_payment_gateway().expire_session(payment.session_id)
+
+        stripe_expired_check(payment)
+        self.assertEqual(payment.status, "E")
+        renew_payment(RequestFactory().post("/"), payment)
+
+        session = get_payment_gateway().retrieve_session(payment.session_id)
+        self.assertEqual((payment.status, session.status), ("G", "open"))
+
+    @override_settings(
+        PAYMENT_GATEWAY={**IN_MEMORY_GATEWAY, "OPTIONS": {"failure_rate": 1}}
+    )
+    def test_injected_failure_surfaces_as_payment_error(self):
+        with self.assertRaises(StripePaymentException):
+            create_stripe_session(RequestFactory().post("/"), 100)
+
+    def test_incomplete_backend_cannot_be_created(self):
+        class CreateOnlyGateway(PaymentGateway):
+            def create_session(self, *args, **kwargs):
+                return None
+
+        with self.assertRaises(TypeError):
+            CreateOnlyGateway()
+
+
+class StripeClientTests(TestCase):
+
+    def test_token_bucket_paces_calls(self):
+        bucket = TokenBucket(rate=100, capacity=1)
+        started = time.monotonic()
+
+        for _ in range(11):
+            bucket.acquire()
+
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+
+    def test_rate_limited_call_is_retried_with_backoff(self):
+        gateway = StripeGateway(max_requests_per_second=1000)
+        session = SimpleNamespace(id="cs_test", status="open")
+        rate_limited = stripe.error.RateLimitError("Too many requests")
+
+        with mock.patch(
+            "helpers.payment_gateway.stripe.checkout.Session.retrieve",
+            side_effect=[rate_limited, rate_limited, session],
+        ) as retrieve, mock.patch("helpers.payment_gateway.time.sleep") as sleep:
+            self.assertEqual(gateway.retrieve_session("cs_test"), session)
+
+        self.assertEqual(retrieve.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_async_session_goes_through_stripe_async_api(self):
+        gateway = StripeGateway(max_requests_per_second=1000)
+        session = SimpleNamespace(id="cs_test", url="https://checkout.stripe.com/cs")
+
+        with mock.patch(
+            "helpers.payment_gateway.stripe.checkout.Session.create_async",
+            new=mock.AsyncMock(return_value=session),
+        ) as create_async:
+            created = async_to_sync(gateway.acreate_session)(
+                [], "https://success", "https://cancel", idempotency_key="key"
+            )
+
+        self.assertEqual(created, session)
+        self.assertEqual(create_async.await_args.kwargs["idempotency_key"], "key")
+
+    def test_async_calls_on_separate_event_loops(self):
+        class SessionHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                body = json.dumps(
+                    {"id": "cs_test", "object": "checkout.session", "status": "open"}
+                ).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), SessionHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        gateway = StripeGateway(max_requests_per_second=1000, max_retries=0)
+
+        with mock.patch.multiple(
+            stripe,
+            api_base=f"http://127.0.0.1:{server.server_port}",
+            api_key="sk_test",
+            max_network_retries=0,
+        ):
+            # WSGI runs every async view call on an event loop of its own.
+            sessions = [
+                async_to_sync(gateway.aretrieve_session)("cs_test") for _ in range(2)
+            ]
+
+        self.assertEqual([session.id for session in sessions], ["cs_test"] * 2)
+        # The session of each loop was closed together with the loop.
+        client = stripe.default_http_client._async_fallback_client
+        self.assertEqual(client._sessions, {})
+
+    def test_sessions_are_retrieved_in_parallel(self):
+        gateway = InMemoryGateway(latency=0.05, max_workers=10)
+        session_ids = [
+            InMemoryGateway().create_session([], "", "").id for _ in range(40)
+        ]
+        started = time.monotonic()
+
+        sessions = gateway.retrieve_sessions(session_ids)
+
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(list(sessions), session_ids)
+
+
+@override_settings(PAYMENT_GATEWAY={**IN_MEMORY_GATEWAY, "OPTIONS": {"latency": 0.2}})
+class AsyncViewsTests(TestCase):
+
+    def setUp(self) -> None:
+        InMemoryGateway.reset()
+        self.user = get_user_model().objects.create_user(
+            email="test@test.com", password="test_password"
+        )
+        self.book = Book.objects.create(
+            title="Test Title", author="Test Author", inventory=10, daily_fee=1
+        )
+        self.borrowing = Borrowing.objects.create(
+            expected_return_date=datetime.date.today() + datetime.timedelta(days=2),
+            book=self.book,
+            user=self.user,
+        )
+
+    async def test_renewals_wait_on_the_gateway_concurrently(self):
+        payments = await sync_to_async(Payment.objects.bulk_create)(
+            Payment(status="E", borrowing=self.borrowing, money=2) for _ in range(20)
+        )
+        token = str(AccessToken.for_user(self.user))
+        client = AsyncClient(headers={"Authorize": f"Bearer {token}"})
+        started = time.monotonic()
+
+        responses = await asyncio.gather(
+            *(
+                client.post(reverse("payment:renew", args=[payment.id]))
+                for payment in payments
+            )
+        )
+
+        self.assertLess(time.monotonic() - started, 20 * 0.2 / 2)
+        self.assertEqual({res.status_code for res in responses}, {200})
+        self.assertEqual(
+            await Payment.objects.filter(status="G").acount(), len(payments)
+        )
+
+    def test_late_return_opens_fine_session_inline(self):
+        Borrowing.objects.filter(id=self.borrowing.id).update(
+            borrow_date=datetime.date.today() - datetime.timedelta(days=10),
+            expected_return_date=datetime.date.today() - datetime.timedelta(days=3),
+        )
+        client = APIClient()
+        client.force_authenticate(self.user)
+
+        res = client.post(reverse("borrowings:return", args=[self.borrowing.id]))
+
+        fine = Payment.objects.get(id=res.data["fine_payment_id"])
+        self.assertEqual((fine.type, fine.status), ("F", "G"))
+        self.assertEqual(res.data["url_for_payment"], fine.session_url)
+        self.assertEqual(
+            get_payment_gateway().retrieve_session(fine.session_id).url,
+            fine.session_url,
+        )
+        self.assertFalse(
+            OutboxMessage.objects.filter(processed_at__isnull=True).exists()
+        )
+        self.assertEqual(process_outbox(), 0)
+        self.assertEqual(len(InMemoryGateway._sessions), 1)
+
+
+@override_settings(PAYMENT_GATEWAY=IN_MEMORY_GATEWAY)
+class ExpirySweepTests(TestCase):
+
+    def test_sweep_expires_and_records_deadlines_in_bulk(self):
+        user = get_user_model().objects.create_user(
+            email="test@test.com", password="test_password"
+        )
+        book = Book.objects.create(
+            title="Test Title", author="Test Author", inventory=10, daily_fee=1
+        )
+        borrowing = Borrowing.objects.create(
+            expected_return_date=datetime.date.today() + datetime.timedelta(days=2),
+            book=book,
+            user=user,
+        )
+        gateway = get_payment_gateway()
+        session_ids = [gateway.create_session([], "", "").id for _ in range(6)]
+        for session_id in session_ids[:2]:
+            gateway.expire_session(session_id)
+        Payment.objects.bulk_create(
+            Payment(status="G", borrowing=borrowing, money=2, session_id=session_id)
+            for session_id in session_ids
+        )
+
+        stats = track_expired_stripe_sessions()
+
+        self.assertEqual(stats, {"expired": 2, "checked_with_stripe": 6, "failed": 0})
+        self.assertEqual(Payment.objects.filter(status="E").count(), 2)
+        self.assertFalse(
+            Payment.objects.filter(status="G", expires_at__isnull=True).exists()
+        )
+
+    def test_sweep_leaves_payments_renewed_meanwhile_alone(self):
+        user = get_user_model().objects.create_user(
+            email="test@test.com", password="test_password"
+        )
+        book = Book.objects.create(
+            title="Test Title", author="Test Author", inventory=10, daily_fee=1
+        )
+        borrowing = Borrowing.objects.create(
+            expected_return_date=datetime.date.today() + datetime.timedelta(days=2),
+            book=book,
+            user=user,
+        )
+        gateway = get_payment_gateway()
+        expired_session, open_session = (
+            gateway.create_session([], "", "").id for _ in range(2)
+        )
+        gateway.expire_session(expired_session)
+        payments = Payment.objects.bulk_create(
+            Payment(status="G", borrowing=borrowing, money=2, session_id=session_id)
+            for session_id in (expired_session, open_session)
+        )
+        retrieve_sessions = gateway.retrieve_sessions
+
+        def renew_while_retrieving(session_ids):
+            sessions = retrieve_sessions(session_ids)
+            for payment in payments:
+                Payment.objects.filter(id=payment.id).update(
+                    session_id=f"{payment.session_id}_renewed"
+                )
+            return sessions
+
+        with mock.patch.object(
+            gateway, "retrieve_sessions", side_effect=renew_while_retrieving
+        ):
+            stats = track_expired_stripe_sessions()
+
+        self.assertEqual(stats["expired"], 0)
+        self.assertEqual(
+            list(Payment.objects.order_by("id").values_list("status", "expires_at")),
+            [("G", None), ("G", None)],
+        )
+
+
+class CircuitBreakerTests(TestCase):
+
+    def setUp(self) -> None:
+        self.breaker = CircuitBreaker(
+            "test",
+            min_calls=4,
+            failure_rate=0.5,
+            slow_call_seconds=0.05,
+            open_seconds=0.05,
+            failure_exceptions=(ConnectionError,),
+        )
+
+    def fail(self):
+        raise ConnectionError("down")
+
+    def test_opens_on_failure_rate_and_fails_fast(self):
+        self.breaker.call(lambda: "ok")
+        self.breaker.call(lambda: "ok")
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                self.breaker.call(self.fail)
+
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.call(lambda: "ok")
+        self.assertEqual(self.breaker.stats()["rejected_calls"], 1)
+
+    def test_opens_on_slow_calls(self):
+        for _ in range(4):
+            self.breaker.call(time.sleep, 0.06)
+
+        self.assertEqual(self.breaker.stats()["state"], "open")
+
+    def test_successful_trial_call_closes_breaker(self):
+        for _ in range(4):
+            with self.assertRaises(ConnectionError):
+                self.breaker.call(self.fail)
+        time.sleep(0.06)
+
+        self.assertEqual(self.breaker.call(lambda: "ok"), "ok")
+        self.assertEqual(self.breaker.stats()["state"], "closed")
+
+    def test_client_errors_do_not_count_as_failures(self):
+        for _ in range(4):
+            with self.assertRaises(ValueError):
+                self.breaker.call(int, "x")
+
+        self.assertEqual(self.breaker.stats()["state"], "closed")
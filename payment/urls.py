@@ -1,7 +1,11 @@
 from django.urls import path, include
 from rest_framework import routers
 
-from payment.views import PaymentViewSet, RenewPaymentSessionView
+from payment.views import (
+    PaymentViewSet,
+    RenewPaymentSessionView,
+    StripeWebhookView,
+)
 
 router = routers.DefaultRouter()
 router.register("payment", PaymentViewSet)
@@ -9,6 +13,7 @@ router.register("payment", PaymentViewSet)
 urlpatterns = [
     path("", include(router.urls)),
     path("payment/<int:id>/renew/", RenewPaymentSessionView().as_view(), name="renew"),
+    path("stripe/webhook/", StripeWebhookView.as_view(), name="stripe-webhook"),
 ]
 
 app_name = "payment"
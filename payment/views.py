@@ -1,55 +1,143 @@
+import json
+
 import stripe
 from django.db import transaction
-from django.shortcuts import get_object_or_404
+from django.db.models import Prefetch
+from django.shortcuts import aget_object_or_404
+from django.utils import timezone
+from drf_spectacular.utils import extend_schema, OpenApiParameter
 from rest_framework import viewsets, status
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.exceptions import ValidationError
+from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from helpers.stripe_helper import stripe_success_check, renew_payment
-from helpers.telegram_helper import TelegramHelper
-from payment.models import Payment
+from books.models import Book
+from borrowings.tasks import schedule_stripe_event_processing
+from helpers.async_views import AsyncAPIView
+from helpers.idempotency import idempotent
+from helpers.stripe_helper import (
+    PaymentGatewayUnavailable,
+    arenew_payment,
+    construct_webhook_event,
+)
+from payment.models import Payment, STATUS_CHOICES, StripeEvent, TYPE_CHOICES
+from payment.pagination import PaymentCursorPagination
 from payment.serializers import PaymentListSerializer
 
+STRIPE_EVENT_TYPES = ("checkout.session.completed", "checkout.session.expired")
+
+
+def parse_choice_param(params, name: str, choices) -> str | None:
+    """Accept a choice by its code (``G``) or its label (``PENDING``)."""
+    value = params.get(name)
+    if not value:
+        return None
+    for code, label in choices:
+        if value.upper() in (code, label):
+            return code
+    raise ValidationError({name: f"Must be one of {[label for _, label in choices]}."})
+
 
 class PaymentViewSet(viewsets.ModelViewSet):
     queryset = Payment.objects.all()
     serializer_class = PaymentListSerializer
     permission_classes = (IsAuthenticated,)
+    pagination_class = PaymentCursorPagination
 
     def get_queryset(self):
         queryset = super().get_queryset()
 
+        if self.action in ["list", "retrieve"]:
+            queryset = queryset.select_related("borrowing__user").prefetch_related(
+                Prefetch(
+                    "borrowing__book", queryset=Book.objects.with_available_inventory()
+                ),
+                "borrowings",
+            )
+
+        if self.action == "list":
+            params = self.request.query_params
+            status_code = parse_choice_param(params, "status", STATUS_CHOICES)
+            type_code = parse_choice_param(params, "type", TYPE_CHOICES)
+            user_id = params.get("user_id")
+            if status_code:
+                queryset = queryset.filter(status=status_code)
+            if type_code:
+                queryset = queryset.filter(type=type_code)
+            if user_id:
+                if not user_id.isdigit():
+                    raise ValidationError({"user_id": "A valid integer is required."})
+                queryset = queryset.filter(borrowing__user_id=user_id)
+
         if self.action in ["list", "retrieve"] and not self.request.user.is_staff:
             queryset = queryset.filter(borrowing__user=self.request.user)
             return queryset
 
         return queryset
 
+    @extend_schema(
+        parameters=[
+            OpenApiParameter(
+                "status",
+                type=str,
+                description="Filter by payment status (SESSION_PENDING, PENDING, "
+                "PAID, EXPIRED) ex. ?status=PENDING",
+            ),
+            OpenApiParameter(
+                "type",
+                type=str,
+                description="Filter by payment type (PAYMENT, FINE) ex. ?type=FINE",
+            ),
+            OpenApiParameter(
+                "user_id",
+                type=int,
+                description="Filter by the user of the borrowing, admin users see "
+                "all users' payments ex. ?user_id=2",
+            ),
+        ]
+    )
+    def list(self, request, *args, **kwargs):
+        """Get list of payments."""
+        return super().list(request, *args, **kwargs)
+
     def get_serializer_class(self):
         if self.action in ["list", "retrieve"]:
             return PaymentListSerializer
         return super().get_serializer_class()
 
 
-class StripeSuccessView(APIView):
-    def get(self, request, *args, **kwargs):
+class StripeSuccessView(AsyncAPIView):
+    """
+    Stripe redirects here after the checkout. The payment status comes
+    from the webhook events, so the view only reads the local state.
+    """
+
+    async def get(self, request, *args, **kwargs):
         session_id = request.query_params.get("session_id")
-        payment = get_object_or_404(Payment, session_id=session_id)
-        stripe_success_check(payment)
+        if not session_id:
+            return Response(
+                {"error": "session_id is required"}, status=status.HTTP_400_BAD_REQUEST
+            )
+        payment = await aget_object_or_404(Payment, session_id=session_id)
 
-        telegram_helper = TelegramHelper()
-        message = f"Successful payment {payment.money} USD."
-        telegram_helper.send_message(message)
+        if payment.status == "D":
+            message = "Payment was successful!"
+        else:
+            message = "Payment is being processed, its status will be updated shortly."
 
         return Response(
-            {"message": "Payment was successful!", "session_id": session_id},
+            {
+                "message": message,
+                "session_id": session_id,
+                "payment_status": payment.status,
+            },
             status=status.HTTP_200_OK,
         )
 
 
-class StripeCancelView(APIView):
-    def get(self, request):
+class StripeCancelView(AsyncAPIView):
+    async def get(self, request):
 
         session_id = request.query_params.get("session_id")
         if not session_id:
@@ -58,9 +146,10 @@ class StripeCancelView(APIView):
             )
 
         try:
-            session = stripe.checkout.Session.retrieve(session_id)
-            payment = Payment.objects.get(session_id=session_id)
-            if payment.status == "G" and session.status == "open":
+            payment = await Payment.objects.aget(session_id=session_id)
+            if payment.status == "G" and (
+                payment.expires_at is None or payment.expires_at > timezone.now()
+            ):
                 return Response(
                     {
                         "message": "Payment session is available for 24 hours. You can complete the payment later.",
@@ -83,18 +172,59 @@ class StripeCancelView(APIView):
             )
 
 
-class RenewPaymentSessionView(APIView):
+class StripeWebhookView(APIView):
+    """
+    Signed Stripe webhook. Checkout session completed/expired events are
+    stored once per event id and applied by the process_stripe_events task.
+    """
+
+    authentication_classes = ()
+    permission_classes = (AllowAny,)
+    throttle_classes = ()
+
+    def post(self, request):
+        payload = request.body
+        try:
+            construct_webhook_event(
+                payload, request.META.get("HTTP_STRIPE_SIGNATURE", "")
+            )
+        except (ValueError, stripe.error.SignatureVerificationError):
+            return Response(
+                {"error": "Invalid Stripe webhook signature."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        event = json.loads(payload)
+        if event["type"] in STRIPE_EVENT_TYPES:
+            session = event["data"]["object"]
+            _, created = StripeEvent.objects.get_or_create(
+                event_id=event["id"],
+                defaults={
+                    "type": event["type"],
+                    "session_id": session["id"],
+                    "payload": session,
+                },
+            )
+            if created:
+                transaction.on_commit(schedule_stripe_event_processing)
+
+        return Response({"received": True}, status=status.HTTP_200_OK)
+
+
+class RenewPaymentSessionView(AsyncAPIView):
     """Renew the Payment session"""
 
     serializer_class = PaymentListSerializer
 
-    @transaction.atomic
-    def post(self, request, id):
+    @idempotent
+    async def post(self, request, id):
         try:
 
-            payment = get_object_or_404(Payment, id=id)
+            payment = await aget_object_or_404(
+                Payment.objects.select_related("borrowing__user"), id=id
+            )
             if payment.status == "E":
-                renew_payment(request, payment)
+                await arenew_payment(request, payment)
 
                 return Response(
                     {
@@ -111,5 +241,8 @@ class RenewPaymentSessionView(APIView):
                     status=status.HTTP_400_BAD_REQUEST,
                 )
 
+        except PaymentGatewayUnavailable:
+            raise
+
         except Exception as e:
             raise ValueError(f"Error occurred while creating payment: {str(e)}")